@@ -4,6 +4,7 @@ import os
 from quit.conf import Feature, QuitStoreConfiguration
 from quit.exceptions import InvalidConfigurationError
 import rdflib.plugins.sparql
+import quit.tools.evaluate
 from rdflib.plugins.sparql.algebra import SequencePath
 from rdflib.plugin import register
 from rdflib.serializer import Serializer
@@ -71,6 +72,10 @@ def initialize(args):
     # To disable web access: https://github.com/RDFLib/rdflib/issues/810
     rdflib.plugins.sparql.SPARQL_LOAD_GRAPHS = False
 
+    # Bound the memory used for GROUP BY and DISTINCT on huge result sets
+    quit.tools.evaluate.SPILL_THRESHOLD = args['spill_threshold']
+    quit.tools.evaluate.REDUCED_BUFFER_SIZE = args['reduced_buffer']
+
     register(
         'sparql', Processor,
         'quit.tools.processor', 'SPARQLProcessor')
@@ -153,7 +158,8 @@ class FeaturesAction(argparse.Action):
     CHOICES = {
         'provenance': Feature.Provenance,
         'persistence': Feature.Persistence,
-        'garbagecollection': Feature.GarbageCollection
+        'garbagecollection': Feature.GarbageCollection,
+        'compactfiles': Feature.CompactFiles
     }
 
     def __call__(self, parser, namespace, values, option_string=None):
@@ -185,6 +191,13 @@ def getDefaults():
         'verbose': 0,
         'flask_debug': False,
         'defaultgraph_union': False,
+        'spill_threshold': None,
+        'reduced_buffer': 1,
+        'query_timeout': None,
+        'query_result_limit': None,
+        'provenance_query_timeout': None,
+        'provenance_query_result_limit': None,
+        'upload_limit': None,
         'features': 0
     }
 
@@ -224,6 +237,28 @@ def parseEnv():
     if 'QUIT_OAUTH_SECRET' in os.environ:
         env['oauth_clientsecret'] = os.environ['QUIT_OAUTH_SECRET']
 
+    if 'QUIT_SPILL_THRESHOLD' in os.environ:
+        env['spill_threshold'] = int(os.environ['QUIT_SPILL_THRESHOLD'])
+
+    if 'QUIT_REDUCED_BUFFER' in os.environ:
+        env['reduced_buffer'] = int(os.environ['QUIT_REDUCED_BUFFER'])
+
+    if 'QUIT_QUERY_TIMEOUT' in os.environ:
+        env['query_timeout'] = float(os.environ['QUIT_QUERY_TIMEOUT'])
+
+    if 'QUIT_QUERY_RESULT_LIMIT' in os.environ:
+        env['query_result_limit'] = int(os.environ['QUIT_QUERY_RESULT_LIMIT'])
+
+    if 'QUIT_PROVENANCE_QUERY_TIMEOUT' in os.environ:
+        env['provenance_query_timeout'] = float(os.environ['QUIT_PROVENANCE_QUERY_TIMEOUT'])
+
+    if 'QUIT_PROVENANCE_QUERY_RESULT_LIMIT' in os.environ:
+        env['provenance_query_result_limit'] = int(
+            os.environ['QUIT_PROVENANCE_QUERY_RESULT_LIMIT'])
+
+    if 'QUIT_UPLOAD_LIMIT' in os.environ:
+        env['upload_limit'] = int(os.environ['QUIT_UPLOAD_LIMIT'])
+
     return env
 
 
@@ -236,12 +271,26 @@ def parseArgs(args):
     basepathhelp = "Base path (aka. application root) (WSGI only)."
     featurehelp = """This option enables additional features of the QuitStore:
                 "provenance" - Store provenance information for each revision.
-                "persistance" - Store all internal data as rdf graph."""
+                "persistance" - Store all internal data as rdf graph.
+                "compactfiles" - Keep the graph files in memory as bytes instead of str objects."""
     confighelp = """Path of config file (turtle). Defaults to ./config.ttl."""
     loghelp = """Path to the log file."""
     targethelp = 'The directory of the local store repository.'
     namespacehelp = """A base namespace that will be applied when dealing with relative URIs in
                     SPARQL UPDATE queries."""
+    spillhelp = """Number of groups resp. distinct solutions kept in memory while evaluating a
+                SPARQL query before further data is spilled to temporary files. Unlimited by
+                default."""
+    reducedhelp = """Number of recent solutions compared for SPARQL REDUCED. Defaults to 1."""
+    timeouthelp = """Seconds a query on the SPARQL endpoint may run before it is aborted with a
+                  503 response. Unlimited by default."""
+    limithelp = """Number of results a query on the SPARQL endpoint may produce before it is
+                aborted with a 503 response. Unlimited by default."""
+    provtimeouthelp = """Like --query-timeout but for the provenance endpoint."""
+    provlimithelp = """Like --query-result-limit but for the provenance endpoint."""
+    uploadhelp = """Number of bytes a request body written to the statements, the graph store or
+                 the import endpoint may have before the request is rejected with a 413 response.
+                 Unlimited by default."""
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', '--port', type=int)
@@ -257,6 +306,13 @@ def parseArgs(args):
     parser.add_argument('-v', '--verbose', action='count', default=0)
     parser.add_argument('--flask-debug', action='store_true')
     parser.add_argument('--defaultgraph-union', action='store_true')
+    parser.add_argument('--spill-threshold', type=int, help=spillhelp)
+    parser.add_argument('--reduced-buffer', type=int, help=reducedhelp)
+    parser.add_argument('--query-timeout', type=float, help=timeouthelp)
+    parser.add_argument('--query-result-limit', type=int, help=limithelp)
+    parser.add_argument('--provenance-query-timeout', type=float, help=provtimeouthelp)
+    parser.add_argument('--provenance-query-result-limit', type=int, help=provlimithelp)
+    parser.add_argument('--upload-limit', type=int, help=uploadhelp)
     parser.add_argument('-f', '--features', nargs='*', action=FeaturesAction,
                         default=Feature.Unknown,
                         help=featurehelp)
@@ -0,0 +1,473 @@
+import codecs
+import heapq
+import io
+import logging
+
+from tempfile import TemporaryDirectory, mkstemp
+from rdflib import URIRef
+from rdflib.exceptions import ParserError
+from rdflib.plugins.parsers.ntriples import W3CNTriplesParser, r_tail, r_wspace
+from rdflib.plugins.serializers.nt import _nt_row as _nt
+from quit.conf import Feature
+from quit.exceptions import BulkImportError
+
+logger = logging.getLogger('quit.bulk')
+
+
+class _ScopedLabels(dict):
+    """Blank node labels of a parser which are all prefixed with the same string."""
+
+    def __init__(self, prefix):
+        super().__init__()
+        self.prefix = prefix
+
+    def get(self, label, default=None):
+        return self.prefix + label
+
+
+class StatementParser(W3CNTriplesParser):
+    """Parse single lines of N-Triples or N-Quads.
+
+    Blank node labels are mapped to the same blank nodes for all lines parsed by an instance.
+    """
+
+    def statement(self, line):
+        """Return a (s, p, o, graph) tuple of a line, graph is None for a triple.
+
+        Returns None for empty lines and comments.
+
+        Raises:
+            ParserError if the line is not a valid triple or quad
+        """
+        self.line = line.rstrip('\r\n')
+        self.eat(r_wspace)
+        if not self.line or self.line.startswith('#'):
+            return None
+
+        subject = self.subject()
+        self.eat(r_wspace)
+        predicate = self.predicate()
+        self.eat(r_wspace)
+        obj = self.object()
+        self.eat(r_wspace)
+        graph = self.uriref() or None
+        self.eat(r_tail)
+
+        if self.line:
+            raise ParserError("Trailing garbage")
+        return subject, predicate, obj, graph
+
+
+def parse_statements(stream, default=None):
+    """Yield (s, p, o, graph) tuples for the statements of N-Triples or N-Quads.
+
+    Args:
+        stream: A binary file-like object or an iterable of lines in UTF-8
+        default: The graph IRI of triples and of quads without a graph label
+    Raises:
+        BulkImportError if a statement is invalid or no graph is given for a triple
+    """
+    parser = StatementParser()
+    default = URIRef(default) if default else None
+
+    for number, line in enumerate(codecs.iterdecode(stream, 'utf-8'), start=1):
+        try:
+            statement = parser.statement(line)
+        except ParserError as e:
+            raise BulkImportError('Invalid statement in line {}: {}'.format(number, e))
+        if statement is None:
+            continue
+
+        s, p, o, graph = statement
+        graph = graph or default
+        if graph is None:
+            raise BulkImportError('No graph given for the triple in line {}'.format(number))
+        yield s, p, o, graph
+
+
+class BulkImport(object):
+    """Import N-Triples or N-Quads into a branch with a single commit.
+
+    The statements are not evaluated as SPARQL Update. Every statement is serialized to its line
+    in the graph file right away. The lines are kept per graph in sorted runs of at most
+    run_size lines in total, which are written to temporary files. The runs of a graph and the
+    lines of its current file are then merged into the new, sorted and duplicate free graph file,
+    which is added to the repository from disk. So the memory used only depends on run_size.
+    """
+
+    def __init__(self, quit, run_size=500000):
+        self.quit = quit
+        self.run_size = run_size
+
+    def run(self, stream, branch, graph=None, message=None):
+        """Import statements into a branch.
+
+        Args:
+            stream: A binary file-like object of UTF-8 encoded N-Triples or N-Quads
+            branch: The branch to commit to, it is created if the repository is empty
+            graph: The graph IRI of triples and of quads without a graph label
+            message: The commit message
+        Returns:
+            A tuple of the commit id and the number of statements read
+        Raises:
+            BulkImportError if a statement is invalid, no graph is given for a triple or the
+                branch is no local branch
+            RevisionNotFound if the branch does not exist
+        """
+        return self.write(parse_statements(stream, graph), branch, message)
+
+    def write(self, statements, branch, message=None, replace=()):
+        """Write (s, p, o, graph) tuples into a branch.
+
+        Args:
+            statements: An iterable of (s, p, o, graph) tuples
+            branch: The branch to commit to, it is created if the repository is empty
+            message: The commit message
+            replace: Graph IRIs whose current statements are replaced instead of kept
+        Returns:
+            A tuple of the commit id and the number of statements written, the commit id is the
+            one of the parent if no graph file changed
+        Raises:
+            BulkImportError if the branch is no local branch
+            RevisionNotFound if the branch does not exist
+        """
+        repository = self.quit.repository
+        branch = _branch(self.quit, branch)
+        parent = None if repository.is_empty else repository.revision(branch)
+        replace = set(URIRef(graph) for graph in replace)
+
+        with TemporaryDirectory() as directory:
+            runs, count = self._runs(statements, directory)
+            if not count and not replace:
+                return None, 0
+            for graph in replace:
+                runs.setdefault(graph, [])
+            blobs = self._merge(runs, parent, directory, replace)
+            if self._unchanged(blobs, parent):
+                return parent.id, count
+            oid = self._commit(blobs, parent, branch, message)
+
+        logger.info("Imported {} statements into {} with commit {}".format(count, branch, oid))
+        return oid, count
+
+    def _unchanged(self, blobs, parent):
+        """Check whether every graph file of the parent commit is the same as its new blob."""
+        if parent is None:
+            return False
+        files = dict((name, oid) for name, oid, filemode in parent.files())
+        graphconfig = self.quit.getGraphConfig(parent.id)
+        return all(files.get(graphconfig.getfileforgraphuri(graph)) == oid
+                   for graph, oid in blobs.items())
+
+    def _runs(self, statements, directory):
+        """Read the statements and return a dict of graphs to lists of sorted runs."""
+        runs = {}
+        buffers = {}
+        buffered = 0
+        count = 0
+
+        for s, p, o, graph in statements:
+            buffers.setdefault(graph, []).append(_nt((s, p, o)).rstrip())
+            buffered += 1
+            count += 1
+
+            if buffered >= self.run_size:
+                self._spill(buffers, runs, directory)
+                buffered = 0
+
+        for graph, lines in buffers.items():
+            lines.sort()
+            runs.setdefault(graph, []).append(lines)
+
+        return runs, count
+
+    def _spill(self, buffers, runs, directory):
+        """Write the buffered lines of every graph to a sorted run file."""
+        for graph, lines in buffers.items():
+            lines.sort()
+            fd, path = mkstemp(dir=directory)
+            with open(fd, 'w', encoding='utf-8') as f:
+                f.writelines(line + '\n' for line in lines)
+            runs.setdefault(graph, []).append(path)
+        buffers.clear()
+
+    def _merge(self, runs, parent, directory, replace=()):
+        """Merge the runs of every graph with its file and return a dict of graphs to blob ids.
+
+        The file of a graph in replace is not merged, its new content are the runs only.
+        """
+        repository = self.quit.repository
+        files = dict((name, oid) for name, oid, filemode in parent.files()) if parent else {}
+        graphconfig = self.quit.getGraphConfig(parent.id if parent else None)
+
+        blobs = {}
+        for graph, graphRuns in runs.items():
+            sources = [self._lines(run) for run in graphRuns]
+
+            name = graphconfig.getfileforgraphuri(graph)
+            if name in files and graph not in replace:
+                sources.append(self._fileLines(files[name]))
+
+            fd, path = mkstemp(dir=directory)
+            with open(fd, 'w', encoding='utf-8') as f:
+                previous = None
+                for line in heapq.merge(*sources):
+                    if line != previous:
+                        f.write(line + '\n')
+                        previous = line
+            blobs[graph] = repository._repository.create_blob_fromdisk(path)
+        return blobs
+
+    def _fileLines(self, oid):
+        """Return the sorted lines of a graph file.
+
+        Files written by QuitStore are sorted already, so they are streamed as one more run. Only
+        other files are sorted in memory.
+        """
+        previous = ''
+        for line in self._blobLines(oid):
+            if line < previous:
+                return sorted(self._blobLines(oid))
+            previous = line
+        return self._blobLines(oid)
+
+    def _blobLines(self, oid):
+        for line in io.BytesIO(self.quit.repository._repository[oid].data):
+            line = ' '.join(line.decode('utf-8').split())
+            if line:
+                yield line
+
+    def _lines(self, run):
+        if isinstance(run, list):
+            yield from run
+            return
+        with open(run, encoding='utf-8') as f:
+            for line in f:
+                yield line.rstrip('\n')
+
+    def _commit(self, blobs, parent, branch, message):
+        quit = self.quit
+        repository = quit.repository
+        graphconfig = quit.getGraphConfig(parent.id if parent else None)
+        new_config = graphconfig.copy()
+        known_files = list(graphconfig.getfiles().keys())
+
+        index = repository.index(parent.id if parent else None)
+        for graph, oid in blobs.items():
+            name = graphconfig.getfileforgraphuri(graph)
+            if name is None:
+                name = quit.newFileName(graph, known_files)
+                known_files.append(name)
+                new_config.addgraph(graph, name, 'nt')
+                if graphconfig.mode == 'graphfiles':
+                    index.add(name + '.graph', str(graph) + "\n")
+            index.add_blob(name, oid)
+        if graphconfig.mode == 'configuration' and len(new_config.getgraphs()) > len(
+                graphconfig.getgraphs()):
+            index.add('config.ttl', new_config.graphconf.serialize(format='turtle'))
+
+        return _commit(quit, index, message or 'Bulk import from QuitStore', branch)
+
+
+def _branch(quit, branch):
+    """Return the name of the local branch to write to, HEAD is resolved to its branch.
+
+    Raises:
+        BulkImportError if the revision is no local branch
+        RevisionNotFound if there is no such revision
+    """
+    repository = quit.repository
+    if branch == 'HEAD':
+        branch = repository.current_head or quit.getDefaultBranch()
+    if repository.is_empty or repository.branch_head(branch) is not None:
+        return branch
+    repository.revision(branch)
+    raise BulkImportError('Statements can only be written to a local branch, not {}'.format(
+        branch))
+
+
+def _commit(quit, index, message, branch):
+    """Commit an index to a branch, load the new commit into the store and return its id."""
+    repository = quit.repository
+    author = repository._repository.default_signature
+    oid = index.commit(message, author.name, author.email, ref='refs/heads/{}'.format(branch))
+
+    if quit.config.hasFeature(Feature.GarbageCollection):
+        quit.garbagecollection()
+
+    quit.syncSingle(repository.revision(oid.hex))
+    quit.updateTip(branch)
+    return oid.hex
+
+
+class BulkExport(object):
+    """Export the statements of a commit as N-Quads or TriG.
+
+    The graph files are N-Triples, so their lines are copied from the blobs and only the graph
+    label is added. Only lines with blank nodes are parsed, their labels are prefixed with the
+    position of the file, since the same label in two files denotes two nodes, even if the files
+    have the same content. Lines which are not terminated
+    by a dot are parsed as well and skipped if they are invalid. The output is produced in chunks
+    of about chunk_size bytes while the files are read one after another.
+    """
+
+    formats = ['nquads', 'trig']
+
+    def __init__(self, quit, chunk_size=65536):
+        self.quit = quit
+        self.chunk_size = chunk_size
+
+    def run(self, commit, format='nquads'):
+        """Return a generator of UTF-8 encoded chunks of the statements of a commit.
+
+        Raises:
+            ValueError if the format is not supported
+        """
+        if format not in self.formats:
+            raise ValueError('Unknown export format: {}'.format(format))
+        return self._chunks(self._lines(commit, format))
+
+    def _lines(self, commit, format):
+        repository = self.quit.repository._repository
+        graphconfig = self.quit.getGraphConfig(commit.id)
+
+        for position, (name, oid) in enumerate(sorted(self.quit.getFilesForCommit(commit))):
+            label = URIRef(graphconfig.getgraphuriforfile(name)).n3().encode('utf-8')
+            if format == 'trig':
+                yield label + b' {\n'
+
+            # blank nodes of different files are different nodes, so their labels are scoped
+            parser = StatementParser(bnode_context=_ScopedLabels('f{}_'.format(position)))
+            for line in io.BytesIO(repository[oid].data):
+                line = line.strip()
+                if not line or line.startswith(b'#'):
+                    continue
+                if b'_:' in line or not line.endswith(b'.'):
+                    line = self._rewrite(parser, name, line)
+                    if line is None:
+                        continue
+                if format == 'trig':
+                    yield line + b'\n'
+                else:
+                    yield line[:-1].rstrip() + b' ' + label + b' .\n'
+
+            if format == 'trig':
+                yield b'}\n'
+
+    def _rewrite(self, parser, name, line):
+        """Serialize a line again with the scoped blank node labels, None if it is invalid."""
+        try:
+            s, p, o, graph = parser.statement(line.decode('utf-8'))
+        except ParserError as e:
+            logger.warning('Skipping invalid line of {} in export: {}'.format(name, e))
+            return None
+        return _nt((s, p, o)).rstrip().encode('utf-8')
+
+    def _chunks(self, lines):
+        chunk = []
+        size = 0
+        for line in lines:
+            chunk.append(line)
+            size += len(line)
+            if size >= self.chunk_size:
+                yield b''.join(chunk)
+                chunk = []
+                size = 0
+        if chunk:
+            yield b''.join(chunk)
+
+
+class GraphStore(object):
+    """Read and write single graphs like the SPARQL 1.1 Graph Store HTTP Protocol.
+
+    Every graph is stored in one N-Triples file, so the operations work on the files without the
+    SPARQL engine: reading a graph returns its blob, PUT and POST write the new file of the graph
+    with BulkImport and DELETE removes the file. Every change is a single commit.
+    """
+
+    def __init__(self, quit, chunk_size=65536):
+        self.quit = quit
+        self.chunk_size = chunk_size
+
+    def get(self, commit, graph):
+        """Return a generator of the chunks of the graph file or None if there is no such graph."""
+        graphconfig = self.quit.getGraphConfig(commit.id)
+        name = graphconfig.getfileforgraphuri(graph)
+        files = dict((path, oid) for path, oid, filemode in commit.files())
+        if name not in files:
+            return None
+
+        return self._chunks(files[name])
+
+    def _chunks(self, oid):
+        # the blob is read when the response is streamed, chunks are copied from its buffer
+        data = memoryview(self.quit.repository._repository[oid])
+        for i in range(0, len(data), self.chunk_size):
+            yield bytes(data[i:i + self.chunk_size])
+
+    def exists(self, branch, graph):
+        """Return whether a branch has a file for the graph."""
+        repository = self.quit.repository
+        if repository.is_empty:
+            return False
+        commit = repository.revision(branch)
+        return self.quit.getGraphConfig(commit.id).getfileforgraphuri(graph) is not None
+
+    def put(self, statements, branch, graph, message=None):
+        """Replace the statements of a graph and return the id of the new commit.
+
+        Nothing is committed if the graph does not change, the id of the parent is returned then.
+
+        Args:
+            statements: An iterable of (s, p, o, graph) tuples of the graph
+        Raises:
+            BulkImportError if a statement belongs to another graph
+            RevisionNotFound if the branch does not exist
+        """
+        oid, count = BulkImport(self.quit).write(
+            self._only(statements, graph), branch, message or 'Replace graph {}'.format(graph),
+            replace=[graph])
+        return oid
+
+    def post(self, statements, branch, graph, message=None):
+        """Add statements to a graph and return the id of the new commit or None if empty."""
+        oid, count = BulkImport(self.quit).write(
+            self._only(statements, graph), branch, message or 'Add to graph {}'.format(graph))
+        return oid
+
+    def delete(self, branch, graph, message=None):
+        """Remove the file of a graph and return the id of the new commit or None if unknown.
+
+        Raises:
+            BulkImportError if the branch is no local branch
+            RevisionNotFound if the branch does not exist
+        """
+        quit = self.quit
+        repository = quit.repository
+        if repository.is_empty:
+            return None
+        branch = _branch(quit, branch)
+        parent = repository.revision(branch)
+        graphconfig = quit.getGraphConfig(parent.id)
+        name = graphconfig.getfileforgraphuri(graph)
+        if name is None:
+            return None
+
+        index = repository.index(parent.id)
+        index.remove(name)
+        if graphconfig.mode == 'graphfiles':
+            index.remove(name + '.graph')
+        elif graphconfig.mode == 'configuration':
+            new_config = graphconfig.copy()
+            new_config.removegraph(graph)
+            index.add('config.ttl', new_config.graphconf.serialize(format='turtle'))
+
+        return _commit(quit, index, message or 'Delete graph {}'.format(graph), branch)
+
+    def _only(self, statements, graph):
+        graph = URIRef(graph)
+        for s, p, o, context in statements:
+            if context != graph:
+                raise BulkImportError('The statement {} is not in the graph {}'.format(
+                    _nt((s, p, o)).strip(), graph))
+            yield s, p, o, context
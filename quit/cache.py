@@ -1,6 +1,16 @@
+import re
+
+from bisect import bisect_left
 from collections import OrderedDict
+from heapq import merge
+from itertools import chain, groupby, islice
+from operator import lt
 from sortedcontainers import SortedSet
 
+# whitespace besides single spaces between the terms and newlines at the line ends
+_irregular = (b'\t', b'\r', b'\x0b', b'\x0c', b'  ', b' \n', b'\n ', b'\n\n')
+_newline = re.compile(b'\n')
+
 
 class Cache:
 
@@ -94,3 +104,158 @@ class FileReference:
             self._content.remove(data)
         except KeyError:
             pass
+
+    def update(self, lines):
+        """Add a batch of lines to the file content.
+
+        Large batches are merged with the content at once instead of inserting line by line.
+        """
+        self._content.update(lines)
+
+    def difference_update(self, lines):
+        """Remove a batch of lines from the file content, lines not in the file are ignored."""
+        self._content.difference_update(lines)
+
+
+class CompactFileReference:
+    """A FileReference which keeps the lines of an n-triple file as bytes.
+
+    The sorted and distinct lines are stored in chunks of at most chunk_size lines. Each chunk is
+    one bytes object of newline terminated lines, so a file needs a few objects per thousand
+    lines instead of one str object per line. The chunk of a line is found by binary search over
+    the last lines of the chunks. Added and removed lines are collected and merged with the
+    chunks they belong to when the content is read, so only these chunks are copied.
+    """
+
+    def __init__(self, path, content, chunk_size=1024):
+        """Initialize a new CompactFileReference instance.
+
+        Args:
+            path: A string of the filepath.
+            content: The content of the file as str or UTF-8 encoded bytes.
+            chunk_size: The number of lines per chunk.
+        """
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+
+        self._path = path
+        self._chunk_size = chunk_size
+        self._chunks = []
+        self._maxes = []
+        self._added = set()
+        self._removed = set()
+        if not self._load(content):
+            lines = sorted(set(b' '.join(line.split()) for line in content.splitlines()))
+            if lines and not lines[0]:
+                lines.pop(0)
+            self._replace(0, 0, lines)
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def content(self):
+        """Get the content of the file as UTF-8 encoded bytes."""
+        self._apply()
+        return b''.join(self._chunks) or b'\n'
+
+    def __contains__(self, line):
+        self._apply()
+        line = line.encode('utf-8') if isinstance(line, str) else line
+        index = bisect_left(self._maxes, line)
+        if index == len(self._chunks):
+            return False
+        chunk = self._chunks[index]
+        return chunk.startswith(line + b'\n') or b'\n' + line + b'\n' in chunk
+
+    def __len__(self):
+        self._apply()
+        return sum(chunk.count(b'\n') for chunk in self._chunks)
+
+    def add(self, data):
+        """Add a triple to the file content."""
+        self.update([data])
+
+    def extend(self, data):
+        """Add triples to the file content."""
+        self.update(data)
+
+    def remove(self, data):
+        """Remove trple from the file content."""
+        self.difference_update([data])
+
+    def update(self, lines):
+        """Add a batch of lines to the file content."""
+        lines = set(line.encode('utf-8') for line in lines)
+        self._removed.difference_update(lines)
+        self._added.update(lines)
+
+    def difference_update(self, lines):
+        """Remove a batch of lines from the file content, lines not in the file are ignored."""
+        lines = set(line.encode('utf-8') for line in lines)
+        self._added.difference_update(lines)
+        self._removed.update(lines)
+
+    def _apply(self):
+        """Merge the added and removed lines with the chunks they belong to."""
+        if not self._added and not self._removed:
+            return
+
+        changes = {}
+        last = max(len(self._chunks) - 1, 0)
+        for line in self._added:
+            index = min(bisect_left(self._maxes, line), last)
+            changes.setdefault(index, ([], set()))[0].append(line)
+        for line in self._removed:
+            index = bisect_left(self._maxes, line)
+            if index < len(self._chunks):
+                changes.setdefault(index, ([], set()))[1].add(line)
+        self._added = set()
+        self._removed = set()
+
+        # replace the chunks from the last one, so the indexes of the others stay valid
+        for index in sorted(changes, reverse=True):
+            added, removed = changes[index]
+            lines = self._chunks[index].split(b'\n')[:-1] if self._chunks else []
+            if removed:
+                lines = [line for line in lines if line not in removed]
+            if added:
+                lines = [line for line, _ in groupby(merge(lines, sorted(added)))]
+            self._replace(index, 1 if self._chunks else 0, lines)
+
+    def _load(self, content):
+        """Cut canonical content into chunks, return False if the content is not canonical.
+
+        The chunks are cut at every chunk_size-th newline of the content, only the lines of one
+        chunk at a time are split to check that they are sorted.
+        """
+        if not content.endswith(b'\n') or content[:1].isspace():
+            return False
+        if any(ws in content for ws in _irregular):
+            return False
+
+        size = self._chunk_size
+        ends = (match.end() for match in islice(_newline.finditer(content), size - 1, None, size))
+        chunks, maxes, start = [], [], 0
+        for end in chain(ends, [len(content)]):
+            if end == start:
+                continue
+            chunk = content[start:end]
+            lines = chunk[:-1].split(b'\n')
+            if maxes and not maxes[-1] < lines[0]:
+                return False
+            if not all(map(lt, lines, islice(lines, 1, None))):
+                return False
+            chunks.append(chunk)
+            maxes.append(lines[-1])
+            start = end
+        self._chunks, self._maxes = chunks, maxes
+        return True
+
+    def _replace(self, index, count, lines):
+        """Replace count chunks at index with chunks of the sorted lines."""
+        size = self._chunk_size
+        pieces = [lines[i:i + size] for i in range(0, len(lines), size)]
+        self._chunks[index:index + count] = [b'\n'.join(piece) + b'\n' for piece in pieces]
+        self._maxes[index:index + count] = [piece[-1] for piece in pieces]
@@ -1,7 +1,7 @@
 import logging
 
 from pygit2 import GIT_OBJ_BLOB, GIT_OBJ_TREE
-from os.path import join, isfile
+from os.path import basename, join, isfile
 from quit.exceptions import InvalidConfigurationError
 from quit.exceptions import UnknownConfigurationError
 from quit.helpers import isAbsoluteUri
@@ -21,7 +21,8 @@ class Feature:
     Provenance = 1 << 0
     Persistence = 1 << 1
     GarbageCollection = 1 << 2
-    All = Provenance | Persistence | GarbageCollection
+    CompactFiles = 1 << 3
+    All = Provenance | Persistence | GarbageCollection | CompactFiles
 
 
 class QuitStoreConfiguration():
@@ -180,6 +181,52 @@ class QuitGraphConfiguration():
         self.graphs = {}
         self.files = {}
 
+    @staticmethod
+    def signature(files):
+        """Get the key of the graph configuration of a revision.
+
+        The configuration only depends on the config.ttl and *.graph blobs and on the names of the
+        N-Triples files, so revisions with the same signature share the same configuration.
+
+        Args
+        ----
+            files: An iterable of (path, oid, filemode) tuples of all blobs of the revision
+
+        Returns
+        -------
+            A hashable signature
+
+        """
+        config_files = []
+        graph_files = []
+        rdf_files = []
+
+        for path, oid, filemode in files:
+            name = basename(path)
+            format = guess_format(name)
+            if format is None and name.endswith('.graph'):
+                graph_files.append((path, oid))
+            elif format == 'nt':
+                rdf_files.append(path)
+            elif format is not None and name == 'config.ttl':
+                config_files.append(oid)
+
+        return tuple(sorted(config_files)), frozenset(graph_files), frozenset(rdf_files)
+
+    def copy(self):
+        """Get an independent copy of this configuration which can be modified."""
+        other = QuitGraphConfiguration(self.repository)
+        other.configfile = self.configfile
+        other.mode = self.mode
+        other.graphconf = Graph()
+        for prefix, namespace in self.graphconf.namespaces():
+            other.graphconf.bind(prefix, namespace, override=False)
+        other.graphconf += self.graphconf
+        other.nsMngrGraphconf = other.graphconf.namespace_manager
+        other.graphs = dict(self.graphs)
+        other.files = {file: dict(values) for file, values in self.files.items()}
+        return other
+
     def initgraphconfig(self, rev):
         """Initialize graph settings.
 
@@ -235,32 +282,31 @@ class QuitGraphConfiguration():
             raise InvalidConfigurationError(
                 "Configfile could not be parsed {} {}".format(configfileId, e)
             )
-        nsQuit = 'http://quit.aksw.org/vocab/'
-        query = 'SELECT DISTINCT ?graphuri ?filename ?format WHERE { '
-        query += '  ?graph a <' + nsQuit + 'Graph> . '
-        query += '  ?graph <' + nsQuit + 'graphUri> ?graphuri . '
-        query += '  ?graph <' + nsQuit + 'graphFile> ?filename . '
-        query += '  OPTIONAL { ?graph <' + nsQuit + 'hasFormat> ?format .} '
-        query += '}'
-        result = self.graphconf.query(query)
-
-        for row in result:
-            filename = str(row['filename'])
-            if row['format'] is None:
+
+        for filename, graphuri, format in self.__graph_entries():
+            if format is None:
                 format = guess_format(filename)
-            else:
-                format = str(row['format'])
             if format != 'nt':
-                break
+                continue
             if filename not in known_blobs.keys():
-                break
-
-            graphuri = URIRef(str(row['graphuri']))
+                continue
 
             # we store which named graph is serialized in which file
             self.graphs[graphuri] = filename
-            self.files[filename] = {
-                'serialization': format, 'graph': graphuri, 'oid': known_blobs[filename]}
+            self.files[filename] = {'serialization': format, 'graph': graphuri, 'oid': filename}
+
+    def __graph_entries(self):
+        """Yield (filename, graphuri, format) for the quit:Graph resources of the config file.
+
+        The format is None if the graph has no quit:hasFormat.
+        """
+        conf = self.graphconf
+        for graph in conf.subjects(RDF.type, self.quit.Graph, unique=True):
+            formats = [str(format) for format in conf.objects(graph, self.quit.hasFormat)]
+            for graphuri in conf.objects(graph, self.quit.graphUri):
+                for filename in conf.objects(graph, self.quit.graphFile):
+                    for format in formats or [None]:
+                        yield str(filename), URIRef(str(graphuri)), format
 
     def __get_uri_from_graphfile_blob(self, oid):
         """Search for a graph uri in graph file and return it.
@@ -2,17 +2,16 @@ import pygit2
 
 import logging
 
-from copy import copy
-
 from rdflib import Graph, ConjunctiveGraph, BNode, Literal, URIRef
 import re
 
 from quit.conf import Feature, QuitGraphConfiguration
 from quit.helpers import applyChangeset
 from quit.namespace import RDFS, FOAF, XSD, PROV, QUIT, is_a
+from quit.provenance import BlameIndex
 from quit.graphs import RewriteGraph, InMemoryAggregatedGraph
 from quit.utils import graphdiff, git_timestamp, iri_to_name
-from quit.cache import Cache, FileReference
+from quit.cache import Cache, CompactFileReference, FileReference
 
 import subprocess
 
@@ -97,6 +96,9 @@ class Quit(object):
         self._commits = Cache()
         self._blobs = Cache()
         self._graphconfigs = Cache()
+        self._graphlayouts = Cache()
+        self._tips = {}
+        self.blameIndex = BlameIndex()
 
     def _exists(self, cid):
         uri = QUIT['commit-' + cid]
@@ -161,12 +163,17 @@ class Quit(object):
 
         for name in self.repository.tags_or_branches:
             initial_commit = self.repository.revision(name)
+            self.repository.commit_graph.ensure(initial_commit.id)
+            self.repository.path_index.ensure(initial_commit.id)
             commits = traverse(initial_commit, seen)
 
             while commits:
                 commit = commits.pop()
                 self.syncSingle(commit)
 
+            if name.startswith('refs/heads/'):
+                self.updateTip(name[len('refs/heads/'):])
+
     def syncSingle(self, commit):
         if not self._exists(commit.id):
             self.changeset(commit)
@@ -174,12 +181,23 @@ class Quit(object):
     def instance(self, reference, force=False):
         """Create and return dataset for a given commit id.
 
+        The dataset of the head of a branch is kept until the branch is moved, so reading from
+        a branch again only needs to look up the reference of the branch.
+
         Args:
             reference: commit id or reference of the commit to retrieve
             force: force to get the dataset from the git repository instead of the internal cache
         Returns:
             Instance of VirtualGraph representing the respective dataset
         """
+        if reference and not force:
+            head = self.repository.branch_head(reference)
+            tip = self._tips.get(reference, None)
+            if tip is not None and tip[1] == head:
+                return tip
+            if head is None:
+                self._tips.pop(reference, None)
+
         default_graphs = []
         commitid = None
 
@@ -190,7 +208,7 @@ class Quit(object):
             for blob in self.getFilesForCommit(commit):
                 try:
                     (name, oid) = blob
-                    (f, context) = self.getFileReferenceAndContext(blob, commit)
+                    context = self.getContext(blob, commit)
                     internal_identifier = context.identifier + '-' + str(oid)
 
                     if force or not self.config.hasFeature(Feature.Persistence):
@@ -208,7 +226,35 @@ class Quit(object):
         instance = InMemoryAggregatedGraph(
             graphs=default_graphs, identifier='default')
 
-        return VirtualGraph(instance), commitid
+        tip = VirtualGraph(instance), commitid
+        if reference and not force and commitid == head:
+            self._tips[reference] = tip
+        return tip
+
+    def updateTip(self, branch):
+        """Replace the cached dataset of a branch, if any, with the one of its new head.
+
+        Writers change the graphs of the dataset they got from instance in place, so readers of
+        the branch see the changes of an update before it is committed.
+        """
+        if branch in self._tips:
+            self.instance(branch)
+
+    def discardChanges(self, commitid):
+        """Drop the datasets and parsed graphs of a commit which were changed by a failed write.
+
+        Writers change the dataset of a commit in place. If the write does not end in a new
+        commit, the dataset no longer matches the commit and is read from the repository again.
+        """
+        self._dropTips(commitid)
+        if commitid:
+            for blob in self.getFilesForCommit(self.repository.revision(commitid)):
+                self._blobs.remove(blob)
+
+    def _dropTips(self, commitid, keep=None):
+        for branch, (_, tipid) in list(self._tips.items()):
+            if tipid == commitid and branch != keep:
+                self._tips.pop(branch, None)
 
     def changeset(self, commit):
 
@@ -309,71 +355,64 @@ class Quit(object):
                 update_uri = QUIT['update-{}-{}'.format(commit.id, index)]
                 g.add((update_uri, QUIT['graph'], iri))
                 g.add((commit_uri, QUIT['updates'], update_uri))
-                for (op, triples) in changesets:
+                for i, (op, triples) in enumerate(changesets):
+                    triples = list(triples)
+                    changesets[i] = (op, triples)
                     op_uri = QUIT[op + '-' + commit.id]
                     g.add((update_uri, QUIT[op], op_uri))
                     g.addN((s, p, o, op_uri) for s, p, o in triples)
 
+            self.blameIndex.add(commit.id, [parent.id for parent in commit.parents or []], delta)
+
         # Entities
         if commit.id not in self._graphconfigs:
             self.updateGraphConfig(commit.id)
 
-        map = self._graphconfigs.get(commit.id).getgraphurifilemap()
+        files = set(self._graphconfigs.get(commit.id).getgraphurifilemap().values())
 
-        for entity in commit.node().entries(recursive=True):
+        for name, oid, filemode in commit.files():
             # todo check if file was changed
-            if entity.is_file:
+            if name not in files:
+                continue
 
-                if entity.name not in map.values():
-                    continue
+            graphUri = URIRef(self._graphconfigs.get(commit.id).getgraphuriforfile(name))
+            blob = (name, oid)
 
-                graphUri = self._graphconfigs.get(commit.id).getgraphuriforfile(entity.name)
-                blob = (entity.name, entity.oid)
+            private_uri = QUIT["graph-{}".format(oid)]
 
-                try:
-                    f, context = self.getFileReferenceAndContext(blob, commit)
-                except KeyError:
-                    graph = Graph(identifier=graphUri)
-                    graph.parse(data=entity.content, format='nt')
-
-                    self._blobs.set(
-                        blob, (FileReference(entity.name, entity.content), graph)
-                    )
-
-                private_uri = QUIT["graph-{}".format(entity.oid)]
-
-                if (
-                    self.config.hasFeature(Feature.Provenance) or
-                    self.config.hasFeature(Feature.Persistence)
-                ):
-                    g.add((private_uri, is_a, PROV['Entity']))
-                    g.add(
-                        (private_uri, PROV['specializationOf'], context.identifier))
-                    g.add(
-                        (private_uri, PROV['wasGeneratedBy'], commit_uri))
-                    g.add((private_uri, PROV['generatedAtTime'], Literal(
-                        git_timestamp(commit.author.time, commit.author.offset),
-                        datatype=XSD.dateTime)))
-
-                    q_usage = BNode()
-                    g.add((private_uri, PROV['qualifiedGeneration'], q_usage))
-                    g.add((q_usage, is_a, PROV['Generation']))
-                    g.add((q_usage, PROV['activity'], commit_uri))
-
-                    prev = next(entity.history(), None)
-                    if prev:
-                        prev_uri = QUIT["graph-{}-{}".format(prev.oid, index)]
-                        g.add((private_uri, PROV['wasDerivedFrom'], prev_uri))
-                        g.add((commit_uri, PROV['used'], prev_uri))
-
-                        q_derivation = BNode()
-                        g.add((private_uri, PROV['qualifiedDerivation'], q_derivation))
-                        g.add((q_derivation, is_a, PROV['Derivation']))
-                        g.add((q_derivation, PROV['entity'], prev_uri))
-                        g.add((q_derivation, PROV['hadActivity'], commit_uri))
-                if self.config.hasFeature(Feature.Persistence):
-                    g.addN((s, p, o, private_uri) for s, p, o
-                           in context.triples((None, None, None)))
+            if (
+                self.config.hasFeature(Feature.Provenance) or
+                self.config.hasFeature(Feature.Persistence)
+            ):
+                g.add((private_uri, is_a, PROV['Entity']))
+                g.add(
+                    (private_uri, PROV['specializationOf'], graphUri))
+                g.add(
+                    (private_uri, PROV['wasGeneratedBy'], commit_uri))
+                g.add((private_uri, PROV['generatedAtTime'], Literal(
+                    git_timestamp(commit.author.time, commit.author.offset),
+                    datatype=XSD.dateTime)))
+
+                q_usage = BNode()
+                g.add((private_uri, PROV['qualifiedGeneration'], q_usage))
+                g.add((q_usage, is_a, PROV['Generation']))
+                g.add((q_usage, PROV['activity'], commit_uri))
+
+                prev = self.repository.path_index.previous(commit.id, name)
+                if prev:
+                    prev_uri = QUIT["graph-{}".format(prev[1])]
+                    g.add((private_uri, PROV['wasDerivedFrom'], prev_uri))
+                    g.add((commit_uri, PROV['used'], prev_uri))
+
+                    q_derivation = BNode()
+                    g.add((private_uri, PROV['qualifiedDerivation'], q_derivation))
+                    g.add((q_derivation, is_a, PROV['Derivation']))
+                    g.add((q_derivation, PROV['entity'], prev_uri))
+                    g.add((q_derivation, PROV['hadActivity'], commit_uri))
+            if self.config.hasFeature(Feature.Persistence):
+                context = self.getContext(blob, commit)
+                g.addN((s, p, o, private_uri) for s, p, o
+                       in context.triples((None, None, None)))
 
     def getFilesForCommit(self, commit):
         """Get all entry, oid tupples for a commit.
@@ -388,49 +427,84 @@ class Quit(object):
             if commit.id not in self._graphconfigs:
                 self.updateGraphConfig(commit.id)
 
-            uriFileMap = self._graphconfigs.get(commit.id).getgraphurifilemap()
-            blobs = set()
-
-            for entity in commit.node().entries(recursive=True):
-                if entity.is_file:
-                    if entity.name not in uriFileMap.values():
-                        continue
-                    blob = (entity.name, entity.oid)
-                    blobs.add(blob)
+            files = set(self._graphconfigs.get(commit.id).getgraphurifilemap().values())
+            blobs = set((name, oid) for name, oid, filemode in commit.files() if name in files)
             self._commits.set(commit.id, blobs)
             return blobs
         return self._commits.get(commit.id)
 
+    def getGraphConfig(self, commitId):
+        """Get the graph configuration of a commit.
+
+        On Cache miss this method also updates the graph configuration cache.
+        """
+        if commitId not in self._graphconfigs:
+            self.updateGraphConfig(commitId)
+        return self._graphconfigs.get(commitId)
+
+    def newFileReference(self, name, content):
+        """Create the FileReference of a graph file, a compact one if the feature is enabled.
+
+        The content is given as str or as the UTF-8 encoded bytes of the blob, which are kept
+        as they are by a CompactFileReference.
+        """
+        if self.config.hasFeature(Feature.CompactFiles):
+            return CompactFileReference(name, content)
+        if isinstance(content, bytes):
+            content = content.decode('utf-8')
+        return FileReference(name, content)
+
     def getFileReferenceAndContext(self, blob, commit):
         """Get the FileReference and Context for a given blob (name, oid) of a commit.
 
         On Cache miss this method also updates teh commits cache.
         """
+        return self.getFileReference(blob, commit), self.getContext(blob, commit)
+
+    def getFileReference(self, blob, commit):
+        """Get the FileReference for a given blob (name, oid) of a commit.
+
+        The graph of the blob is not parsed for this, it is parsed when its Context is requested.
+        """
+        fileReference, context = self._blobs.get(blob) if blob in self._blobs else (None, None)
+        if fileReference is None:
+            (name, oid) = blob
+            fileReference = self.newFileReference(name, commit.node(path=name).blob.data)
+            self._blobs.set(blob, (fileReference, context))
+        return fileReference
+
+    def getContext(self, blob, commit):
+        """Get the Context for a given blob (name, oid) of a commit.
+
+        The FileReference of the blob is not created for this. On Cache miss this method also
+        updates the commits cache.
+        """
         if commit.id not in self._graphconfigs:
             self.updateGraphConfig(commit.id)
 
-        if blob not in self._blobs:
+        fileReference, context = self._blobs.get(blob) if blob in self._blobs else (None, None)
+        if context is None:
             (name, oid) = blob
-            content = commit.node(path=name).content
             graphUri = self._graphconfigs.get(commit.id).getgraphuriforfile(name)
-            graph = Graph(identifier=URIRef(graphUri))
-            graph.parse(data=content, format='nt')
-            quitWorkingData = (FileReference(name, content), graph)
-            self._blobs.set(blob, quitWorkingData)
-            return quitWorkingData
-        return self._blobs.get(blob)
+            context = Graph(identifier=URIRef(graphUri))
+            context.parse(data=commit.node(path=name).content, format='nt')
+            self._blobs.set(blob, (fileReference, context))
+        return context
 
     def applyQueryOnCommit(self, parsedQuery, parent_commit_ref, target_ref, query=None,
                            default_graph=[], named_graph=[]):
         """Apply an update query on the graph and the git repository."""
         graph, commitid = self.instance(parent_commit_ref)
-        resultingChanges, exception = graph.update(parsedQuery)
-        if exception:
-            # TODO need to revert or invalidate the graph at this point.
-            pass
-        oid = self.commit(graph, resultingChanges, 'New Commit from QuitStore', parent_commit_ref,
-                          target_ref, query=query, default_graph=default_graph,
-                          named_graph=named_graph)
+        try:
+            resultingChanges, exception = graph.update(parsedQuery)
+            oid = self.commit(graph, resultingChanges, 'New Commit from QuitStore',
+                              parent_commit_ref, target_ref, query=query,
+                              default_graph=default_graph, named_graph=named_graph)
+        except Exception:
+            self.discardChanges(commitid)
+            raise
+        if oid is None:
+            self.discardChanges(commitid)
         if exception:
             raise exception
         return oid
@@ -482,7 +556,7 @@ class Quit(object):
 
         blobs_new = self._applyKnownGraphs(delta, blobs, parent_commit, index)
         new_contexts = self._applyUnknownGraphs(delta, known_files)
-        new_config = copy(graphconfig)
+        new_config = graphconfig.copy()
 
         for identifier, fileReference in new_contexts.items():
             # Add new blobs to repo
@@ -512,6 +586,11 @@ class Quit(object):
             self._commits.set(oid.hex, blobs_new)
             commit = self.repository.revision(oid.hex)
             self.syncSingle(commit)
+            # the graphs of the parent commit now belong to the new commit, so the datasets of
+            # other branches at the parent commit are read from the repository again
+            branch = re.sub('^refs/heads/', '', target_ref)
+            self._dropTips(parent_commit_id, keep=branch)
+            self.updateTip(branch)
 
         return oid.hex
 
@@ -546,18 +625,25 @@ class Quit(object):
         blobs_new = set()
         for blob in blobs:
             (fileName, oid) = blob
+            graphconfig = self.getGraphConfig(parent_commit.id)
             try:
-                file_reference, context = self.getFileReferenceAndContext(blob, parent_commit)
+                identifier = URIRef(graphconfig.getgraphuriforfile(fileName))
+                file_reference = self.getFileReference(blob, parent_commit)
                 for entry in delta:
-                    changeset = entry['delta'].get(context.identifier, None)
+                    changeset = entry['delta'].get(identifier, None)
 
                     if changeset:
-                        applyChangeset(file_reference, changeset, context.identifier)
-                        del entry['delta'][context.identifier]
+                        applyChangeset(file_reference, changeset, identifier)
+                        del entry['delta'][identifier]
 
                 index.add(file_reference.path, file_reference.content)
 
-                self._blobs.remove(blob)
+                # a parsed graph was changed by the update and is kept for the new blob, otherwise
+                # it is parsed when it is read. With persistence the update changed the store
+                # instead, so the parsed graph is outdated.
+                context = (self._blobs.remove(blob) or (None, None))[1]
+                if self.config.hasFeature(Feature.Persistence):
+                    context = None
                 blob = fileName, index.stash[file_reference.path][0]
                 self._blobs.set(blob, (file_reference, context))
                 blobs_new.add(blob)
@@ -573,22 +659,26 @@ class Quit(object):
                     continue  # TODO default graph use case
 
                 if identifier not in new_contexts.keys():
-                    fileName = iri_to_name(identifier) + '.nt'
-
-                    if fileName in known_blobs:
-                        reg = re.compile(re.escape(iri_to_name(identifier)) + "_([0-9]+).nt")
-                        #  n ~ numbers (in blobname), b ~ blobname, m ~ match
-                        n = [
-                            int(m.group(1)) for b in known_blobs for m in [reg.search(b)] if m
-                        ] + [0]
-                        fileName = '{}_{}.nt'.format(iri_to_name(identifier), max(n) + 1)
-
-                    new_contexts[identifier] = FileReference(fileName, '')
+                    fileName = self.newFileName(identifier, known_blobs)
+                    new_contexts[identifier] = self.newFileReference(fileName, '')
 
                 fileReference = new_contexts[identifier]
                 applyChangeset(fileReference, changeset, identifier)
         return new_contexts
 
+    def newFileName(self, identifier, known_blobs):
+        """Get the name of a new file for a graph which does not clash with the known files."""
+        fileName = iri_to_name(identifier) + '.nt'
+
+        if fileName in known_blobs:
+            reg = re.compile(re.escape(iri_to_name(identifier)) + "_([0-9]+).nt")
+            #  n ~ numbers (in blobname), b ~ blobname, m ~ match
+            n = [
+                int(m.group(1)) for b in known_blobs for m in [reg.search(b)] if m
+            ] + [0]
+            fileName = '{}_{}.nt'.format(iri_to_name(identifier), max(n) + 1)
+        return fileName
+
     def _isDeltaEmpty(self, result):
         for entry in result:
             if "delta" in entry and entry["delta"]:
@@ -614,7 +704,18 @@ class Quit(object):
             logger.debug(e)
 
     def updateGraphConfig(self, commitId):
-        """Update the graph configuration for a given commit id."""
-        graphconf = QuitGraphConfiguration(self.repository._repository)
-        graphconf.initgraphconfig(commitId)
+        """Update the graph configuration for a given commit id.
+
+        Commits with the same configuration and graph files share one configuration object, which
+        must not be modified.
+        """
+        files = self.repository.revision(commitId).files() if commitId else ()
+        signature = QuitGraphConfiguration.signature(files)
+
+        try:
+            graphconf = self._graphlayouts.get(signature)
+        except KeyError:
+            graphconf = QuitGraphConfiguration(self.repository._repository)
+            graphconf.initgraphconfig(commitId)
+            self._graphlayouts.set(signature, graphconf)
         self._graphconfigs.set(commitId, graphconf)
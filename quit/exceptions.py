@@ -88,6 +88,27 @@ class SparqlProtocolError(Error):
     pass
 
 
+class QueryTimeout(Error):
+    """
+    Thrown when a query exceeds its time or result budget
+    """
+    pass
+
+
+class BulkImportError(Error):
+    """
+    Thrown when statements to import are invalid
+    """
+    pass
+
+
+class UploadTooLarge(Error):
+    """
+    Thrown when a request body exceeds the upload limit
+    """
+    pass
+
+
 class FromNamedError(Error):
     pass
 
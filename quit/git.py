@@ -2,16 +2,22 @@ import os
 import pygit2
 import re
 import logging
+import threading
 
 from pygit2._pygit2 import GitError
 from os.path import expanduser, join
 from quit.exceptions import RepositoryNotFound, RevisionNotFound, NodeNotFound, RemoteNotFound
 from quit.exceptions import QuitGitRefNotFound, QuitGitRepoError, QuitGitPushError
+from quit.cache import Cache
 from quit.namespace import QUIT
 from quit.merge import Merger
 
 import subprocess
 
+from contextlib import contextmanager
+from functools import wraps
+from heapq import heappush, heappop
+
 logger = logging.getLogger('quit.git')
 
 # roles
@@ -19,6 +25,15 @@ role_author = QUIT['author']
 role_committer = QUIT['committer']
 
 
+def _notifies(method):
+    """Notify the listeners of a repository about the references moved by a method."""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.notifying():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class Repository(object):
     """The Quit class for wrapping a git repository.
 
@@ -43,10 +58,76 @@ class Repository(object):
         self.path = path
         self.callback = callback if callback else QuitRemoteCallbacks()
         self._repository = self.init_repository(path, origin, create)
+        self.commit_graph = CommitGraph(self._repository)
+        self.path_index = PathIndex(self._repository)
+        self._trees = Cache(capacity=256)
+        self._listeners = []
+        self._tracking = threading.local()
+        self._reported = None
+        self._reporting = threading.Lock()
         self.log_repository(self._repository)
         if garbageCollection:
             self.init_garbageCollection(path)
 
+    def subscribe(self, listener):
+        """Call listener(ref, old, new) for every reference which is moved, created or deleted.
+
+        old and new are the ids of the commits the reference pointed to before and after the
+        change, old is None for new references and new is None for deleted references.
+        """
+        self._listeners = self._listeners + [listener]
+
+    def unsubscribe(self, listener):
+        self._listeners = [x for x in self._listeners if x is not listener]
+        if not self._listeners:
+            with self._reporting:
+                self._reported = None
+
+    @contextmanager
+    def notifying(self):
+        """Notify the listeners about the references moved within this context.
+
+        After the context the references are compared with the ones of the last notification,
+        nested contexts in the same thread are part of the outermost one. Only the comparison is
+        locked, not the context, so a reference moved by another thread is reported once, by the
+        context which ends first after the change.
+        """
+        if not self._listeners or getattr(self._tracking, 'active', False):
+            yield
+            return
+
+        self._tracking.active = True
+        with self._reporting:
+            if self._reported is None:
+                self._reported = self._targets()
+        try:
+            yield
+        finally:
+            self._tracking.active = False
+            with self._reporting:
+                if self._reported is not None:
+                    self._notify(self._targets())
+
+    def _notify(self, targets):
+        before, self._reported = self._reported, targets
+        for ref in sorted(set(before) | set(targets)):
+            old, new = before.get(ref, None), targets.get(ref, None)
+            if old != new:
+                for listener in self._listeners:
+                    try:
+                        listener(ref, old, new)
+                    except Exception as e:
+                        logger.exception(e)
+
+    def _targets(self):
+        """Get a dict of all direct references to the ids of their targets."""
+        targets = {}
+        for name in self._repository.listall_references():
+            reference = self._repository.lookup_reference(name)
+            if reference.type == pygit2.GIT_REF_OID:
+                targets[name] = str(reference.target)
+        return targets
+
     def init_repository(self, path, origin, create):
         try:
             repository = pygit2.Repository(path)
@@ -144,6 +225,16 @@ class Repository(object):
             logger.exception(e)
         raise RevisionNotFound(name)
 
+    def branch_head(self, name):
+        """Get the id of the commit a branch points to or None if there is no such branch.
+
+        Only the reference is read, no object of the repository.
+        """
+        try:
+            return str(self._repository.lookup_reference('refs/heads/' + name).target)
+        except (KeyError, ValueError):
+            return None
+
     def revision(self, id='HEAD'):
         try:
             commit = self._repository.revparse_single(id)
@@ -152,30 +243,56 @@ class Repository(object):
 
         return Revision(self, commit)
 
+    def files(self, tree):
+        """Return a tuple of (path, oid, filemode) for all blobs below a tree.
+
+        The listings of trees are cached by their oid, so only the subtrees that changed since an
+        already listed commit are read from the repository.
+        """
+        try:
+            return self._trees.get(tree.id)
+        except KeyError:
+            pass
+
+        files = []
+        for entry in tree:
+            if entry.type == pygit2.GIT_OBJ_BLOB:
+                files.append((entry.name, entry.id, entry.filemode))
+            elif entry.type == pygit2.GIT_OBJ_TREE:
+                prefix = entry.name + '/'
+                files.extend((prefix + path, oid, filemode)
+                             for path, oid, filemode in self.files(self._repository[entry.id]))
+        files = tuple(files)
+        self._trees.set(tree.id, files)
+        return files
+
+    def is_ancestor(self, ancestor, descendant):
+        """Check whether a commit is an ancestor of (or equal to) another commit.
+
+        Keyword arguments:
+        ancestor -- an Oid or hex id of the possible ancestor
+        descendant -- an Oid or hex id of the possible descendant
+        """
+        return self.commit_graph.is_ancestor(ancestor, descendant)
+
+    def merge_base(self, one, two):
+        """Get the Oid of the best common ancestor of two commits or None if there is none."""
+        return self.commit_graph.merge_base(one, two)
+
     def revisions(self, name=None, order=pygit2.GIT_SORT_REVERSE):
+        return list(self.iter_revisions(name, order))
+
+    def iter_revisions(self, name=None, order=pygit2.GIT_SORT_REVERSE):
+        """Lazily iterate the revisions reachable from name or from all branches if omitted."""
         seen = set()
 
-        def traverse(ref, seen):
-            for commit in self._repository.walk(ref, order):
+        for name in [name] if name else self.branches:
+            for commit in self._repository.walk(self.lookup(name), order):
                 oid = commit.oid
                 if oid not in seen:
                     seen.add(oid)
                     yield Revision(self, commit)
 
-        def iter_commits(name, seen):
-            commits = []
-
-            if not name:
-                for name in self.branches:
-                    ref = self.lookup(name)
-                    commits += traverse(ref, seen)
-            else:
-                oid = self.lookup(name)
-                commits += traverse(oid, seen)
-            return commits
-
-        return iter_commits(name, seen)
-
     @property
     def current_head(self):
         if not self._repository.head_is_unborn:
@@ -235,6 +352,7 @@ class Repository(object):
             return (remote_name, remote_branch, remote_ref)
         return (None, None, None)
 
+    @_notifies
     def fetch(self, remote_name=None, remote_branch=None):
         """Fetch changes from a remote.
 
@@ -281,6 +399,7 @@ class Repository(object):
                 return self._repository.lookup_reference(remote_ref).target
         raise RemoteNotFound("There is no remote \"{}\".".format(remote_name))
 
+    @_notifies
     def pull(self, remote_name=None, refspec=None, **kwargs):
         """Pull (fetch and merge) changes from a remote repository.
 
@@ -353,6 +472,7 @@ class Repository(object):
                 return
         raise RemoteNotFound("There is no remote \"{}\".".format(remote_name))
 
+    @_notifies
     def merge(self, target=None, branch=None, method=None):
         """Merge a branch into another (target) branch.
 
@@ -425,6 +545,7 @@ class Repository(object):
 
         raise AssertionError('Unknown merge analysis result')
 
+    @_notifies
     def branch(self, oldbranch=None, newbranch=None):
         """Create a new branch from an existing branch."""
         logger.debug("Branching: {} from {} -> {}".format(newbranch, oldbranch,
@@ -447,11 +568,287 @@ class Repository(object):
             logger.error(e)
             raise e
 
+    @_notifies
+    def delete_branch(self, name):
+        """Delete a branch.
+
+        Returns:
+        True if the branch was deleted and False if there is no such branch
+        """
+        branch = self._repository.branches.local.get(re.sub("^refs/heads/", "", name))
+        if branch is None:
+            return False
+        branch.delete()
+        return True
+
+    @_notifies
     def revert(self, reference='', target='', branch=''):
         """Revert a commit."""
         raise Exception('Not yet supported')
 
 
+def _to_oid(oid):
+    return pygit2.Oid(hex=oid) if isinstance(oid, str) else oid
+
+
+class CommitGraph(object):
+    """An in-memory index of the commit graph for ancestry queries.
+
+    Commits are numbered by integer ids in the order they are indexed, which is always after
+    their parents. Parents are kept as arrays of ids and every commit has a generation number
+    (1 for a root commit, otherwise 1 + the maximal generation of its parents), so an ancestor
+    always has a lower generation than its descendants, and ancestry queries only walk the
+    commits above the generation of the possible ancestor. Optionally, the set of ancestors of
+    every commit is kept as an integer bitmap of ids, which reduces an ancestry check to a bit
+    test, at the cost of memory quadratic in the number of commits (about 625 MB for 100k
+    commits), so bitmaps are only meant for small histories.
+
+    Commits are indexed on demand together with their not yet indexed ancestors, so the index
+    stays valid whenever new commits are created.
+    """
+
+    def __init__(self, repository, bitmaps=False):
+        self._repository = repository
+        self._ids = {}
+        self._oids = []
+        self._parents = []
+        self._generations = []
+        self._bitmaps = [] if bitmaps else None
+
+    def __contains__(self, oid):
+        return _to_oid(oid) in self._ids
+
+    def __len__(self):
+        return len(self._oids)
+
+    def ensure(self, oid):
+        """Index a commit and its ancestors and return the integer id of the commit."""
+        oid = _to_oid(oid)
+        if oid in self._ids:
+            return self._ids[oid]
+
+        parents = {}
+        stack = [oid]
+        while stack:
+            current = stack[-1]
+            if current in self._ids:
+                stack.pop()
+                continue
+            if current not in parents:
+                commit = self._repository.get(current)
+                if not isinstance(commit, pygit2.Commit):
+                    raise RevisionNotFound(str(current))
+                parents[current] = commit.parent_ids
+            missing = [parent for parent in parents[current] if parent not in self._ids]
+            if missing:
+                stack.extend(missing)
+                continue
+            stack.pop()
+            self._add(current, [self._ids[parent] for parent in parents[current]])
+
+        return self._ids[oid]
+
+    def _add(self, oid, parents):
+        id = len(self._oids)
+        self._ids[oid] = id
+        self._oids.append(oid)
+        self._parents.append(tuple(parents))
+        self._generations.append(1 + max((self._generations[p] for p in parents), default=0))
+        if self._bitmaps is not None:
+            bitmap = 1 << id
+            for parent in parents:
+                bitmap |= self._bitmaps[parent]
+            self._bitmaps.append(bitmap)
+
+    def generation(self, oid):
+        return self._generations[self.ensure(oid)]
+
+    def parents(self, oid):
+        return [self._oids[parent] for parent in self._parents[self.ensure(oid)]]
+
+    def is_ancestor(self, ancestor, descendant):
+        """Check whether ancestor is reachable from (or equal to) descendant."""
+        a = self.ensure(ancestor)
+        d = self.ensure(descendant)
+        if a == d:
+            return True
+        if self._generations[a] >= self._generations[d]:
+            return False
+        if self._bitmaps is not None:
+            return bool(self._bitmaps[d] >> a & 1)
+
+        # Walk the ancestors of descendant, but not below the generation of ancestor
+        generation = self._generations[a]
+        seen = {d}
+        stack = [d]
+        while stack:
+            for parent in self._parents[stack.pop()]:
+                if parent == a:
+                    return True
+                if parent not in seen and self._generations[parent] > generation:
+                    seen.add(parent)
+                    stack.append(parent)
+        return False
+
+    def merge_base(self, one, two):
+        """Return the Oid of the best common ancestor of two commits or None if there is none.
+
+        A best common ancestor is not an ancestor of any other common ancestor. Ids are assigned
+        after the ids of all ancestors, so the common ancestor with the highest id is one. Without
+        bitmaps the ancestors of both commits are visited together by decreasing generation, the
+        first one reached from both sides has the highest generation of all common ancestors.
+        """
+        a = self.ensure(one)
+        b = self.ensure(two)
+
+        if self._bitmaps is not None:
+            common = self._bitmaps[a] & self._bitmaps[b]
+            return self._oids[common.bit_length() - 1] if common else None
+
+        # All descendants of a commit have a higher generation, so the sides it is reachable
+        # from are known when it is taken from the heap
+        sides = {a: 1}
+        sides[b] = sides.get(b, 0) | 2
+        heap = sorted((-self._generations[id], id) for id in sides)
+        while heap:
+            _, id = heappop(heap)
+            side = sides[id]
+            if side == 3:
+                return self._oids[id]
+            for parent in self._parents[id]:
+                if parent not in sides:
+                    sides[parent] = side
+                    heappush(heap, (-self._generations[parent], parent))
+                else:
+                    sides[parent] |= side
+        return None
+
+
+class PathIndex(object):
+    """An in-memory index of the versions of every path along the first-parent history.
+
+    The versions of a path are kept as a list of (commit, oid, previous) tuples in the order they
+    are indexed, where commit introduced the blob oid at the path and previous is the position of
+    the version it replaced. Every indexed commit only keeps the positions of the paths it
+    changed, None for a removed path. The position of a path in a commit is found by following
+    the first parents to the commit that last changed the path. Every interval-th commit of a
+    first-parent chain is a checkpoint which keeps the positions of all of its paths, so a lookup
+    follows at most interval commits.
+
+    A commit is indexed by applying its diff against the first parent to the paths of the parent.
+    Like the commit graph, commits are indexed on demand together with their first parents.
+    """
+
+    def __init__(self, repository, interval=64):
+        self._repository = repository
+        self._interval = interval
+        self._versions = {}
+        self._commits = {}
+        self._checkpoints = {}
+
+    def __contains__(self, oid):
+        return _to_oid(oid) in self._commits
+
+    def ensure(self, oid):
+        """Index a commit and its first-parent ancestors."""
+        oid = _to_oid(oid)
+        if oid in self._commits:
+            return
+
+        # Follow the first parents until an indexed commit or the root commit
+        chain = []
+        commit = self._repository.get(oid)
+        while commit is not None:
+            if not isinstance(commit, pygit2.Commit):
+                raise RevisionNotFound(str(oid))
+            if commit.id in self._commits:
+                break
+            chain.append(commit)
+            commit = commit.parents[0] if commit.parents else None
+
+        for commit in reversed(chain):
+            if commit.parents:
+                parent = commit.parent_ids[0]
+                diff = commit.parents[0].tree.diff_to_tree(commit.tree)
+            else:
+                parent = None
+                diff = commit.tree.diff_to_tree(swap=True)
+
+            changes = {}
+            for delta in diff.deltas:
+                path = delta.new_file.path
+                if delta.status == pygit2.GIT_DELTA_DELETED:
+                    changes[path] = None
+                    continue
+                versions = self._versions.setdefault(path, [])
+                versions.append((commit.id, delta.new_file.id, self._position(parent, path)))
+                changes[path] = len(versions) - 1
+
+            depth = self._commits[parent][2] + 1 if parent is not None else 0
+            self._commits[commit.id] = (parent, changes, depth)
+            if depth % self._interval == 0:
+                self._checkpoints[commit.id] = self._positions(commit.id)
+
+    def _position(self, oid, path):
+        """Return the position of the version of a path in an indexed commit or None."""
+        while oid is not None:
+            parent, changes, depth = self._commits[oid]
+            if path in changes:
+                return changes[path]
+            if oid in self._checkpoints:
+                return self._checkpoints[oid].get(path)
+            oid = parent
+        return None
+
+    def _positions(self, oid):
+        """Return a dict of all paths of an indexed commit to the positions of their versions."""
+        chain = []
+        positions = {}
+        while oid is not None:
+            if oid in self._checkpoints:
+                positions = dict(self._checkpoints[oid])
+                break
+            parent, changes, depth = self._commits[oid]
+            chain.append(changes)
+            oid = parent
+
+        for changes in reversed(chain):
+            for path, position in changes.items():
+                if position is None:
+                    positions.pop(path, None)
+                else:
+                    positions[path] = position
+        return positions
+
+    def versions(self, commit, path):
+        """Yield (commit, oid) for the version of a path in a commit and the previous versions.
+
+        The most recent version comes first and the commit is the one that introduced the
+        version. Nothing is yielded if the path does not exist in the given commit.
+        """
+        oid = _to_oid(commit)
+        self.ensure(oid)
+        position = self._position(oid, path)
+        versions = self._versions.get(path)
+        while position is not None:
+            commit, oid, position = versions[position]
+            yield commit, oid
+
+    def history(self, commit, path):
+        """Yield (commit, oid) for the previous versions of a path, the most recent first.
+
+        The commit is the one that introduced the version. Nothing is yielded if the path does
+        not exist in the given commit.
+        """
+        versions = self.versions(commit, path)
+        next(versions, None)
+        yield from versions
+
+    def previous(self, commit, path):
+        """Return (commit, oid) of the previous version of a path or None if there is none."""
+        return next(self.history(commit, path), None)
+
+
 class Revision(object):
 
     def __init__(self, repository, commit):
@@ -540,6 +937,10 @@ class Revision(object):
     def node(self, path=None):
         return Node(self._repository, self._commit, path)
 
+    def files(self):
+        """Return a tuple of (path, oid, filemode) for all files of the revision."""
+        return self._repository.files(self._commit.tree)
+
 
 class Node(object):
 
@@ -624,24 +1025,13 @@ class Node(object):
         return None
 
     def history(self):
-        walker = self._repository._repository.walk(self._commit.oid, pygit2.GIT_SORT_TIME)
-
-        c0 = self._commit
-        e0 = c0.tree[self.name]
-
-        for c1 in walker:
-            try:
-                e1 = c1.tree[self.name]
-                if e0 and e0.oid != e1.oid:
-                    yield Node(self._repository, c1, self.name)
-            except KeyError:
-                return
+        """Yield the previous versions of this node along the first-parent history.
 
-            c0 = c1
-            e0 = e1
-
-
-from heapq import heappush, heappop
+        Every version is returned as the node in the commit that introduced it.
+        """
+        repository = self._repository
+        for commit, oid in repository.path_index.history(self._commit.id, self.name):
+            yield Node(repository, repository._repository.get(commit), self.name)
 
 
 class Index(object):
@@ -664,6 +1054,12 @@ class Index(object):
 
         self.stash[path] = (oid, mode or pygit2.GIT_FILEMODE_BLOB)
 
+    def add_blob(self, path, oid, mode=None):
+        """Add a blob which is already stored in the repository, e.g. by create_blob_fromdisk."""
+        path = os.path.normpath(path)
+
+        self.stash[path] = (oid, mode or pygit2.GIT_FILEMODE_BLOB)
+
     def remove(self, path):
         path = os.path.normpath(path)
 
@@ -705,9 +1101,12 @@ class Index(object):
                             "{}, {}".format(branch, e))
                 pass
 
-        return self.repository._repository.create_commit(
-            ref, author, commiter, message, oid, parents
-        )
+        with self.repository.notifying():
+            oid = self.repository._repository.create_commit(
+                ref, author, commiter, message, oid, parents
+            )
+        self.repository.commit_graph.ensure(oid)
+        return oid
 
 
 class IndexHeap(object):
@@ -1,13 +1,15 @@
 #!/usr/bin/env python3
 import logging
 import os
+import time
 from pyparsing import ParseException
+from quit.cache import Cache
 from quit.exceptions import UnSupportedQuery, SparqlProtocolError, NonAbsoluteBaseError
-from rdflib.term import URIRef
+from rdflib.term import Literal, URIRef
 from rdflib.plugins.sparql.parserutils import CompValue
 from rdflib.plugins.sparql.parser import parseQuery, parseUpdate
 from quit.tools.algebra import translateQuery, translateUpdate
-from rdflib.plugins.serializers.nt import _nt_row as _nt
+from rdflib.plugins.serializers.nt import _quoteLiteral
 from rdflib.plugins.sparql import parser, algebra
 from rdflib.plugins import sparql
 from uritools import urisplit
@@ -107,19 +109,104 @@ class QueryAnalyzer:
         return
 
 
+class PreparedQueryCache:
+    """A LRU cache for parsed and translated SPARQL queries and updates.
+
+    Parsing with the pyparsing grammar and translating to the algebra is costly for complex
+    queries. The translated algebra does not depend on initial bindings, thus a cached query can
+    be evaluated again with different initBindings.
+    """
+
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.clear()
+
+    def get(self, key, prepare, keep=None):
+        """Return the prepared value for key and call prepare() on a cache miss.
+
+        Exceptions raised by prepare() are passed on and nothing is cached. If keep is given,
+        the prepared value is only cached if keep(value) is true.
+        """
+        try:
+            value, cost = self._cache.get(key)
+        except KeyError:
+            start = time.perf_counter()
+            value = prepare()
+            cost = time.perf_counter() - start
+            if keep is None or keep(value):
+                self._cache.set(key, (value, cost))
+            self.misses += 1
+            return value
+
+        self.hits += 1
+        self.saved += cost
+        logger.debug("Reused prepared query, saved {:.3f} ms".format(cost * 1000))
+        return value
+
+    def clear(self):
+        """Drop all cached queries and reset the counters."""
+        self._cache = Cache(capacity=self.capacity)
+        self.hits = 0
+        self.misses = 0
+        self.saved = 0.0
+
+    @property
+    def stats(self):
+        """Return the counters of the cache, "saved" is the parse time saved in seconds."""
+        return {
+            'size': self._cache.size,
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'saved': self.saved
+        }
+
+
+preparedQueries = PreparedQueryCache()
+
+
+def _dataset_key(graphs):
+    return tuple(graphs) if isinstance(graphs, list) else graphs
+
+
+def ntLines(triples):
+    """Get the sorted and distinct N-Triples lines of triples.
+
+    The lines are the same as the ones of rdflib's N-Triples serializer, but IRIs and blank nodes
+    which occur in several triples of the batch are only serialized once.
+    """
+    terms = {}
+    lines = set()
+
+    for s, p, o in triples:
+        s3 = terms.get(s)
+        if s3 is None:
+            s3 = terms[s] = s.n3()
+        p3 = terms.get(p)
+        if p3 is None:
+            p3 = terms[p] = p.n3()
+        if isinstance(o, Literal):
+            o3 = _quoteLiteral(o)
+        else:
+            o3 = terms.get(o)
+            if o3 is None:
+                o3 = terms[o] = o.n3()
+        lines.add('%s %s %s .' % (s3, p3, o3))
+
+    return sorted(lines)
+
+
 def applyChangeset(f, changeset, identifier):
-    """Update the FileReference (graph uri) of a file with help of the changeset."""
+    """Update the FileReference (graph uri) of a file with help of the changeset.
+
+    Every batch of additions resp. removals is serialized and sorted once and merged with the
+    content of the file in one step.
+    """
     for (op, triples) in changeset:
         if op == 'additions':
-            for triple in triples:
-                # the internal _nt serializer appends '\n'
-                line = _nt(triple).rstrip()
-                f.add(line)
+            f.update(ntLines(triples))
         elif op == 'removals':
-            for triple in triples:
-                # the internal _nt serializer appends '\n'
-                line = _nt(triple).rstrip()
-                f.remove(line)
+            f.difference_update(ntLines(triples))
 
 
 def isAbsoluteUri(uri):
@@ -207,7 +294,16 @@ def configure_update_dataset(parsed_update, default_graphs, named_graphs):
 
 
 def parse_query_type(query, base=None, default_graph=[], named_graph=[]):
-    """Parse a query and add default and named graph uri if possible."""
+    """Parse a query and add default and named graph uri if possible.
+
+    The translated query is cached by query string, base and dataset.
+    """
+    key = ('query', query, base, _dataset_key(default_graph), _dataset_key(named_graph))
+    return preparedQueries.get(
+        key, lambda: _parse_query_type(query, base, default_graph, named_graph))
+
+
+def _parse_query_type(query, base, default_graph, named_graph):
     try:
         parsed_query = parseQuery(query)
         parsed_query = configure_query_dataset(parsed_query, default_graph, named_graph)
@@ -227,7 +323,23 @@ def parse_query_type(query, base=None, default_graph=[], named_graph=[]):
 
 
 def parse_update_type(query, base=None, default_graph=[], named_graph=[]):
-    """Parse an update and add default and named graph uri if possible."""
+    """Parse an update and add default and named graph uri if possible.
+
+    The translated update is cached by update string, base and dataset. Updates with INSERT DATA
+    or DELETE DATA operations are not cached, their payloads are large and rarely sent again.
+    """
+    key = ('update', query, base, _dataset_key(default_graph), _dataset_key(named_graph))
+    return preparedQueries.get(
+        key, lambda: _parse_update_type(query, base, default_graph, named_graph),
+        keep=_reusable_update)
+
+
+def _reusable_update(prepared):
+    _, translated_update = prepared
+    return not any(op.name in ('InsertData', 'DeleteData') for op in translated_update)
+
+
+def _parse_update_type(query, base, default_graph, named_graph):
     try:
         parsed_update = parseUpdate(query)
         parsed_update = configure_update_dataset(parsed_update, default_graph, named_graph)
@@ -30,19 +30,18 @@ class Merger(object):
         target = self.quitRepository.lookup(target)
         branch = self.quitRepository.lookup(branch)
 
-        ancestor_head = self._repository.merge_base(target, branch)
-        if ancestor_head is None:
-            # TODO there might be more errors
-            return pygit2.GIT_MERGE_ANALYSIS_NONE
-
         # We're up-to-date if we're trying to merge our own common ancestor.
-        if branch == ancestor_head:
+        if self.quitRepository.is_ancestor(branch, target):
             return pygit2.GIT_MERGE_ANALYSIS_UP_TO_DATE
 
         # We're fastforwardable if we're our own common ancestor.
-        if target == ancestor_head:
+        if self.quitRepository.is_ancestor(target, branch):
             return pygit2.GIT_MERGE_ANALYSIS_FASTFORWARD | pygit2.GIT_MERGE_ANALYSIS_NORMAL
 
+        if self.quitRepository.merge_base(target, branch) is None:
+            # TODO there might be more errors
+            return pygit2.GIT_MERGE_ANALYSIS_NONE
+
         return pygit2.GIT_MERGE_ANALYSIS_NORMAL
 
     def merge_three_way_head(self, branch):
@@ -67,7 +66,7 @@ class Merger(object):
 
         targetOid = self.quitRepository.lookup(target)
         branchOid = self.quitRepository.lookup(branch)
-        baseOid = self._repository.merge_base(targetOid, branchOid)
+        baseOid = self.quitRepository.merge_base(targetOid, branchOid)
 
         baseCommit = self._repository.get(baseOid)
         targetCommit = self._repository.get(targetOid)
@@ -1,98 +1,328 @@
 #!/usr/bin/env python3
 
-import functools as ft
+import logging
+from heapq import nsmallest
+from rdflib import BNode, Literal, URIRef, Variable
+from rdflib.exceptions import ParserError
+from rdflib.plugins.parsers.ntriples import W3CNTriplesParser
+from rdflib.query import Result
+from quit.cache import Cache
+from quit.namespace import XSD
+from quit.utils import git_timestamp
 
-from rdflib import BNode
-from quit.namespace import FOAF, PROV, QUIT
+logger = logging.getLogger('quit.provenance')
 
 
-class Blame(object):
+def _key(term):
+    # Blank node labels are not stable between the dataset and the computed deltas
+    return None if isinstance(term, BNode) else term
+
+
+def quad_key(s, p, o, context):
+    """Return the key of a quad in the blame index, blank nodes are treated as wildcards."""
+    return (_key(s), _key(p), _key(o), _key(context))
+
+
+class BlameIndex(object):
+    """Index of the commit that introduced each quad of a revision.
+
+    The deltas of every commit against its first parent are recorded while the history is
+    processed. The attribution of a revision is derived from the one of its first parent by
+    replaying the delta; quads a merge takes over from another parent keep the attribution of
+    that parent. These are looked up by walking the history of the other parent for just these
+    quads, so a merge does not need the complete attribution of its other parents. Attributions
+    are computed on demand and the most recent ones are cached.
     """
-    Reusable Blame object for web client
+
+    def __init__(self, capacity=10):
+        self._deltas = {}
+        self._keys = {}
+        self._attributions = Cache(capacity=capacity)
+
+    def __contains__(self, commitid):
+        return commitid in self._deltas
+
+    def add(self, commitid, parents, delta):
+        """Record the delta of a commit against its first parent.
+
+        Args:
+            commitid: the id of the commit
+            parents: the ids of the parent commits, the delta is relative to the first one
+            delta: a dict of graph iris to lists of ('additions'|'removals', triples) tuples
+        """
+        additions = set()
+        removals = set()
+        for iri, changesets in delta.items():
+            for op, triples in changesets:
+                keys = additions if op == 'additions' else removals
+                # the same quad is added and removed by many commits, so one key is shared
+                keys.update(self._keys.setdefault(key, key)
+                            for key in (quad_key(s, p, o, iri) for s, p, o in triples))
+        self._deltas[commitid] = (tuple(parents), frozenset(additions), frozenset(removals))
+
+    def attribution(self, commitid):
+        """Return a dict of quad keys to the id of the commit that introduced the quad.
+
+        The returned dict is shared with the cache and must not be modified.
+
+        Raises:
+            KeyError if the commit is not indexed
+        """
+        try:
+            return self._attributions.get(commitid)
+        except KeyError:
+            pass
+
+        # Follow the first parents until a cached attribution or the root commit
+        chain = []
+        attribution = {}
+        current = commitid
+        while current is not None:
+            if current in self._attributions:
+                attribution = dict(self._attributions.get(current))
+                break
+            chain.append(current)
+            parents = self._deltas[current][0]
+            current = parents[0] if parents else None
+
+        for current in reversed(chain):
+            parents, additions, removals = self._deltas[current]
+            taken = self._introducers(parents[1:], additions) if len(parents) > 1 else {}
+            for key in removals:
+                attribution.pop(key, None)
+            for key in additions:
+                attribution[key] = taken.get(key, current)
+
+        self._attributions.set(commitid, attribution)
+        return attribution
+
+    def _introducers(self, revisions, keys):
+        """Return a dict of quad keys to the commit that introduced them into the first revision
+        which contains them, keys contained in none of the revisions are left out.
+        """
+        introducers = {}
+        # (keys, revisions still to look at, commit which introduced the remaining keys)
+        stack = [(set(keys), list(revisions), None)]
+        while stack:
+            keys, revisions, fallback = stack[-1]
+            if not keys or not revisions:
+                stack.pop()
+                if fallback is not None:
+                    introducers.update((key, fallback) for key in keys)
+                continue
+
+            current = revisions.pop(0)
+            pending = set(keys)
+            while pending and current is not None:
+                if current in self._attributions:
+                    attribution = self._attributions.get(current)
+                    for key in pending:
+                        if key in attribution:
+                            introducers[key] = attribution[key]
+                            keys.discard(key)
+                    break
+                parents, additions, removals = self._deltas[current]
+                added = pending & additions
+                if added:
+                    keys -= added
+                    if len(parents) > 1:
+                        # a merge, the keys may again be taken over from its other parents
+                        stack.append((added, list(parents[1:]), current))
+                    else:
+                        introducers.update((key, current) for key in added)
+                pending -= added
+                pending -= removals
+                current = parents[0] if parents else None
+        return introducers
+
+
+class _TripleSink(object):
+    def __init__(self):
+        self.last = None
+
+    def triple(self, s, p, o):
+        self.last = (s, p, o)
+
+
+class HistoryBlame(object):
+    """Line level blame of graph files computed by walking the first-parent history.
+
+    This works like git blame, but graph files are sorted N-Triples, so the diff of two versions
+    of a file is the difference of their sets of lines. The versions of a file are taken from the
+    path index of the repository and the attribution of every version is cached by the commit
+    which introduced it and the path, so a blame of a neighbouring revision only replays the
+    versions in between.
     """
 
-    def __init__(self, quit):
-        self.quit = quit
+    def __init__(self, repository, capacity=50):
+        self.repository = repository
+        self._blobs = Cache(capacity=capacity)
 
-    def _generate_values(self, quads):
-        result = list()
+    def _lines(self, commitid, path):
+        content = self.repository.revision(commitid).node(path=path).content
+        return set(' '.join(line.split()) for line in content.splitlines() if line.strip())
 
-        for quad in quads:
-            (s, p, o, c) = quad
+    def blame(self, commitid, path):
+        """Return a dict of the lines of a file to the id of the commit that introduced them."""
+        # Follow the versions of the file until a cached one or the one that created the file
+        chain = []
+        attribution = {}
+        for commitid, oid in self.repository.path_index.versions(commitid, path):
+            key = (str(commitid), path)
+            if key in self._blobs:
+                attribution = self._blobs.get(key)
+                break
+            chain.append(key)
 
-            c.rewrite = True
+        for key in reversed(chain):
+            commitid, path = key
+            attribution = {line: attribution.get(line, commitid)
+                           for line in self._lines(commitid, path)}
+            self._blobs.set(key, attribution)
 
-            # Todo: BNodes in VALUES are not supported by specification? Using UNDEF for now
-            _s = 'UNDEF' if isinstance(s, BNode) else s.n3()
-            _p = 'UNDEF' if isinstance(p, BNode) else p.n3()
-            _o = 'UNDEF' if isinstance(o, BNode) else o.n3()
-            _c = 'UNDEF' if isinstance(c, BNode) else c.identifier.n3()
+        return attribution
 
-            c.rewrite = False
+    def quads(self, quit, commit, subject=None, predicate=None, graph=None):
+        """Yield ((s, p, o, context), commit id) for the statements of a revision.
+
+        Only the files of the given graph are blamed and only the lines with the given subject
+        and predicate are parsed.
+        """
+        graphconfig = quit.getGraphConfig(commit.id)
+        s = subject.n3() if subject is not None else None
+        p = predicate.n3() if predicate is not None else None
+
+        for name, oid in quit.getFilesForCommit(commit):
+            context = URIRef(graphconfig.getgraphuriforfile(name))
+            if graph is not None and context != graph:
+                continue
+
+            sink = _TripleSink()
+            parser = W3CNTriplesParser(sink)
+
+            for line, commitid in self.blame(commit.id, name).items():
+                if s is not None or p is not None:
+                    # subjects and predicates never contain spaces in N-Triples
+                    parts = line.split(' ', 2)
+                    if (s is not None and parts[0] != s) or (
+                            p is not None and (len(parts) < 2 or parts[1] != p)):
+                        continue
+                sink.last = None
+                parser.line = line
+                try:
+                    parser.parseline()
+                except ParserError as e:
+                    logger.warning('Skipping line of {} in blame: {}'.format(name, e))
+                    continue
+                if sink.last is not None:
+                    yield sink.last + (context,), commitid
 
-            result.append((_s, _p, _o, _c))
-        return result
 
-    def run(self, quads=None, branch_or_ref='master'):
+class Blame(object):
+    """
+    Reusable Blame object for web client
+    """
+
+    variables = [Variable(v) for v in ['s', 'p', 'o', 'context', 'hex', 'name', 'email', 'date']]
+
+    def __init__(self, quit):
+        self.quit = quit
+        self.history = HistoryBlame(quit.repository)
+
+    def _commit_bindings(self, commitid):
+        commit = self.quit.repository.revision(commitid)
+        return {
+            Variable('hex'): Literal(commit.id),
+            Variable('name'): Literal(commit.author.name),
+            Variable('email'): Literal(commit.author.email),
+            Variable('date'): Literal(
+                git_timestamp(commit.committer.time, commit.committer.offset),
+                datatype=XSD.dateTime)
+        }
+
+    def run(self, quads=None, branch_or_ref='master', engine='index', graph=None,
+            subject=None, predicate=None, limit=None, offset=0):
         """
         Annotated every quad with the respective author
 
+        Only the quads matching the given graph, subject and predicate are looked up, sorted by
+        graph, subject, predicate and object and the page given by offset and limit is returned.
+
         Args:
-                querystring: A string containing a SPARQL ask or select query.
+                quads: An iterable of (s, p, o, context) tuples, all quads of the revision if None.
+                branch_or_ref: The revision to annotate.
+                engine: "index" to look the quads up in the blame index of Quit, "history" to
+                    compute the blame of the graph files from their first-parent history.
+                graph, subject, predicate: Restrict the blame to quads with these terms.
+                limit, offset: The number of quads to return resp. to skip.
         Returns:
-                The SPARQL result set
+                A SPARQL result set with the variables s, p, o, context, hex, name, email and date
         """
 
         commit = self.quit.repository.revision(branch_or_ref)
-        g, commitid = self.quit.instance(branch_or_ref)
-
-        quads = [x for x in g.store.quads((None, None, None))]
-
-        if len(quads) == 0:
-            return []
-
-        values = self._generate_values(quads)
-        values_string = ft.reduce(lambda acc, quad: acc + '( %s %s %s %s )\n' % quad, values, '')
-
-        q = """
-            PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-            PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-            PREFIX aksw: <http://aksw.org/>
-            PREFIX quit: <http://quit.aksw.org/vocab/>
-            PREFIX prov: <http://www.w3.org/ns/prov#>
-            PREFIX foaf: <http://xmlns.com/foaf/0.1/>
-            SELECT ?s ?p ?o ?context ?hex ?name ?email ?date WHERE {
-                ?commit quit:preceedingCommit* ?c .
-                ?c      prov:endedAtTime ?date ;
-                        prov:qualifiedAssociation ?qa ;
-                        quit:updates ?update ;
-                        quit:hex ?hex .
-                ?qa     prov:agent ?user ;
-                        prov:hadRole quit:Author .
-                ?user   foaf:mbox ?email ;
-                        rdfs:label ?name .
-                ?update quit:graph ?context ;
-                        quit:additions ?additions .
-                GRAPH ?additions {
-                    ?s ?p ?o
-                }
-                FILTER NOT EXISTS {
-                    ?y quit:preceedingCommit+ ?z .
-                    ?z quit:updates ?update2 .
-                    ?update2 quit:graph ?g ;
-                        quit:removals ?removals .
-                    GRAPH ?removals {
-                        ?s ?p ?o
-                    }
-                }
-                VALUES (?s ?p ?o ?context) {
-                    %s
-                }
-            }
-            """ % values_string
-
-        return self.quit.store.store.query(
-            q,
-            initNs={'foaf': FOAF, 'prov': PROV, 'quit': QUIT},
-            initBindings={'commit': QUIT['commit-' + commit.id]}
-        )
+        pattern = (subject, predicate, graph)
+
+        if engine == 'index':
+            annotated = self._index(commit, quads, pattern)
+        elif engine == 'history':
+            annotated = self._history(commit, quads, pattern)
+        else:
+            raise ValueError('Unknown blame engine: {}'.format(engine))
+
+        if limit is None:
+            annotated = sorted(annotated, key=_sort_key)
+        else:
+            # only the quads up to the end of the page are kept
+            annotated = nsmallest(offset + limit, annotated, key=_sort_key)
+
+        commits = {}
+        bindings = []
+
+        for (s, p, o, c), commitid in annotated[offset:]:
+            if commitid not in commits:
+                commits[commitid] = self._commit_bindings(commitid)
+
+            row = {Variable('s'): s, Variable('p'): p, Variable('o'): o, Variable('context'): c}
+            row.update(commits[commitid])
+            bindings.append(row)
+
+        result = Result('SELECT')
+        result.vars = self.variables
+        result.bindings = bindings
+        return result
+
+    def _index(self, commit, quads, pattern):
+        subject, predicate, graph = pattern
+        attribution = self.quit.blameIndex.attribution(commit.id)
+
+        if quads is None:
+            g, commitid = self.quit.instance(commit.id)
+            quads = ((s, p, o, c.identifier)
+                     for s, p, o, c in g.store.quads((subject, predicate, None, graph)))
+        else:
+            quads = (quad for quad in quads if _matches(quad, pattern))
+
+        for quad in quads:
+            commitid = attribution.get(quad_key(*quad))
+            if commitid is not None:
+                yield quad, commitid
+
+    def _history(self, commit, quads, pattern):
+        annotated = self.history.quads(self.quit, commit, *pattern)
+        if quads is None:
+            return annotated
+
+        keys = set(quad_key(*quad) for quad in quads if _matches(quad, pattern))
+        return ((quad, commitid) for quad, commitid in annotated if quad_key(*quad) in keys)
+
+
+def _sort_key(annotated):
+    (s, p, o, c), commitid = annotated
+    return (c.n3(), s.n3(), p.n3(), o.n3())
+
+
+def _matches(quad, pattern):
+    s, p, o, c = quad
+    subject, predicate, graph = pattern
+    return ((subject is None or s == subject) and (predicate is None or p == predicate) and
+            (graph is None or c == graph))
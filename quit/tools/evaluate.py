@@ -15,12 +15,19 @@ also return a dict of list of dicts
 """
 
 import collections
+import hashlib
+import heapq
+import pickle
+import tempfile
+import threading
+import time
 
 from rdflib import Variable, Graph, BNode, URIRef, Literal
-from six import iteritems, itervalues
+from rdflib.paths import Path
+from six import iteritems
 
 from rdflib.plugins.sparql import CUSTOM_EVALS
-from rdflib.plugins.sparql.parserutils import value
+from rdflib.plugins.sparql.parserutils import value, CompValue
 from rdflib.plugins.sparql.sparql import (
     QueryContext, AlreadyBound, FrozenBindings, SPARQLError)
 from rdflib.plugins.sparql.evalutils import (
@@ -30,7 +37,271 @@ from rdflib.plugins.sparql.aggregates import Aggregator
 from rdflib.plugins.sparql.algebra import Join, ToMultiSet, Values
 
 from quit.web import service
-from quit.exceptions import UnSupportedQuery, UnSupportedQueryType, FromNamedError
+from quit.exceptions import UnSupportedQuery, UnSupportedQueryType, FromNamedError, QueryTimeout
+
+# Number of groups (GROUP BY) resp. distinct solutions (DISTINCT) kept in memory
+# before further solutions are spilled to temporary files. None disables spilling.
+SPILL_THRESHOLD = None
+
+# Number of temporary files used per spill and the maximal recursion depth when
+# a spilled partition on its own exceeds the threshold again.
+SPILL_PARTITIONS = 16
+SPILL_MAX_DEPTH = 4
+
+# Number of most recently seen solutions REDUCED compares incoming solutions with.
+# 0: No reduction
+# 1: compare only with the last row, almost no reduction with unordered incoming rows
+# N: The greater the buffer size the greater the reduction but more memory and time
+#    are needed
+REDUCED_BUFFER_SIZE = 1
+
+_budget = threading.local()
+
+
+class QueryBudget(object):
+    """Bound the time and the number of results of the queries evaluated within this context.
+
+    The evaluator checks the budget of the current thread while matching triple patterns,
+    evaluating property paths and joining solutions and raises QueryTimeout once it is
+    exhausted. Solutions are generated lazily, so the result has to be consumed (serialized)
+    within the context as well.
+    """
+
+    def __init__(self, timeout=None, limit=None):
+        self.timeout = timeout
+        self.limit = limit
+        self.deadline = None
+        self.results = 0
+        self._outer = None
+
+    def __enter__(self):
+        self._outer = getattr(_budget, 'current', None)
+        self.results = 0
+        if self.timeout is not None:
+            self.deadline = time.monotonic() + self.timeout
+        _budget.current = self
+        return self
+
+    def __exit__(self, *exc):
+        _budget.current = self._outer
+        return False
+
+    def check(self):
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise QueryTimeout("Query exceeded the time limit of {}s".format(self.timeout))
+
+    def produced(self):
+        self.results += 1
+        if self.limit is not None and self.results > self.limit:
+            raise QueryTimeout("Query exceeded the limit of {} results".format(self.limit))
+        self.check()
+
+
+def _currentBudget():
+    return getattr(_budget, 'current', None)
+
+
+def _checked(rows):
+    """Pass rows through while checking the time budget of the current thread."""
+    budget = _currentBudget()
+    if budget is None:
+        return rows
+    return _checkedRows(rows, budget)
+
+
+def _checkedRows(rows, budget):
+    for row in rows:
+        budget.check()
+        yield row
+
+
+def _counted(rows):
+    """Pass result rows through while counting them against the budget of the current thread."""
+    budget = _currentBudget()
+    if budget is None:
+        return rows
+    return _countedRows(rows, budget)
+
+
+def _countedRows(rows, budget):
+    for row in rows:
+        budget.produced()
+        yield row
+
+
+class _BudgetedGraph(object):
+    """A graph proxy handed to property path evaluation to check the budget on every step."""
+
+    def __init__(self, graph, budget):
+        self.graph = graph
+        self.budget = budget
+
+    def triples(self, triple):
+        s, p, o = triple
+        if isinstance(p, Path):
+            for _s, _o in p.eval(self, s, o):
+                self.budget.check()
+                yield _s, p, _o
+        else:
+            for t in self.graph.triples(triple):
+                self.budget.check()
+                yield t
+
+    def __getattr__(self, name):
+        return getattr(self.graph, name)
+
+
+_profile = threading.local()
+
+
+class OperatorStats(object):
+    """Statistics of one algebra operator collected by a QueryProfile."""
+
+    __slots__ = ('calls', 'rows', 'time', 'lookups')
+
+    def __init__(self):
+        self.calls = 0
+        self.rows = 0
+        self.time = 0.0
+        self.lookups = 0
+
+
+class QueryProfile(object):
+    """Collect per operator statistics of the queries evaluated within this context.
+
+    For every operator of the algebra the number of evaluations, the produced solutions, the
+    wall time spent in it (including its operands) and the triple pattern lookups issued on
+    the graph are recorded. Like with QueryBudget the result has to be consumed within the
+    context.
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self.time = 0.0
+        self._stack = []
+        self._outer = None
+        self._start = None
+
+    def __enter__(self):
+        self._outer = getattr(_profile, 'current', None)
+        self._start = time.perf_counter()
+        _profile.current = self
+        return self
+
+    def __exit__(self, *exc):
+        self.time += time.perf_counter() - self._start
+        _profile.current = self._outer
+        return False
+
+    def get(self, part):
+        return self.stats.get(id(part))
+
+    def evalPart(self, ctx, part):
+        stats = self.stats.get(id(part))
+        if stats is None:
+            stats = self.stats[id(part)] = OperatorStats()
+        stats.calls += 1
+
+        self._stack.append(stats)
+        start = time.perf_counter()
+        try:
+            res = _evalPart(ctx, part)
+        finally:
+            stats.time += time.perf_counter() - start
+            self._stack.pop()
+
+        if not isinstance(res, dict):
+            return self._rows(stats, res)
+        if 'bindings' in res:
+            res['bindings'] = self._rows(stats, res['bindings'])
+        elif 'graph' in res:
+            stats.rows += len(res['graph'])
+        else:
+            stats.rows += 1
+        return res
+
+    def _rows(self, stats, rows):
+        rows = iter(rows)
+        while True:
+            self._stack.append(stats)
+            start = time.perf_counter()
+            try:
+                row = next(rows)
+            except StopIteration:
+                return
+            finally:
+                stats.time += time.perf_counter() - start
+                self._stack.pop()
+            stats.rows += 1
+            yield row
+
+    def lookup(self):
+        if self._stack:
+            self._stack[-1].lookups += 1
+
+
+def _dump(f, seq, row):
+    pickle.dump((seq, dict(row)), f, pickle.HIGHEST_PROTOCOL)
+
+
+def _load(ctx, f):
+    """Read back (seq, solution) pairs written with _dump and close the file."""
+    f.seek(0)
+    try:
+        while True:
+            seq, row = pickle.load(f)
+            yield seq, FrozenBindings(ctx, row)
+    except EOFError:
+        pass
+    finally:
+        f.close()
+
+
+def _digest(row):
+    """A compact, fixed size representation of a solution used to detect duplicates."""
+    h = hashlib.blake2b(digest_size=16)
+    for var, term in sorted(row.items()):
+        h.update(var.encode('utf-8'))
+        h.update(b'\0')
+        h.update(term.n3().encode('utf-8'))
+        h.update(b'\0')
+    return h.digest()
+
+
+class SpillPartitions(object):
+    """Hash partitioned temporary files for solutions that do not fit into memory.
+
+    Solutions are written as plain dicts together with their position in the
+    incoming sequence and are thawed with the given context when a partition is
+    read back.
+    """
+
+    def __init__(self, ctx, depth=0, count=SPILL_PARTITIONS):
+        self.ctx = ctx
+        self.depth = depth
+        self._files = [None] * count
+        self._seq = 0
+
+    def add(self, key, row):
+        i = hash((self.depth, key)) % len(self._files)
+        if self._files[i] is None:
+            self._files[i] = tempfile.TemporaryFile()
+        _dump(self._files[i], self._seq, row)
+        self._seq += 1
+
+    def partitions(self):
+        """Yield every non-empty partition as a generator of (seq, solution) pairs."""
+        for i, f in enumerate(self._files):
+            if f is not None:
+                self._files[i] = None
+                yield _load(self.ctx, f)
+
+    def close(self):
+        for f in self._files:
+            if f is not None:
+                f.close()
+        self._files = [None] * len(self._files)
+
 
 def evalBGP(ctx, bgp):
 
@@ -48,7 +319,19 @@ def evalBGP(ctx, bgp):
     _p = ctx[p]
     _o = ctx[o]
 
-    for ss, sp, so in ctx.graph.triples((_s, _p, _o)):
+    profile = getattr(_profile, 'current', None)
+    if profile is not None:
+        profile.lookup()
+
+    budget = _currentBudget()
+    if budget is None:
+        triples = ctx.graph.triples((_s, _p, _o))
+    elif isinstance(_p, Path):
+        triples = _BudgetedGraph(ctx.graph, budget).triples((_s, _p, _o))
+    else:
+        triples = _checkedRows(ctx.graph.triples((_s, _p, _o)), budget)
+
+    for ss, sp, so in triples:
         if None in (_s, _p, _o):
             c = ctx.push()
         else:
@@ -95,7 +378,7 @@ def evalLazyJoin(ctx, join):
     essentially doing the join implicitly
     hopefully evaluating much fewer triples
     """
-    for a in evalPart(ctx, join.p1):
+    for a in _checked(evalPart(ctx, join.p1)):
         c = ctx.thaw(a)
         for b in evalPart(c, join.p2):
             yield b.merge(a) # merge, as some bindings may have been forgotten
@@ -109,7 +392,7 @@ def evalJoin(ctx, join):
     if join.lazy:
         return evalLazyJoin(ctx, join)
     else:
-        a = evalPart(ctx, join.p1)
+        a = _checked(evalPart(ctx, join.p1))
         b = set(evalPart(ctx, join.p2))
         return _join(a, b)
 
@@ -125,14 +408,14 @@ def evalUnion(ctx, union):
 
 
 def evalMinus(ctx, minus):
-    a = evalPart(ctx, minus.p1)
+    a = _checked(evalPart(ctx, minus.p1))
     b = set(evalPart(ctx, minus.p2))
     return _minus(a, b)
 
 
 def evalLeftJoin(ctx, join):
     # import pdb; pdb.set_trace()
-    for a in evalPart(ctx, join.p1):
+    for a in _checked(evalPart(ctx, join.p1)):
         ok = False
         c = ctx.thaw(a)
         for b in evalPart(c, join.p2):
@@ -211,6 +494,13 @@ def evalMultiset(ctx, part):
 
 
 def evalPart(ctx, part):
+    profile = getattr(_profile, 'current', None)
+    if profile is not None:
+        return profile.evalPart(ctx, part)
+    return _evalPart(ctx, part)
+
+
+def _evalPart(ctx, part):
 
     # try custom evaluation functions
     for name, c in CUSTOM_EVALS.items():
@@ -294,29 +584,67 @@ def evalAggregateJoin(ctx, agg):
     # p is always a Group, we always get a dict back
 
     group_expr = agg.p.expr
-    res = collections.defaultdict(lambda: Aggregator(aggregations=agg.A))
 
     if group_expr is None:
         # no grouping, just COUNT in SELECT clause
         # get 1 aggregator for counting
-        aggregator = res[True]
+        aggregator = Aggregator(aggregations=agg.A)
         for row in p:
             aggregator.update(row)
-    else:
-        for row in p:
-            # determine right group aggregator for row
-            k = tuple(_eval(e, row, False) for e in group_expr)
-            res[k].update(row)
-
-    # all rows are done; yield aggregated values
-    for aggregator in itervalues(res):
         yield FrozenBindings(ctx, aggregator.get_bindings())
+        return
+
+    empty = True
+    for bindings in _aggregateGroups(ctx, agg.A, group_expr, p):
+        empty = False
+        yield bindings
 
     # there were no matches
-    if len(res) == 0:
+    if empty:
         yield FrozenBindings(ctx)
 
 
+def _aggregateGroups(ctx, aggregations, group_expr, rows, depth=0):
+    """Aggregate rows into one solution per group.
+
+    Only the accumulators of each group are kept in memory. If SPILL_THRESHOLD
+    is set and the number of groups exceeds it, rows of further groups are
+    written to hash partitioned temporary files which are aggregated one after
+    another once all rows in memory are done.
+    """
+    res = collections.OrderedDict()
+    spill = None
+    limit = SPILL_THRESHOLD if depth < SPILL_MAX_DEPTH else None
+
+    try:
+        for row in rows:
+            # determine right group aggregator for row
+            k = tuple(_eval(e, row, False) for e in group_expr)
+            aggregator = res.get(k)
+            if aggregator is None:
+                if limit is not None and len(res) >= limit:
+                    if spill is None:
+                        spill = SpillPartitions(ctx, depth)
+                    spill.add(k, row)
+                    continue
+                aggregator = res[k] = Aggregator(aggregations=aggregations)
+            aggregator.update(row)
+
+        # all rows are done; yield aggregated values
+        while res:
+            _, aggregator = res.popitem(last=False)
+            yield FrozenBindings(ctx, aggregator.get_bindings())
+
+        if spill is not None:
+            for partition in spill.partitions():
+                rows = (row for _, row in partition)
+                for x in _aggregateGroups(ctx, aggregations, group_expr, rows, depth + 1):
+                    yield x
+    finally:
+        if spill is not None:
+            spill.close()
+
+
 def evalOrderBy(ctx, part):
 
     res = evalPart(ctx, part.p)
@@ -357,15 +685,14 @@ def evalReduced(ctx, part):
     """
 
     # This implementation uses a most recently used strategy and a limited
-    # buffer size. It relates to a LRU caching algorithm:
+    # buffer size (REDUCED_BUFFER_SIZE). It relates to a LRU caching algorithm:
     # https://en.wikipedia.org/wiki/Cache_algorithms#Least_Recently_Used_.28LRU.29
-    MAX = 1
-    # TODO: add configuration or determine "best" size for most use cases
-    # 0: No reduction
-    # 1: compare only with the last row, almost no reduction with
-    #    unordered incoming rows
-    # N: The greater the buffer size the greater the reduction but more
-    #    memory and time are needed
+    MAX = REDUCED_BUFFER_SIZE
+
+    if not MAX:
+        for row in evalPart(ctx, part.p):
+            yield row
+        return
 
     # mixed data structure: set for lookup, deque for append/pop/remove
     mru_set = set()
@@ -387,13 +714,61 @@ def evalReduced(ctx, part):
 
 
 def evalDistinct(ctx, part):
+    """apply DISTINCT to result
+
+    Only a digest of every yielded solution is kept. If SPILL_THRESHOLD is set
+    and more distinct solutions were seen, the remaining solutions are written to
+    hash partitioned temporary files. These are deduplicated one at a time and
+    yielded afterwards in their original order.
+    """
     res = evalPart(ctx, part.p)
 
     done = set()
-    for x in res:
-        if x not in done:
+    spill = None
+
+    try:
+        for x in res:
+            key = _digest(x)
+            if key in done:
+                continue
+            if SPILL_THRESHOLD is not None and len(done) >= SPILL_THRESHOLD:
+                if spill is None:
+                    spill = SpillPartitions(ctx)
+                spill.add(key, x)
+                continue
             yield x
-            done.add(x)
+            done.add(key)
+
+        if spill is not None:
+            done.clear()
+            for x in _distinctSpilled(ctx, spill):
+                yield x
+    finally:
+        if spill is not None:
+            spill.close()
+
+
+def _distinctSpilled(ctx, spill):
+    # Duplicates always share a partition, so every partition is deduplicated on
+    # its own into a run. The runs are sorted by the position of the solutions
+    # and merged to restore the original order.
+    runs = []
+    try:
+        for partition in spill.partitions():
+            seen = set()
+            run = tempfile.TemporaryFile()
+            for seq, row in partition:
+                key = _digest(row)
+                if key not in seen:
+                    seen.add(key)
+                    _dump(run, seq, row)
+            runs.append(run)
+
+        for _, row in heapq.merge(*(_load(ctx, run) for run in runs), key=lambda x: x[0]):
+            yield row
+    finally:
+        for run in runs:
+            run.close()
 
 
 def evalProject(ctx, project):
@@ -406,7 +781,7 @@ def evalSelectQuery(ctx, query):
 
     res = {}
     res["type_"] = "SELECT"
-    res["bindings"] = evalPart(ctx, query.p)
+    res["bindings"] = _counted(evalPart(ctx, query.p))
     res["vars_"] = query.PV
     return res
 
@@ -431,7 +806,7 @@ def evalConstructQuery(ctx, query):
 
     graph = Graph()
 
-    for c in evalPart(ctx, query.p):
+    for c in _counted(evalPart(ctx, query.p)):
         graph += _fillTemplate(template, c)
 
     res = {}
@@ -488,3 +863,56 @@ def evalQuery(graph, query, initBindings, base=None):
             #     ctx.load(g, default=False)
 
     return evalPart(ctx, main)
+
+
+def explainQuery(query, profile=None):
+    """Render the algebra of a translated query as an indented operator tree.
+
+    If a QueryProfile is given, each operator is annotated with the statistics collected while
+    the query was evaluated.
+    """
+    lines = []
+    _explainPart(query.algebra, profile, 0, lines)
+    if profile is not None:
+        lines.append('')
+        lines.append('Total: {:.3f} ms'.format(profile.time * 1000))
+    return '\n'.join(lines) + '\n'
+
+
+def _explainPart(part, profile, depth, lines):
+    line = '  ' * depth + part.name
+    details = _describePart(part)
+    if details:
+        line += ' ' + details
+    if profile is not None:
+        stats = profile.get(part)
+        if stats is None:
+            line += '  (not evaluated)'
+        else:
+            line += '  (calls={}, rows={}, time={:.3f} ms, lookups={})'.format(
+                stats.calls, stats.rows, stats.time * 1000, stats.lookups)
+    lines.append(line)
+
+    for key, child in part.items():
+        if key in ('p', 'p1', 'p2') and isinstance(child, CompValue):
+            _explainPart(child, profile, depth + 1, lines)
+
+
+def _n3(term):
+    return term.n3() if hasattr(term, 'n3') else str(term)
+
+
+def _describePart(part):
+    if part.name == 'BGP':
+        return '{ ' + ' . '.join(' '.join(_n3(t) for t in triple) for triple in part.triples) + ' }'
+    elif part.name in ('SelectQuery', 'Project'):
+        return ' '.join(_n3(v) for v in part.PV)
+    elif part.name == 'Extend':
+        return _n3(part.var)
+    elif part.name == 'Graph':
+        return _n3(part.term)
+    elif part.name == 'Slice':
+        return 'start={} length={}'.format(part.start, part.length)
+    elif part.name == 'Join' and part.lazy:
+        return '(lazy)'
+    return None
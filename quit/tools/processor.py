@@ -5,6 +5,12 @@ from rdflib.plugins.sparql.parser import parseQuery, parseUpdate
 from quit.tools.algebra import translateQuery, translateUpdate
 from quit.tools.evaluate import evalQuery
 from quit.tools.update import evalUpdate
+from quit.helpers import preparedQueries
+
+
+def _ns_key(initNs):
+    return tuple(sorted((k, str(v)) for k, v in initNs.items()))
+
 
 class SPARQLUpdateProcessor(UpdateProcessor):
     def __init__(self, graph):
@@ -12,7 +18,9 @@ class SPARQLUpdateProcessor(UpdateProcessor):
 
     def update(self, strOrQuery, initBindings={}, initNs={}):
         if isinstance(strOrQuery, str):
-            strOrQuery=translateUpdate(parseUpdate(strOrQuery), initNs=initNs)
+            strOrQuery = preparedQueries.get(
+                ('update', strOrQuery, None, _ns_key(initNs)),
+                lambda: translateUpdate(parseUpdate(strOrQuery), initNs=initNs))
 
         return evalUpdate(self.graph, strOrQuery, initBindings)
 
@@ -32,8 +40,9 @@ class SPARQLProcessor(Processor):
         """
 
         if not isinstance(strOrQuery, Query):
-            parsetree = parseQuery(strOrQuery)
-            query = translateQuery(parsetree, base, initNs)
+            query = preparedQueries.get(
+                ('query', strOrQuery, base, _ns_key(initNs)),
+                lambda: translateQuery(parseQuery(strOrQuery), base, initNs))
         else:
             query = strOrQuery
 
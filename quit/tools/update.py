@@ -13,16 +13,22 @@ from rdflib.plugins.sparql.evalutils import _fillTemplate, _join
 from rdflib.plugins.sparql.evaluate import evalBGP, evalPart
 
 from collections import defaultdict
-from itertools import tee
 from quit.exceptions import UnSupportedQuery
 
 def _append(dct, identifier, action, items):
+    """Add the changes of a graph to the delta.
+
+    Consecutive changes with the same action are collected in one batch, so a template filled
+    for many solutions results in few large batches instead of one batch per solution.
+    """
     if items:
         if not isinstance(identifier, Node):
             identifier = URIRef(identifier)
-        changes = dct.get(identifier, [])
-        changes.append((action, items))
-        dct[identifier] = changes
+        changes = dct.setdefault(identifier, [])
+        if changes and changes[-1][0] == action:
+            changes[-1][1].extend(items)
+        else:
+            changes.append((action, list(items)))
 
 
 def _graphOrDefault(ctx, g):
@@ -188,14 +194,14 @@ def evalDeleteWhere(ctx, u):
 
     for c in _res:
         g = ctx.graph
-        filled, filled_delta = tee(_fillTemplate(u.triples, c))
-        _append(res["delta"], 'default', 'removals', list(filled_delta))
+        filled = list(_fillTemplate(u.triples, c))
+        _append(res["delta"], 'default', 'removals', filled)
         g -= filled
 
         for g in u.quads:
             cg = ctx.dataset.get_context(c.get(g))
-            filledq, filledq_delta = tee(_fillTemplate(u.quads[g], c))
-            _append(res["delta"], cg.identifier, 'removals', list(filledq_delta))
+            filledq = list(_fillTemplate(u.quads[g], c))
+            _append(res["delta"], cg.identifier, 'removals', filledq)
             cg -= filledq
 
     return res
@@ -260,25 +266,25 @@ def evalModify(ctx, u):
     for c in _res:
         dg = ctx.graph
         if u.delete:
-            filled, filled_delta = tee(_fillTemplate(u.delete.triples, c))
-            _append(res["delta"], graphName, 'removals', list(filled_delta))
+            filled = list(_fillTemplate(u.delete.triples, c))
+            _append(res["delta"], graphName, 'removals', filled)
             dg -= filled
 
             for g, q in u.delete.quads.items():
                 cg = ctx.dataset.get_context(c.get(g))
-                filledq, filledq_delta = tee(_fillTemplate(q, c))
-                _append(res["delta"], cg.identifier, 'removals', list(filledq_delta))
+                filledq = list(_fillTemplate(q, c))
+                _append(res["delta"], cg.identifier, 'removals', filledq)
                 cg -= filledq
 
         if u.insert:
-            filled, filled_delta = tee(_fillTemplate(u.insert.triples, c))
-            _append(res["delta"], graphName, 'additions', list(filled_delta))
+            filled = list(_fillTemplate(u.insert.triples, c))
+            _append(res["delta"], graphName, 'additions', filled)
             dg += filled
 
             for g, q in u.insert.quads.items():
                 cg = ctx.dataset.get_context(c.get(g))
-                filledq, filledq_delta = tee(_fillTemplate(q, c))
-                _append(res["delta"], cg.identifier, 'additions', list(filledq_delta))
+                filledq = list(_fillTemplate(q, c))
+                _append(res["delta"], cg.identifier, 'additions', filledq)
                 cg += filledq
 
     return res
@@ -101,6 +101,23 @@ def feature_required(feature):
     return wrapper
 
 
+def count_argument(value):
+    """Parse a limit or offset parameter, None if it is not given.
+
+    Raises:
+        ValueError if the value is no non-negative integer
+    """
+    if not value:
+        return None
+    try:
+        count = int(value)
+    except ValueError:
+        count = -1
+    if count < 0:
+        raise ValueError('limit and offset have to be non-negative integers')
+    return count
+
+
 def create_app(arguments):
     """Create a Flask app."""
 
@@ -142,6 +159,12 @@ def register_app(app, arguments):
 
     app.config['quit'] = quit
     app.config['blame'] = Blame(quit)
+    app.config['query_budget'] = {
+        'sparql': (arguments['query_timeout'], arguments['query_result_limit']),
+        'provenance': (arguments['provenance_query_timeout'],
+                       arguments['provenance_query_result_limit'])
+    }
+    app.config['upload_limit'] = arguments['upload_limit']
     register(QUIT.service, quit.store.store)
 
 
@@ -8,6 +8,15 @@ MIT License
 """
 
 import json
+import threading
+
+from itertools import islice
+from quit.cache import Cache
+
+# Layouts of the commit graph by the id of the tip commit, each a list of the nodes laid out so
+# far and the generator of the following nodes
+_layouts = Cache(capacity=16)
+_lock = threading.Lock()
 
 
 class CommitGraph(object):
@@ -19,13 +28,50 @@ class CommitGraph(object):
     def gets(cls, commits):
         return [cls(c.id, [p.id for p in c.parents]) for c in commits]
 
+    @classmethod
+    def iter(cls, commits):
+        return (cls(c.id, [p.id for p in c.parents]) for c in commits)
+
 
 def generate_graph_data(commits):
-    """Generate graph data.
+    """Generate graph data as json string, see generate_graph_layout."""
+    return json.dumps(generate_graph_layout(commits))
+
+
+def cached_graph_layout(tip, commits, count):
+    """Get the graph layout of the first count commits of the history of a tip commit.
+
+    The layout only depends on the history of the tip, so it is cached by the tip commit id.
+    Commits are laid out from the tip downwards, so only the first count commits are laid out
+    and a later call for more commits continues where the previous one stopped.
 
-    :param commits: a list of commit, which should have
+    :param tip: the id of the tip commit
+    :param commits: a callable returning an iterator of the commits of the history, only called
+        on a cache miss
+    :param count: the number of commits to lay out
+    """
+    with _lock:
+        try:
+            nodes, layout = _layouts.get(tip)
+        except KeyError:
+            nodes, layout = [], iter_graph_layout(commits())
+            _layouts.set(tip, (nodes, layout))
+        if len(nodes) < count:
+            nodes.extend(islice(layout, count - len(nodes)))
+        return nodes[:count]
+
+
+def generate_graph_layout(commits):
+    """Generate graph data, see iter_graph_layout."""
+    return list(iter_graph_layout(commits))
+
+
+def iter_graph_layout(commits):
+    """Generate graph data node by node.
+
+    :param commits: an iterable of commits, which should have
         `sha`, `parents` properties.
-    :returns: data nodes, a json list of
+    :returns: an iterator of data nodes, each a
         [
           sha,
           [offset, branch], //dot
@@ -37,7 +83,6 @@ def generate_graph_data(commits):
         ],  // node
     """
 
-    nodes = []
     branch_idx = [0]
     reserve = []
     branches = {}
@@ -80,13 +125,10 @@ def generate_graph_data(commits):
                 routes.append([offset, reserve.index(other_branch),
                                other_branch])
 
-        node = _make_node(commit.sha,
-                          offset,
-                          branch,
-                          routes)
-        nodes.append(node)
-
-    return json.dumps(nodes)
+        yield _make_node(commit.sha,
+                         offset,
+                         branch,
+                         routes)
 
 
 def _make_node(sha, offset, branch, routes):
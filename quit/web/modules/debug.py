@@ -1,15 +1,22 @@
+import json
 import traceback
 
 from werkzeug.http import parse_accept_header
 from flask import Blueprint, request, current_app, make_response
+from rdflib import URIRef
 from quit.conf import Feature
-from quit.web.app import render_template, feature_required
+from quit.helpers import preparedQueries
+from quit.web.app import render_template, feature_required, count_argument
 
 __all__ = ('debug')
 
 debug = Blueprint('debug', __name__)
 
 
+def _uri(value):
+    return URIRef(value) if value else None
+
+
 @debug.route("/blame", defaults={'branch_or_ref': None}, methods=['GET'])
 @debug.route("/blame/<branch_or_ref>", methods=['GET'])
 @feature_required(Feature.Provenance)
@@ -28,7 +35,18 @@ def blame(branch_or_ref):
         mimetype = 'application/sparql-results+json'
 
     try:
-        res = blame.run(branch_or_ref=branch_or_ref)
+        limit = count_argument(request.values.get('limit', None))
+        offset = count_argument(request.values.get('offset', None)) or 0
+    except ValueError as e:
+        return make_response(str(e), 400)
+
+    try:
+        res = blame.run(branch_or_ref=branch_or_ref,
+                        engine=request.values.get('engine', 'index'),
+                        graph=_uri(request.values.get('graph', None)),
+                        subject=_uri(request.values.get('subject', None)),
+                        predicate=_uri(request.values.get('predicate', None)),
+                        limit=limit, offset=offset)
 
         if mimetype in ['text/html', 'application/xhtml_xml', '*/*']:
             results = [{'commit': quit.repository.revision(
@@ -55,3 +73,11 @@ def blame(branch_or_ref):
         current_app.logger.error(e)
         current_app.logger.error(traceback.format_exc())
         return "<pre>" + traceback.format_exc() + "</pre>", 400
+
+
+@debug.route("/stats", methods=['GET'])
+def stats():
+    """Return counters of the internal caches as JSON."""
+    response = make_response(json.dumps({'preparedQueries': preparedQueries.stats}), 200)
+    response.headers['Content-Type'] = 'application/json'
+    return response
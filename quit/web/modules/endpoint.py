@@ -1,14 +1,17 @@
 import traceback
 
 import logging
-from flask import Blueprint, request, current_app, make_response
-from rdflib import ConjunctiveGraph
+from flask import Blueprint, Response, request, current_app, make_response
+from rdflib import ConjunctiveGraph, Graph, URIRef
 from quit.conf import Feature
 from quit import helpers as helpers
-from quit.helpers import parse_sparql_request, parse_query_type
+from quit.bulk import BulkExport, BulkImport, GraphStore, parse_statements
+from quit.helpers import isAbsoluteUri, parse_sparql_request, parse_query_type
 from quit.web.app import render_template, feature_required
 from quit.exceptions import UnSupportedQuery, SparqlProtocolError, NonAbsoluteBaseError
-from quit.exceptions import FromNamedError, QuitMergeConflict, RevisionNotFound
+from quit.exceptions import FromNamedError, QuitMergeConflict, RevisionNotFound, QueryTimeout
+from quit.exceptions import BulkImportError, UploadTooLarge
+from quit.tools.evaluate import QueryBudget, QueryProfile, explainQuery
 import datetime
 import uuid
 import base64
@@ -28,6 +31,10 @@ resultSetMimetypes = ['application/sparql-results+xml', 'application/xml',
 askMimetypes = ['application/sparql-results+xml', 'application/xml',
                 'application/sparql-results+json', 'application/json', 'text/html',
                 'application/xhtml+xml']
+importMimetypes = ['application/n-triples', 'application/n-quads', 'text/plain']
+exportMimetypes = {'application/n-quads': 'nquads', 'application/trig': 'trig'}
+graphStoreMimetypes = {'application/n-triples': 'nt', 'text/plain': 'nt', 'text/turtle': 'turtle',
+                       'application/x-turtle': 'turtle', 'application/rdf+xml': 'xml'}
 rdfMimetypes = ['text/turtle', 'application/x-turtle', 'application/rdf+xml', 'application/xml',
                 'application/n-triples', 'application/trig', 'application/ld+json',
                 'application/json']
@@ -38,6 +45,10 @@ rdfMimetypes = ['text/turtle', 'application/x-turtle', 'application/rdf+xml', 'a
 def sparql(branch_or_ref):
     """Process a SPARQL query (Select or Update).
 
+    With the parameter "explain" the operator tree of a query is returned instead of its result,
+    with "profile" the query is evaluated and the tree is annotated with the row counts, wall
+    time and triple pattern lookups of each operator.
+
     Returns:
         HTTP Response with query result: If query was a valid select query.
         HTTP Response 200: If request contained a valid update query.
@@ -116,8 +127,7 @@ def sparql(branch_or_ref):
                         quit.repository.merge(target=branch_or_ref, branch=target_ref)
                         oid = quit.repository.revision(branch_or_ref).id
                         # delete temporary branch
-                        tmp_branch = quit.repository._repository.branches.get(target_branch)
-                        tmp_branch.delete()
+                        quit.repository.delete_branch(target_branch)
                         response = make_response('success', 200)
                         target_branch = branch_or_ref
                     except QuitMergeConflict:
@@ -156,19 +166,31 @@ def sparql(branch_or_ref):
             logger.exception(e)
             return make_response('No branch or reference given.', 400)
 
+        explain = 'explain' in request.values or 'profile' in request.values
+        if explain:
+            mimetype = 'text/plain'
+        else:
+            mimetype = _getBestMatchingMimeType(request, queryType)
+
+        if not mimetype:
+            return make_response("Mimetype: {} not acceptable".format(mimetype), 406)
+
         try:
-            res = graph.query(parsedQuery)
+            with QueryBudget(*current_app.config['query_budget']['sparql']):
+                if explain:
+                    response = create_explain_response(
+                        graph, parsedQuery, 'profile' in request.values)
+                else:
+                    res = graph.query(parsedQuery)
+                    response = create_result_response(res, mimetype)
         except FromNamedError:
             return make_response('FROM NAMED not supported, yet', 400)
         except UnSupportedQuery:
             return make_response('Unsupported Query', 400)
+        except QueryTimeout as e:
+            logger.info(e)
+            return make_response(str(e), 503)
 
-        mimetype = _getBestMatchingMimeType(request, queryType)
-
-        if not mimetype:
-            return make_response("Mimetype: {} not acceptable".format(mimetype), 406)
-
-        response = create_result_response(res, mimetype)
         if branch_or_ref:
             response.headers["X-CurrentBranch"] = branch_or_ref
         if commitid:
@@ -212,14 +234,18 @@ def provenance():
         if queryType not in ['SelectQuery', 'AskQuery', 'ConstructQuery', 'DescribeQuery']:
             return make_response('Unsupported Query Type', 400)
 
-        res = graph.query(query)
-
         mimetype = _getBestMatchingMimeType(request, queryType)
 
         if not mimetype:
             return make_response("Mimetype: {} not acceptable".format(mimetype), 406)
 
-        return create_result_response(res, mimetype)
+        try:
+            with QueryBudget(*current_app.config['query_budget']['provenance']):
+                res = graph.query(parsedQuery)
+                return create_result_response(res, mimetype)
+        except QueryTimeout as e:
+            logger.info(e)
+            return make_response(str(e), 503)
     else:
         if request.accept_mimetypes.best_match(['text/html']) == 'text/html':
             return render_template('sparql.html', mode='provenance')
@@ -252,7 +278,30 @@ def create_result_response(res, mimetype):
     return response
 
 
-def edit_store(quit, branch_or_ref, ref, method, args, body, graph):
+def create_explain_response(graph, parsedQuery, profile=False):
+    """Create a plain text response with the (profiled) operator tree of a query."""
+    if profile:
+        with QueryProfile() as stats:
+            for _ in graph.query(parsedQuery):
+                pass
+        body = explainQuery(parsedQuery, stats)
+    else:
+        body = explainQuery(parsedQuery)
+
+    response = make_response(body, 200)
+    response.headers['Content-Type'] = 'text/plain'
+    return response
+
+
+def edit_store(quit, branch_or_ref, ref, method, args, body, graph, commitid=None):
+    """Read or change the statements of a graph instance.
+
+    POST adds the uploaded statements, PUT replaces all statements (of the context given in args)
+    with them and DELETE removes the statements matching args. The body is an iterable of N-Quads
+    lines which is parsed while it is read. Only the statements which are actually added or
+    removed are part of the delta that is committed with Quit.commit. If the change cannot be
+    committed, the dataset of commitid, which graph was built for, is discarded.
+    """
 
     def get_where(graph, args):
         s, p, o, c = _spoc(args)
@@ -262,66 +311,112 @@ def edit_store(quit, branch_or_ref, ref, method, args, body, graph):
         for subgraph in (
             x for x in graph.store.contexts((s, p, o)) if c is None or x.identifier == c
         ):
-            result.addN((s, p, o, subgraph.identifier)
-                        for s, p, o in subgraph.triples((None, None, None)))
+            result.addN(triple + (subgraph.identifier,) for triple in subgraph.triples((s, p, o)))
         return result
 
-    def copy_where(target, graph, args):
+    def remove_where(dataset, delta, args):
+        """Add the removals of the matching statements to delta."""
         s, p, o, c = _spoc(args)
 
-        for subgraph in (x for x in graph.contexts()):
-            target.store.addN((s, p, o, subgraph.identifier)
-                              for s, p, o in subgraph.triples((None, None, None)))
+        for subgraph in dataset.contexts():
+            if c is not None and subgraph.identifier != c:
+                continue
+            triples = list(subgraph.triples((s, p, o)))
+            if triples:
+                delta.setdefault(subgraph.identifier, []).append(('removals', triples))
 
-    def remove_where(graph, args):
-        s, p, o, c = _spoc(args)
-        graph.store.remove((s, p, o, c))
+    def uploaded(args):
+        """Return a dict of the graphs to the sets of uploaded statements."""
+        _, _, _, c = _spoc(args)
 
-    def clear_where(graph, args):
+        statements = {}
+        for s, p, o, context in parse_statements(body, c):
+            statements.setdefault(context, set()).add((s, p, o))
+        return statements
+
+    def add_where(dataset, delta, args):
+        """Add the additions of the uploaded statements which are not in the dataset to delta."""
+        for context, triples in uploaded(args).items():
+            existing = dataset.get_context(context)
+            additions = [triple for triple in triples if triple not in existing]
+            if additions:
+                delta.setdefault(context, []).append(('additions', additions))
+
+    def replace_where(dataset, delta, args):
+        """Add the difference of the graphs (of the context in args) to the upload to delta.
+
+        Raises:
+            BulkImportError if a context is given in args and a statement is in another graph
+        """
         _, _, _, c = _spoc(args)
-        graph.store.remove_context(c)
+        statements = uploaded(args)
+
+        if c is not None and set(statements.keys()) - {c}:
+            raise BulkImportError('Only statements of the graph {} can replace it'.format(c))
+
+        contexts = set(statements.keys())
+        contexts.update(subgraph.identifier for subgraph in dataset.contexts()
+                        if c is None or subgraph.identifier == c)
+        for context in contexts:
+            existing = dataset.get_context(context)
+            triples = statements.get(context, set())
+            removals = [triple for triple in existing if triple not in triples]
+            additions = [triple for triple in triples if triple not in existing]
+            if removals:
+                delta.setdefault(context, []).append(('removals', removals))
+            if additions:
+                delta.setdefault(context, []).append(('additions', additions))
+
+    def apply(dataset, delta):
+        for context, changes in delta.items():
+            target = dataset.get_context(context)
+            for op, triples in changes:
+                for triple in triples:
+                    if op == 'additions':
+                        target.add(triple)
+                    else:
+                        target.remove(triple)
 
     def _spoc(args):
-        from rdflib import URIRef
-        s = args.get('subj', None)
-        p = args.get('pred', None)
-        o = args.get('obj', None)
-        c = args.get('context', None)
-        if c:
-            c = URIRef(c)
-        return s, p, o, c
+        s, p, o, c = (args.get(key, None) for key in ['subj', 'pred', 'obj', 'context'])
+        return tuple(URIRef(term) if term else None for term in (s, p, o, c))
 
     try:
         if method in ['GET', 'HEAD']:
             headers = {"Content-type": 'application/n-quads'}
             response = (200, headers, get_where(graph, args).serialize(format='nquads'))
 
-        elif method == 'DELETE':
-            remove_where(graph, args)
-            response = (200, dict(), None)
-
-            quit.commit(graph, 'New Commit from QuitStore', branch_or_ref, ref)
-
-        elif method in ['POST', 'PUT']:
-
-            data = ConjunctiveGraph()
-            data.parse(data=body, format="nquads")
-
-            if method == 'POST':
-                copy_where(graph, data, args)
-                response = (200, dict(), None)
+        elif method in ['POST', 'PUT', 'DELETE']:
+            # The delta is complete before the instance is changed, so an invalid upload does
+            # not leave the instance half way changed
+            delta = {}
 
+            if method == 'DELETE':
+                remove_where(graph.store, delta, args)
             elif method == 'PUT':
-                clear_where(graph, args)
-                copy_where(graph, data, args)
-                response = (200, dict(), None)
+                replace_where(graph.store, delta, args)
+            else:
+                add_where(graph.store, delta, args)
 
-            quit.commit(graph, 'New Commit from QuitStore', branch_or_ref, ref)
+            if delta:
+                type = {'DELETE': 'DELETE', 'PUT': 'MODIFY', 'POST': 'INSERT'}[method]
+                try:
+                    apply(graph.store, delta)
+                    quit.commit(graph, [{'type': type, 'delta': delta}],
+                                'New Commit from QuitStore', branch_or_ref, ref)
+                except Exception:
+                    quit.discardChanges(commitid)
+                    raise
+            response = (200, dict(), None)
 
         else:
             response = (405, {"Allow": "GET, HEAD, POST, PUT, DELETE"},
                         "Method %s not supported" % method)
 
+    except UploadTooLarge as e:
+        response = (413, dict(), str(e))
+    except BulkImportError as e:
+        response = (400, dict(), str(e))
     except Exception as e:
         logger.exception(e)
         response = (400, dict(), "<pre>{}</pre>".format(traceback.format_exc()))
@@ -329,6 +424,29 @@ def edit_store(quit, branch_or_ref, ref, method, args, body, graph):
     return response
 
 
+def _limited(stream, limit):
+    """Yield the lines of a binary stream, but raise UploadTooLarge after limit bytes."""
+    size = 0
+    for line in stream:
+        size += len(line)
+        if limit is not None and size > limit:
+            raise UploadTooLarge('The request body exceeds {} bytes'.format(limit))
+        yield line
+
+
+def _body():
+    """Return the lines of the request body, which are limited to the configured upload limit.
+
+    Raises:
+        UploadTooLarge if the announced length of the body exceeds the limit, the lines raise it
+            once the limit is exceeded while they are read
+    """
+    limit = current_app.config['upload_limit']
+    if limit is not None and (request.content_length or 0) > limit:
+        raise UploadTooLarge('The request body exceeds {} bytes'.format(limit))
+    return _limited(request.stream, limit)
+
+
 @endpoint.route(
     "/statements", defaults={'branch_or_ref': None},
     methods=['GET', 'POST', 'PUT', 'DELETE']
@@ -337,7 +455,7 @@ def edit_store(quit, branch_or_ref, ref, method, args, body, graph):
 def statements(branch_or_ref):
 
     quit = current_app.config['quit']
-    default_branch = quit.config.getDefaultBranch()
+    default_branch = quit.getDefaultBranch()
 
     if not branch_or_ref and not quit.repository.is_empty:
         branch_or_ref = default_branch
@@ -347,7 +465,11 @@ def statements(branch_or_ref):
 
     method = request.method
     args = request.args
-    body = request.data.decode('utf-8')
+
+    try:
+        body = _body()
+    except UploadTooLarge as e:
+        return make_response(str(e), 413)
 
     graph, commitid = quit.instance(branch_or_ref)
 
@@ -358,7 +480,8 @@ def statements(branch_or_ref):
         method=method,
         args=args,
         body=body,
-        graph=graph
+        graph=graph,
+        commitid=commitid
     )
     code, headers, body = result
 
@@ -368,3 +491,173 @@ def statements(branch_or_ref):
     if commitid:
         response.headers["X-CurrentCommit"] = commitid
     return response
+
+
+@endpoint.route("/import/<path:branch>", methods=['POST'])
+def bulk_import(branch):
+    """Import N-Triples or N-Quads into a branch with a single commit.
+
+    The statements are written to the graph files directly instead of being evaluated as SPARQL
+    Update. The parameter "graph" gives the graph of triples and of quads without a graph label,
+    "message" the commit message.
+
+    Returns:
+        HTTP Response 200: If the statements were imported.
+        HTTP Response 400: If a statement is invalid or no graph is known for a triple.
+        HTTP Response 404: If the branch does not exist.
+        HTTP Response 413: If the request body exceeds the upload limit.
+        HTTP Response 415: If the request is no N-Triples or N-Quads document.
+    """
+    quit = current_app.config['quit']
+
+    if request.mimetype not in importMimetypes:
+        return make_response("Mimetype: {} not supported".format(request.mimetype), 415)
+
+    graph = request.args.get('graph', None)
+    if graph is not None and not isAbsoluteUri(graph):
+        return make_response('The graph has to be an absolute http(s) URI', 400)
+
+    try:
+        oid, count = BulkImport(quit).run(
+            _body(), branch, graph, request.args.get('message', None))
+    except UploadTooLarge as e:
+        return make_response(str(e), 413)
+    except BulkImportError as e:
+        return make_response(str(e), 400)
+    except RevisionNotFound as e:
+        return make_response(str(e), 404)
+
+    response = make_response('{} statements imported'.format(count), 200)
+    response.headers['Content-Type'] = 'text/plain'
+    response.headers["X-CurrentBranch"] = branch
+    if oid is not None:
+        response.headers["X-CurrentCommit"] = oid
+    return response
+
+
+@endpoint.route("/export", defaults={'branch_or_ref': None}, methods=['GET'])
+@endpoint.route("/export/<path:branch_or_ref>", methods=['GET'])
+def bulk_export(branch_or_ref):
+    """Stream all statements of a commit as N-Quads or TriG.
+
+    The format is negotiated with the Accept header or given with the parameter "format"
+    ("nquads" or "trig"), N-Quads is the default.
+
+    Returns:
+        HTTP Response 200: With the statements.
+        HTTP Response 400: If the format is unknown.
+        HTTP Response 404: If the branch or commit does not exist.
+    """
+    quit = current_app.config['quit']
+
+    if not branch_or_ref:
+        if quit.repository.is_empty:
+            return make_response('The repository is empty', 404)
+        branch_or_ref = quit.getDefaultBranch()
+
+    format = request.args.get('format', None)
+    if format is None:
+        mimetype = request.accept_mimetypes.best_match(exportMimetypes.keys(),
+                                                       'application/n-quads')
+        format = exportMimetypes[mimetype]
+    mimetype = {value: key for key, value in exportMimetypes.items()}.get(format)
+
+    try:
+        commit = quit.repository.revision(branch_or_ref)
+        chunks = BulkExport(quit).run(commit, format)
+    except RevisionNotFound as e:
+        return make_response(str(e), 404)
+    except ValueError as e:
+        return make_response(str(e), 400)
+
+    response = Response(chunks, mimetype=mimetype)
+    response.headers["X-CurrentCommit"] = commit.id
+    return response
+
+
+@endpoint.route("/graph-store", defaults={'branch_or_ref': None},
+                methods=['GET', 'HEAD', 'PUT', 'POST', 'DELETE'])
+@endpoint.route("/graph-store/<path:branch_or_ref>",
+                methods=['GET', 'HEAD', 'PUT', 'POST', 'DELETE'])
+def graph_store(branch_or_ref):
+    """Read and write a graph like the SPARQL 1.1 Graph Store HTTP Protocol.
+
+    The parameter "graph" gives the graph, which is read from or written to its file directly.
+    GET returns the file as N-Triples, PUT replaces and POST extends the graph with the uploaded
+    statements and DELETE removes the graph. Writes need a branch, "message" sets the commit
+    message. N-Triples uploads are parsed while they are read.
+
+    Returns:
+        HTTP Response 200: With the statements of the graph.
+        HTTP Response 201: If a graph was created.
+        HTTP Response 204: If a graph was changed or deleted.
+        HTTP Response 400: If no graph is given or a statement is invalid.
+        HTTP Response 404: If the graph, branch or commit does not exist.
+        HTTP Response 413: If the request body exceeds the upload limit.
+        HTTP Response 415: If the uploaded format is not supported.
+    """
+    quit = current_app.config['quit']
+    if not branch_or_ref:
+        branch_or_ref = quit.getDefaultBranch()
+
+    graph = request.args.get('graph', None)
+    if 'default' in request.args:
+        return make_response('The default graph is not supported', 400)
+    if graph is None or not isAbsoluteUri(graph):
+        return make_response('The graph has to be an absolute http(s) URI', 400)
+    graph = URIRef(graph)
+
+    store = GraphStore(quit)
+    message = request.args.get('message', None)
+
+    try:
+        if request.method in ['GET', 'HEAD']:
+            if quit.repository.is_empty:
+                return make_response('The repository is empty', 404)
+            commit = quit.repository.revision(branch_or_ref)
+            chunks = store.get(commit, graph)
+            if chunks is None:
+                return make_response('Graph {} not found'.format(graph), 404)
+            response = Response(chunks, mimetype='application/n-triples')
+            response.headers["X-CurrentCommit"] = commit.id
+            return response
+
+        if request.method == 'DELETE':
+            oid = store.delete(branch_or_ref, graph, message)
+            if oid is None:
+                return make_response('Graph {} not found'.format(graph), 404)
+            status = 204
+        else:
+            format = graphStoreMimetypes.get(request.mimetype, None)
+            if format is None:
+                return make_response("Mimetype: {} not supported".format(request.mimetype), 415)
+            if format == 'nt':
+                statements = parse_statements(_body(), graph)
+            else:
+                data = b''.join(_body())
+                try:
+                    triples = Graph().parse(data=data, format=format)
+                except Exception as e:
+                    return make_response('Invalid {} document: {}'.format(request.mimetype, e),
+                                         400)
+                statements = ((s, p, o, graph) for s, p, o in triples)
+
+            status = 204 if store.exists(branch_or_ref, graph) else 201
+            if request.method == 'PUT':
+                oid = store.put(statements, branch_or_ref, graph, message)
+            else:
+                oid = store.post(statements, branch_or_ref, graph, message)
+            if oid is None:
+                status = 204
+    except UploadTooLarge as e:
+        return make_response(str(e), 413)
+    except BulkImportError as e:
+        return make_response(str(e), 400)
+    except RevisionNotFound as e:
+        return make_response(str(e), 404)
+
+    response = make_response('', status)
+    response.headers["X-CurrentBranch"] = branch_or_ref
+    if oid is not None:
+        response.headers["X-CurrentCommit"] = oid
+    return response
@@ -1,22 +1,49 @@
 import traceback
 import pygit2
 
-from flask import Blueprint, request, current_app, make_response
+from flask import Blueprint, Response, request, current_app, make_response
 from werkzeug.http import parse_accept_header
-from quit.web.app import render_template
-from quit.web.extras.commits_graph import CommitGraph, generate_graph_data
-from quit.exceptions import QuitMergeConflict
+from quit.web.app import render_template, count_argument
+from quit.web.extras.commits_graph import CommitGraph, cached_graph_layout
+from quit.exceptions import QuitMergeConflict, RevisionNotFound
 from quit.utils import git_timestamp
 from quit.web.modules.application import isLoggedIn, githubEnabled
 import json
 import logging
+import queue
 import re
 
+from itertools import islice
+
 logger = logging.getLogger('quit.web.modules.git')
 __all__ = ('git')
 
 git = Blueprint('git', __name__)
 
+# seconds after which an idle event stream sends a comment to keep the connection open
+keepAliveInterval = 15
+
+
+def _page(revisions, since=None, offset=0, limit=None):
+    """Get a page of the lazily iterated revisions.
+
+    The page starts offset revisions after the revision with the id since (or the first revision)
+    and contains at most limit revisions. Only the revisions up to the end of the page are
+    iterated.
+
+    Returns:
+    The position of the first revision of the page and the list of revisions of the page
+    """
+    position = 0
+    if since:
+        for position, revision in enumerate(revisions, 1):
+            if revision.id == since:
+                break
+        else:
+            raise RevisionNotFound(since)
+    page = list(islice(revisions, offset, None if limit is None else offset + limit))
+    return position + offset, page
+
 
 @git.route("/commits", defaults={'branch_or_ref': None}, methods=['GET'])
 @git.route("/commits/<path:branch_or_ref>", methods=['GET'])
@@ -24,8 +51,12 @@ def commits(branch_or_ref):
     """
     Lists all commits of a given git branch.
 
+    The list can be paginated with the parameters "limit" and "offset" and with "since", the id
+    of the last commit of the previous page.
+
     Returns:
     HTTP Response 200: a list of commits
+    HTTP Response 400: limit or offset is no non-negative integer
     HTTP Response 403: unknown branch or ref
     HTTP Response 406: Unsupported Mimetype requested
     """
@@ -35,11 +66,22 @@ def commits(branch_or_ref):
         branch_or_ref = quit.getDefaultBranch()
 
     try:
+        limit = count_argument(request.values.get('limit', None))
+        offset = count_argument(request.values.get('offset', None)) or 0
+    except ValueError as e:
+        return make_response(str(e), 400)
+
+    try:
+        since = request.values.get('since', None)
+
         current_app.logger.debug(branch_or_ref)
         if not quit.repository.is_empty:
-            results = quit.repository.revisions(branch_or_ref, order=pygit2.GIT_SORT_TIME)
+            if since:
+                since = quit.repository.revision(since).id
+            revisions = quit.repository.iter_revisions(branch_or_ref, order=pygit2.GIT_SORT_TIME)
+            position, results = _page(revisions, since, offset, limit)
         else:
-            results = []
+            position, results = 0, []
 
         if 'Accept' in request.headers:
             mimetype = parse_accept_header(request.headers['Accept']).best
@@ -47,9 +89,20 @@ def commits(branch_or_ref):
             mimetype = '*/*'
 
         if mimetype in ['text/html', 'application/xhtml_xml', '*/*']:
-            data = generate_graph_data(CommitGraph.gets(results))
-            response = make_response(render_template('commits.html', results=results, data=data,
+            data = []
+            next_since = None
+            if results:
+                tip = str(quit.repository.lookup(branch_or_ref))
+                layout = cached_graph_layout(tip, lambda: CommitGraph.iter(
+                    quit.repository.iter_revisions(branch_or_ref, order=pygit2.GIT_SORT_TIME)),
+                    position + len(results))
+                data = layout[position:]
+                if limit is not None and len(results) == limit:
+                    next_since = results[-1].id
+            response = make_response(render_template('commits.html', results=results,
+                                                     data=json.dumps(data),
                                                      current_ref=branch_or_ref,
+                                                     next_since=next_since, limit=limit,
                                                      isLoggedIn=isLoggedIn,
                                                      githubEnabled=githubEnabled))
             response.headers['Content-Type'] = 'text/html'
@@ -341,9 +394,7 @@ def del_branch(refspec):
 
         refspec = re.sub("^refs/heads/", "", refspec)
 
-        branch = quit.repository._repository.branches.get(refspec)
-        if branch:
-            branch.delete()
+        if quit.repository.delete_branch(refspec):
             message = "{} deleted".format(refspec)
             status = 200
         else:
@@ -380,3 +431,44 @@ def revert(branch_or_ref):
         current_app.logger.error(e)
         current_app.logger.error(traceback.format_exc())
         return "<pre>" + traceback.format_exc() + "</pre>", 400
+
+
+@git.route("/events", methods=['GET'])
+def events():
+    """Stream the changes of references as Server-Sent Events.
+
+    Every moved, created or deleted reference is sent as an event of the type "ref" with a JSON
+    object of the reference ("ref") and the commit ids before ("old") and after ("new") the
+    change as data. The parameter "ref" restricts the events to references starting with it.
+
+    Returns:
+    HTTP Response 200: The event stream
+    """
+    repository = current_app.config['quit'].repository
+    prefix = request.args.get('ref', '')
+
+    def stream():
+        changes = queue.Queue()
+
+        def listener(ref, old, new):
+            if ref.startswith(prefix):
+                changes.put((ref, old, new))
+
+        repository.subscribe(listener)
+        try:
+            yield ': connected\n\n'
+            while True:
+                try:
+                    ref, old, new = changes.get(timeout=keepAliveInterval)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                yield 'event: ref\ndata: {}\n\n'.format(
+                    json.dumps({'ref': ref, 'old': old, 'new': new}))
+        finally:
+            repository.unsubscribe(listener)
+
+    response = Response(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
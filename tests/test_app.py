@@ -5,7 +5,12 @@ from os import path
 from urllib.parse import quote_plus
 from datetime import datetime
 from pygit2 import GIT_SORT_TOPOLOGICAL, Signature, GIT_OBJ_BLOB
+from rdflib import URIRef
+from quit.cache import CompactFileReference
+from quit.web.extras.commits_graph import CommitGraph, cached_graph_layout, generate_graph_layout
+from quit.web.extras.commits_graph import _layouts
 from quit.conf import Feature
+from quit.exceptions import RevisionNotFound
 import quit.application as quitApp
 from quit.web.app import create_app
 import unittest
@@ -796,6 +801,331 @@ class QuitAppTestCase(unittest.TestCase):
                 # compare lists (without date)
                 assertResultBindingsEqual(self, [expected], resultBindings, queryVariables)
 
+    def testBlameAfterUpdate(self):
+        """Test that blame attributes each quad to the commit that introduced it."""
+        graphContent = """
+            <http://ex.org/x> <http://ex.org/y> <http://ex.org/z> .
+            <http://ex.org/a> <http://ex.org/b> <http://ex.org/c> ."""
+        with TemporaryRepositoryFactory().withGraph("http://example.org/", graphContent) as repo:
+            args = quitApp.getDefaults()
+            args['targetdir'] = repo.workdir
+            args['features'] = Feature.Provenance
+            app = create_app(args).test_client()
+
+            initial = str(repo.revparse_single('HEAD').id)
+
+            update = """DELETE DATA { GRAPH <http://example.org/> {
+                <http://ex.org/a> <http://ex.org/b> <http://ex.org/c> } };
+                INSERT DATA { GRAPH <http://example.org/> {
+                <http://ex.org/1> <http://ex.org/2> <http://ex.org/3> } }"""
+            response = app.post('/sparql', data=dict(update=update))
+            self.assertEqual(response.status, '200 OK')
+            second = response.headers['X-CurrentCommit']
+
+            for engine in ['index', 'history']:
+                for apiPath, expected in [(initial, {'http://ex.org/x': initial,
+                                                     'http://ex.org/a': initial}),
+                                          (second, {'http://ex.org/x': initial,
+                                                    'http://ex.org/1': second})]:
+                    response = app.get('/blame/{}?engine={}'.format(apiPath, engine),
+                                       headers={'Accept': 'application/sparql-results+json'})
+                    bindings = json.loads(response.data.decode("utf-8"))['results']['bindings']
+                    self.assertEqual(
+                        {row['s']['value']: row['hex']['value'] for row in bindings}, expected)
+                    self.assertEqual(
+                        {row['context']['value'] for row in bindings}, {'http://example.org/'})
+
+            response = app.get('/blame/{}?engine=foobar'.format(second))
+            self.assertEqual(response.status, '400 BAD REQUEST')
+
+    def testGraphConfigIsShared(self):
+        """Test that commits with the same graph files share their graph configuration."""
+        with TemporaryRepositoryFactory().withGraph("http://example.org/") as repo:
+            args = quitApp.getDefaults()
+            args['targetdir'] = repo.workdir
+            app = create_app(args)
+            client = app.test_client()
+            quit = app.config['quit']
+
+            initial = str(repo.revparse_single('HEAD').id)
+
+            update = """INSERT DATA { GRAPH <http://example.org/> {
+                <http://ex.org/a> <http://ex.org/b> <http://ex.org/c> } }"""
+            response = client.post('/sparql', data=dict(update=update))
+            second = response.headers['X-CurrentCommit']
+
+            update = """INSERT DATA { GRAPH <http://aksw.org/> {
+                <http://ex.org/a> <http://ex.org/b> <http://ex.org/c> } }"""
+            response = client.post('/sparql', data=dict(update=update))
+            third = response.headers['X-CurrentCommit']
+
+            self.assertIs(quit.getGraphConfig(initial), quit.getGraphConfig(second))
+            self.assertIsNot(quit.getGraphConfig(second), quit.getGraphConfig(third))
+            self.assertEqual(len(quit.getGraphConfig(second).getgraphs()), 1)
+            self.assertEqual(len(quit.getGraphConfig(third).getgraphs()), 2)
+
+    def testBranchTipIsCached(self):
+        """Test that the dataset of a branch is reused until the branch moves."""
+        with TemporaryRepositoryFactory().withGraph("http://example.org/") as repo:
+            args = quitApp.getDefaults()
+            args['targetdir'] = repo.workdir
+            app = create_app(args)
+            client = app.test_client()
+            quit = app.config['quit']
+
+            graph, commitid = quit.instance('master')
+            self.assertEqual(commitid, str(repo.head.target))
+            self.assertIs(quit.instance('master')[0], graph)
+            self.assertIsNot(quit.instance(commitid)[0], graph)
+
+            update = """INSERT DATA { GRAPH <http://example.org/> {
+                <http://ex.org/a> <http://ex.org/b> <http://ex.org/c> } }"""
+            response = client.post('/sparql', data=dict(update=update))
+            head = response.headers['X-CurrentCommit']
+            # the cached dataset was replaced by the commit
+            self.assertEqual(quit._tips['master'][1], head)
+            graph, commitid = quit.instance('master')
+            self.assertEqual(commitid, head)
+
+            # a branch moved by git directly is read again
+            with open(path.join(repo.workdir, 'graph.nt'), 'w') as graphFile:
+                graphFile.write('<http://ex.org/x> <http://ex.org/y> <http://ex.org/z> .\n')
+            createCommit(repo)
+            graph, commitid = quit.instance('master')
+            self.assertEqual(commitid, str(repo.head.target))
+            self.assertEqual(len(graph.store), 1)
+
+            repo.branches.local.create('develop', repo.head.peel())
+            quit.instance('develop')
+            self.assertIn('develop', quit._tips)
+            repo.branches.local.delete('develop')
+            with self.assertRaises(RevisionNotFound):
+                quit.instance('develop')
+            self.assertNotIn('develop', quit._tips)
+
+    def testFailedWritesDiscardBranchTip(self):
+        """Test that a dataset changed by a write which is not committed is not reused."""
+        graphContent = '<http://ex.org/a> <http://ex.org/b> <http://ex.org/c> .\n'
+        with TemporaryRepositoryFactory().withGraph("http://example.org/", graphContent) as repo:
+            args = quitApp.getDefaults()
+            args['targetdir'] = repo.workdir
+            app = create_app(args)
+            client = app.test_client()
+            quit = app.config['quit']
+
+            repo.branches.local.create('develop', repo.head.peel())
+            quit.instance('master')
+            quit.instance('develop')
+
+            def fail(*args, **kwargs):
+                raise Exception('commit failed')
+
+            quit.commit = fail
+            update = """INSERT DATA { GRAPH <http://example.org/> {
+                <http://ex.org/x> <http://ex.org/y> <http://ex.org/z> } }"""
+            response = client.post('/sparql', data=dict(update=update))
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(quit._tips, {})
+            self.assertEqual(len(quit.instance('master')[0].store), 1)
+
+            data = '<http://ex.org/x> <http://ex.org/y> <http://ex.org/z> <http://example.org/> .\n'
+            response = client.post('/statements', data=data, content_type='application/n-quads')
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(len(quit.instance('master')[0].store), 1)
+            del quit.commit
+
+            # the graphs of develop were changed for the commit to master
+            quit.instance('develop')
+            response = client.post('/sparql', data=dict(update=update))
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('develop', quit._tips)
+            self.assertEqual(len(quit.instance('master')[0].store), 2)
+            self.assertEqual(len(quit.instance('develop')[0].store), 1)
+
+    def testGraphFilesAreLoadedLazily(self):
+        """Test that the text and the graph of a file are only loaded when they are used."""
+        graphContent = '<http://ex.org/a> <http://ex.org/b> <http://ex.org/c> .\n'
+        with TemporaryRepositoryFactory().withGraph("http://example.org/", graphContent) as repo:
+            args = quitApp.getDefaults()
+            args['targetdir'] = repo.workdir
+            app = create_app(args)
+            quit = app.config['quit']
+
+            # reading parses the graph without creating the file reference
+            quit.instance('master')
+            [blob] = quit.getFilesForCommit(quit.repository.revision('master'))
+            reference, graph = quit._blobs.get(blob)
+            self.assertIsNone(reference)
+            self.assertEqual(len(graph), 1)
+
+            # a commit to a branch which was not read patches the text of the file without
+            # parsing its graph
+            quit._blobs.remove(blob)
+            triple = tuple(URIRef('http://ex.org/' + name) for name in 'xyz')
+            delta = [{'type': 'INSERT',
+                      'delta': {URIRef('http://example.org/'): [('additions', [triple])]}}]
+            head = quit.commit(None, delta, 'New Commit', 'master', 'refs/heads/develop')
+            commit = quit.repository.revision(head)
+            [blob] = quit.getFilesForCommit(commit)
+            reference, graph = quit._blobs.get(blob)
+            self.assertIsNotNone(reference)
+            self.assertIsNone(graph)
+
+            # the graph is parsed from the new blob when it is read
+            graph = quit.getContext(blob, commit)
+            self.assertEqual(len(graph), 2)
+            self.assertIn(triple, graph)
+            self.assertIs(quit._blobs.get(blob)[1], graph)
+
+            # the graph configuration is read again if it was dropped from its cache
+            quit._graphconfigs.remove(commit.id)
+            index = quit.repository.index(commit.id)
+            self.assertEqual(quit._applyKnownGraphs([], [blob], commit, index), {blob})
+
+    def testPersistedUpdatesDropParsedGraphs(self):
+        """Test that a commit with persistence does not keep the outdated graph of a file."""
+        graphContent = '<http://ex.org/a> <http://ex.org/b> <http://ex.org/c> .\n'
+        with TemporaryRepositoryFactory().withGraph("http://example.org/", graphContent) as repo:
+            args = quitApp.getDefaults()
+            args['targetdir'] = repo.workdir
+            args['features'] = Feature.Persistence
+            app = create_app(args)
+            quit = app.config['quit']
+
+            # the dataset is read from the store, so the parsed graph is not changed by updates
+            commit = quit.repository.revision('master')
+            [blob] = quit.getFilesForCommit(commit)
+            quit.getContext(blob, commit)
+            triple = tuple(URIRef('http://ex.org/' + name) for name in 'xyz')
+            delta = [{'type': 'INSERT',
+                      'delta': {URIRef('http://example.org/'): [('additions', [triple])]}}]
+            head = quit.commit(None, delta, 'New Commit', 'master', 'refs/heads/develop')
+
+            commit = quit.repository.revision(head)
+            [blob] = quit.getFilesForCommit(commit)
+            self.assertEqual(len(quit.getContext(blob, commit)), 2)
+
+    def testReferenceEventStream(self):
+        """Test that moved branches are streamed as server-sent events."""
+        with TemporaryRepositoryFactory().withGraph("http://example.org/") as repo:
+            args = quitApp.getDefaults()
+            args['targetdir'] = repo.workdir
+            app = create_app(args)
+            client = app.test_client()
+            quit = app.config['quit']
+            initial = str(repo.head.target)
+
+            response = client.get('/events?ref=refs/heads/', buffered=False)
+            self.assertEqual(response.mimetype, 'text/event-stream')
+            stream = iter(response.response)
+            self.assertEqual(next(stream), b': connected\n\n')
+            self.assertEqual(len(quit.repository._listeners), 1)
+
+            update = """INSERT DATA { GRAPH <http://example.org/> {
+                <http://ex.org/a> <http://ex.org/b> <http://ex.org/c> } }"""
+            head = client.post('/sparql', data=dict(update=update)).headers['X-CurrentCommit']
+            client.get('/branch/master:develop')
+
+            events = [next(stream), next(stream)]
+            self.assertEqual(events[0].split(b'\n')[0], b'event: ref')
+            data = [json.loads(event.decode('utf-8').split('data: ')[1]) for event in events]
+            self.assertEqual(data, [{'ref': 'refs/heads/master', 'old': initial, 'new': head},
+                                    {'ref': 'refs/heads/develop', 'old': None, 'new': head}])
+
+            response.close()
+            self.assertEqual(quit.repository._listeners, [])
+
+    def testCompactFiles(self):
+        """Test updates with graph files kept as compact file references."""
+        graphContent = ('<http://ex.org/a> <http://ex.org/b> "1" .\n'
+                        '<http://ex.org/a> <http://ex.org/b> "2" .')
+        with TemporaryRepositoryFactory().withGraph("http://example.org/", graphContent) as repo:
+            args = quitApp.getDefaults()
+            args['targetdir'] = repo.workdir
+            args['features'] = Feature.CompactFiles
+            app = create_app(args)
+            client = app.test_client()
+
+            update = """DELETE DATA { GRAPH <http://example.org/> {
+                <http://ex.org/a> <http://ex.org/b> "1" } };
+                INSERT DATA { GRAPH <http://example.org/> { <http://ex.org/c> <http://ex.org/b> "3" }
+                GRAPH <http://aksw.org/> { <http://ex.org/a> <http://ex.org/b> "4" } }"""
+            response = client.post('/sparql', data=dict(update=update))
+            self.assertEqual(response.status_code, 200)
+
+            tree = repo.revparse_single('HEAD').tree
+            self.assertEqual(tree['graph.nt'].data, b'<http://ex.org/a> <http://ex.org/b> "2" .\n'
+                                                    b'<http://ex.org/c> <http://ex.org/b> "3" .\n')
+            self.assertEqual(tree['aksw.org.nt'].data,
+                             b'<http://ex.org/a> <http://ex.org/b> "4" .\n')
+            store = app.config['quit']
+            reference, graph = store.getFileReferenceAndContext(
+                ('graph.nt', tree['graph.nt'].id), store.repository.revision('HEAD'))
+            self.assertIsInstance(reference, CompactFileReference)
+
+    def testBlameFilters(self):
+        """Test restricting and paginating blame."""
+        graphContent = "\n".join(
+            "<http://ex.org/s{}> <http://ex.org/p{}> \"{}\" .".format(i % 3, i % 2, i)
+            for i in range(12))
+        with TemporaryRepositoryFactory().withGraph("http://example.org/", graphContent) as repo:
+            args = quitApp.getDefaults()
+            args['targetdir'] = repo.workdir
+            args['features'] = Feature.Provenance
+            app = create_app(args).test_client()
+
+            def blame(**params):
+                response = app.get('/blame/HEAD', query_string=params,
+                                   headers={'Accept': 'application/sparql-results+json'})
+                self.assertEqual(response.status, '200 OK')
+                bindings = json.loads(response.data.decode("utf-8"))['results']['bindings']
+                return [(row['s']['value'], row['p']['value'], row['o']['value'])
+                        for row in bindings]
+
+            for engine in ['index', 'history']:
+                everything = blame(engine=engine)
+                self.assertEqual(len(everything), 12)
+                self.assertEqual(everything, sorted(everything, key=lambda t: (
+                    t[0], t[1], '"{}"'.format(t[2]))))
+
+                self.assertEqual(blame(engine=engine, limit=5), everything[:5])
+                self.assertEqual(blame(engine=engine, limit=5, offset=10), everything[10:])
+
+                subject = blame(engine=engine, subject='http://ex.org/s1')
+                self.assertEqual(subject, [t for t in everything if t[0] == 'http://ex.org/s1'])
+
+                both = blame(engine=engine, subject='http://ex.org/s1',
+                             predicate='http://ex.org/p0', graph='http://example.org/')
+                self.assertEqual(both, [t for t in subject if t[1] == 'http://ex.org/p0'])
+                self.assertEqual(len(both), 2)
+
+                self.assertEqual(blame(engine=engine, graph='http://example.org/other/'), [])
+
+            for params in [{'limit': 'ten'}, {'offset': '-1'}, {'limit': '1.5'}]:
+                response = app.get('/blame/HEAD', query_string=params)
+                self.assertEqual(response.status, '400 BAD REQUEST')
+                self.assertEqual(
+                    response.data, b'limit and offset have to be non-negative integers')
+
+    def testHistoryBlameSkipsMalformedLines(self):
+        """Test that the history blame leaves out lines which are no N-Triples statements."""
+        graphContent = '<http://ex.org/x> <http://ex.org/y> <http://ex.org/z> .'
+        with TemporaryRepositoryFactory().withGraph("http://example.org/", graphContent) as repo:
+            args = quitApp.getDefaults()
+            args['targetdir'] = repo.workdir
+            args['features'] = Feature.Provenance
+            app = create_app(args).test_client()
+
+            with open(path.join(repo.workdir, 'graph.nt'), 'w') as graphFile:
+                graphFile.write('<http://ex.org/a> <http://ex.org/b> broken\n' + graphContent)
+            createCommit(repo)
+
+            response = app.get('/blame/HEAD?engine=history',
+                               headers={'Accept': 'application/sparql-results+json'})
+            self.assertEqual(response.status, '200 OK')
+            bindings = json.loads(response.data.decode("utf-8"))['results']['bindings']
+            self.assertEqual([row['s']['value'] for row in bindings], ['http://ex.org/x'])
+
     def testBlameApi(self):
         """Test if feature is active or not.
 
@@ -983,6 +1313,65 @@ class QuitAppTestCase(unittest.TestCase):
             response = app.get('/commits', headers={'Accept': 'text/html'})
             self.assertEqual(response.status, '200 OK')
 
+    def testCommitsPagination(self):
+        """Test paginating /commits with limit, offset and since."""
+        with TemporaryRepositoryFactory().withEmptyGraph("http://example.org/") as repo:
+            args = quitApp.getDefaults()
+            args['targetdir'] = repo.workdir
+            app = create_app(args).test_client()
+
+            for i in range(5):
+                update = "INSERT DATA {{ GRAPH <http://example.org/> {{ <urn:{}> <urn:p> 1 }} }}"
+                response = app.post('/sparql', data=dict(update=update.format(i)))
+                self.assertEqual(response.status, '200 OK')
+
+            def commits(**params):
+                response = app.get('/commits', query_string=params,
+                                   headers={'Accept': 'application/json'})
+                self.assertEqual(response.status, '200 OK')
+                return [commit['id'] for commit in json.loads(response.data.decode("utf-8"))]
+
+            everything = commits()
+            self.assertEqual(len(everything), 6)
+            self.assertEqual(everything[0], str(repo.head.target))
+
+            self.assertEqual(commits(limit=2), everything[:2])
+            self.assertEqual(commits(limit=2, offset=3), everything[3:5])
+            self.assertEqual(commits(since=everything[1], limit=3), everything[2:5])
+            self.assertEqual(commits(since=everything[1][:10], offset=1), everything[3:])
+            self.assertEqual(commits(since=everything[-1]), [])
+
+            response = app.get('/commits', query_string={'limit': 2, 'offset': 1},
+                               headers={'Accept': 'text/html'})
+            self.assertEqual(response.status, '200 OK')
+            html = response.data.decode("utf-8")
+            self.assertIn('since={}'.format(everything[2]), html)
+            self.assertIn(everything[1], html)
+            self.assertNotIn(everything[0], html)
+            # only the commits up to the end of the page are laid out
+            nodes, _ = _layouts.get(everything[0])
+            self.assertEqual(len(nodes), 3)
+
+            for params in [{'limit': 'a'}, {'limit': -1}, {'offset': '1.5'}, {'offset': -2}]:
+                response = app.get('/commits', query_string=params)
+                self.assertEqual(response.status_code, 400)
+
+    def testCommitGraphLayoutIsIncremental(self):
+        """Test that the layout of the first commits is laid out and extended on demand."""
+        history = [CommitGraph('m', ['a', 'b']), CommitGraph('a', ['c']), CommitGraph('b', ['c']),
+                   CommitGraph('c', ['d']), CommitGraph('d', [])]
+        calls = []
+
+        def commits():
+            calls.append(1)
+            return iter(history)
+
+        complete = generate_graph_layout(history)
+        self.assertEqual(cached_graph_layout('tip-m', commits, 2), complete[:2])
+        self.assertEqual(cached_graph_layout('tip-m', commits, 1), complete[:1])
+        self.assertEqual(cached_graph_layout('tip-m', commits, 10), complete)
+        self.assertEqual(len(calls), 1)
+
     def testContentNegotiation(self):
         """Test SPARQL with different Accept Headers."""
         # Prepate a git Repository
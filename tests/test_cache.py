@@ -2,7 +2,7 @@
 
 import unittest
 from context import quit
-from quit.cache import Cache, FileReference
+from quit.cache import Cache, CompactFileReference, FileReference
 from os import path, environ
 from pygit2 import init_repository, Repository, clone_repository
 from pygit2 import GIT_SORT_TOPOLOGICAL, GIT_SORT_REVERSE, Signature
@@ -55,6 +55,88 @@ class FileReferenceTests(unittest.TestCase):
     def tearDown(self):
         pass
 
+    def testBatchUpdates(self):
+        f = FileReference('graph.nt', '<urn:b> <urn:p> "2" .\n<urn:a>  <urn:p> "1" .')
+        f.update(['<urn:c> <urn:p> "3" .', '<urn:a> <urn:p> "1" .'])
+        self.assertEqual(f.content,
+                         '<urn:a> <urn:p> "1" .\n<urn:b> <urn:p> "2" .\n<urn:c> <urn:p> "3" .\n')
+        f.difference_update(['<urn:b> <urn:p> "2" .', '<urn:d> <urn:p> "4" .'])
+        self.assertEqual(f.content, '<urn:a> <urn:p> "1" .\n<urn:c> <urn:p> "3" .\n')
+
+    def testLoadCanonicalContent(self):
+        lines = sorted('<urn:s{}> <urn:p> "{}" .'.format(i % 37, i) for i in range(300))
+        canonical = FileReference('graph.nt', '\n'.join(lines) + '\n')
+        reference = FileReference('graph.nt', '\n'.join(reversed(lines)))
+        self.assertEqual(canonical.content, reference.content)
+        self.assertEqual(list(canonical._content), lines)
+        canonical._content._check()
+
+        canonical.add('<urn:a> <urn:p> "0" .')
+        self.assertEqual(canonical.content, '<urn:a> <urn:p> "0" .\n' + reference.content)
+
+
+class CompactFileReferenceTests(unittest.TestCase):
+    content = '<urn:b> <urn:p> "2" .\n\n<urn:a>  <urn:p> "1" .\n<urn:b> <urn:p> "2" .'
+
+    def testContent(self):
+        f = CompactFileReference('graph.nt', self.content)
+        self.assertEqual(f.path, 'graph.nt')
+        self.assertEqual(f.content, b'<urn:a> <urn:p> "1" .\n<urn:b> <urn:p> "2" .\n')
+        self.assertEqual(len(f), 2)
+        self.assertIn('<urn:a> <urn:p> "1" .', f)
+        self.assertNotIn('<urn:a> <urn:p> "2" .', f)
+        self.assertEqual(CompactFileReference('graph.nt', b'').content, b'\n')
+
+        canonical = CompactFileReference('graph.nt', f.content, chunk_size=1)
+        self.assertEqual(canonical.content, f.content)
+        self.assertEqual(canonical._chunks,
+                         [b'<urn:a> <urn:p> "1" .\n', b'<urn:b> <urn:p> "2" .\n'])
+
+    def testLoadChunks(self):
+        lines = ['<urn:s{:03}> <urn:p> "{}" .\n'.format(i, i).encode('utf-8') for i in range(20)]
+        content = b''.join(lines)
+        for size in [1, 3, 4, 20, 1024]:
+            f = CompactFileReference('graph.nt', content, chunk_size=size)
+            self.assertEqual(f._chunks, [b''.join(lines[i:i + size]) for i in range(0, 20, size)])
+            self.assertEqual(f._maxes,
+                             [lines[min(i + size, 20) - 1][:-1] for i in range(0, 20, size)])
+
+        # lines out of order within and between the chunks are sorted
+        unsorted = b''.join(lines[4:] + lines[:4])
+        for size in [2, 4, 5]:
+            f = CompactFileReference('graph.nt', unsorted, chunk_size=size)
+            self.assertEqual(f.content, content)
+        f = CompactFileReference('graph.nt', content + lines[0], chunk_size=4)
+        self.assertEqual(f.content, content)
+
+        # content which is not canonical is normalized
+        canonical = '<urn:a> <urn:p> "1" .\n<urn:b> <urn:p> "2" .\n'
+        for irregular in ['<urn:b> <urn:p> "2" .\n<urn:a> <urn:p> "1" .', canonical[:-1],
+                          canonical + '<urn:b> <urn:p> "2" .\n', ' ' + canonical,
+                          canonical.replace('> <', '>  <', 1), canonical.replace('> <', '>\t<', 1),
+                          canonical.replace('\n', ' \n'), canonical.replace('\n', '\r\n'),
+                          '\n' + canonical, canonical + '\n']:
+            f = CompactFileReference('graph.nt', irregular.encode('utf-8'), chunk_size=1)
+            self.assertEqual(f.content, canonical.encode('utf-8'), repr(irregular))
+
+    def testChangesLikeFileReference(self):
+        lines = ['<urn:s{}> <urn:p> "{}" .'.format(i % 37, i) for i in range(300)]
+        compact = CompactFileReference('graph.nt', '\n'.join(lines[::3]), chunk_size=7)
+        reference = FileReference('graph.nt', '\n'.join(lines[::3]))
+
+        for f in [compact, reference]:
+            f.update(lines[::2])
+            f.remove(lines[0])
+            f.add(lines[0])
+            f.difference_update(lines[::5])
+            f.add('<urn:z> <urn:p> "\u00e4" .')
+            f.remove('<urn:unknown> <urn:p> "0" .')
+        self.assertEqual(compact.content, reference.content.encode('utf-8'))
+        self.assertTrue(all(len(chunk.split(b'\n')) <= 8 for chunk in compact._chunks))
+
+        compact.difference_update(lines)
+        self.assertEqual(compact.content, '<urn:z> <urn:p> "\u00e4" .\n'.encode('utf-8'))
+
 
 def main():
     unittest.main()
@@ -194,6 +194,64 @@ class TestConfiguration(unittest.TestCase):
             self.assertEqual(conf.getgraphuriforfile('new_file.nt').n3(), '<http://aksw.org/>')
             self.assertEqual(conf.getserializationoffile('new_file.nt'), 'nt')
 
+    def testGraphConfigurationCopy(self):
+        repoContent = {'http://example.org/': '<urn:x> <urn:y> <urn:z> .'}
+        with TemporaryRepositoryFactory().withGraphs(repoContent, 'configfile') as repo:
+            conf = QuitGraphConfiguration(repository=repo)
+            conf.initgraphconfig(repo.head.shorthand)
+
+            copy = conf.copy()
+            copy.addgraph('http://aksw.org/', 'new_file.nt', 'nt')
+
+            self.assertEqual(copy.mode, 'configuration')
+            self.assertEqual(copy.getfileforgraphuri('http://aksw.org/'), 'new_file.nt')
+            self.assertEqual(copy.getfileforgraphuri('http://example.org/'), 'graph_0.nt')
+            self.assertEqual(conf.getfileforgraphuri('http://aksw.org/'), None)
+            self.assertEqual(sorted(conf.getfiles()), ['graph_0.nt'])
+            self.assertEqual(len(copy.graphconf), len(conf.graphconf) + 4)
+
+    def testGraphConfigurationSignature(self):
+        files = [('a.nt', 'a1', 0), ('a.nt.graph', 'g1', 0), ('dir/config.ttl', 'c1', 0),
+                 ('README.md', 'r1', 0)]
+        signature = QuitGraphConfiguration.signature(files)
+
+        # changed graph data does not change the signature
+        self.assertEqual(QuitGraphConfiguration.signature(
+            [('a.nt', 'a2', 0)] + files[1:]), signature)
+        self.assertEqual(QuitGraphConfiguration.signature(files[:3]), signature)
+        self.assertNotEqual(QuitGraphConfiguration.signature(
+            files[:1] + [('a.nt.graph', 'g2', 0)] + files[2:]), signature)
+        self.assertNotEqual(QuitGraphConfiguration.signature(
+            files + [('b.nt', 'b1', 0)]), signature)
+        self.assertNotEqual(QuitGraphConfiguration.signature(files[:2]), signature)
+
+    def testConfigfileSkipsUnusableGraphs(self):
+        config = """@prefix quit: <http://quit.aksw.org/vocab/> .
+            <urn:a> a quit:Graph ; quit:graphUri <http://ex.org/a> ; quit:graphFile "a.nt" .
+            <urn:b> a quit:Graph ; quit:graphUri <http://ex.org/b> ; quit:graphFile "b.ttl" .
+            <urn:c> a quit:Graph ; quit:graphUri <http://ex.org/c> ; quit:graphFile "c.nt" ;
+                quit:hasFormat "nt" .
+            <urn:d> a quit:Graph ; quit:graphUri <http://ex.org/d> ; quit:graphFile "d.nt" .
+            <urn:e> a quit:Graph ; quit:graphUri <http://ex.org/e> ; quit:graphFile "e.nt" ;
+                quit:hasFormat "turtle" ."""
+        with TemporaryRepository() as repo:
+            author = Signature('QuitStoreTest', 'quit@quit.aksw.org')
+            builder = repo.TreeBuilder()
+            builder.insert('config.ttl', repo.create_blob(config), pygit2.GIT_FILEMODE_BLOB)
+            for name in ['a.nt', 'b.ttl', 'c.nt', 'e.nt']:
+                builder.insert(name, repo.create_blob(''), pygit2.GIT_FILEMODE_BLOB)
+            repo.create_commit('HEAD', author, author, 'config', builder.write(), [])
+
+            conf = QuitGraphConfiguration(repository=repo)
+            conf.initgraphconfig(repo.head.shorthand)
+
+            self.assertEqual(conf.mode, 'configuration')
+            # b.ttl and e.nt are no N-Triples files and d.nt does not exist
+            self.assertEqual(conf.getgraphurifilemap(), {
+                rdflib.term.URIRef('http://ex.org/a'): 'a.nt',
+                rdflib.term.URIRef('http://ex.org/c'): 'c.nt'})
+            self.assertEqual(conf.getserializationoffile('c.nt'), 'nt')
+
     def testGraphConfigurationFailing(self):
         with TemporaryRepositoryFactory().withBothConfigurations() as repo:
             current_head = repo.head.shorthand
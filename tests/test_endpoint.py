@@ -3,9 +3,14 @@ import unittest
 from context import quit
 
 import quit.application as quitApp
+from quit.bulk import BulkImport
 from quit.web.app import create_app
 from tempfile import TemporaryDirectory
+from helpers import TemporaryRepositoryFactory
+import io
 import json
+from rdflib import ConjunctiveGraph, Literal, URIRef
+
 
 class EndpointTests(unittest.TestCase):
     """Test endpoint features."""
@@ -409,5 +414,512 @@ class EndpointTests(unittest.TestCase):
                 "o": {'type': 'uri', 'value': 'http://ex.org/Todo'}})
 
 
+class QueryEvaluationTests(unittest.TestCase):
+    """Test the memory bounded evaluation of queries."""
+
+    content = "\n".join(
+        "<http://ex.org/s{}> <http://ex.org/p> \"{}\" .".format(i % 6, i) for i in range(30))
+
+    def _post(self, query, **kwargs):
+        with TemporaryRepositoryFactory().withGraph("http://example.org/", self.content) as repo:
+            args = quitApp.getDefaults()
+            args['targetdir'] = repo.workdir
+            args.update(kwargs)
+            app = create_app(args).test_client()
+
+            return app.post('/sparql', data=dict(query=query),
+                            headers=dict(accept="application/sparql-results+json"))
+
+    def _query(self, query, **kwargs):
+        response = self._post(query, **kwargs)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data.decode("utf-8"))["results"]["bindings"]
+
+    def testGroupBySpill(self):
+        query = """SELECT ?s (COUNT(?o) AS ?c) (GROUP_CONCAT(?o) AS ?all) WHERE {
+            GRAPH ?g { ?s ?p ?o } } GROUP BY ?s ORDER BY ?s"""
+
+        expected = self._query(query)
+        self.assertEqual(len(expected), 6)
+        self.assertEqual(expected[0]['c']['value'], '5')
+
+        for threshold in [1, 2, 5]:
+            self.assertEqual(self._query(query, spill_threshold=threshold), expected)
+
+    def testDistinctSpill(self):
+        query = """SELECT DISTINCT ?s WHERE { GRAPH ?g { ?s ?p ?o } } ORDER BY DESC(?s)"""
+
+        expected = self._query(query)
+        self.assertEqual(len(expected), 6)
+        self.assertEqual(expected[0]['s']['value'], 'http://ex.org/s5')
+
+        for threshold in [0, 1, 4]:
+            self.assertEqual(self._query(query, spill_threshold=threshold), expected)
+
+    def testReducedBuffer(self):
+        query = """SELECT REDUCED ?s WHERE { GRAPH ?g { ?s ?p ?o } } ORDER BY ?s"""
+
+        self.assertEqual(len(self._query(query, reduced_buffer=0)), 30)
+        self.assertEqual(len(self._query(query, reduced_buffer=1)), 6)
+
+        query = """SELECT REDUCED ?s WHERE { GRAPH ?g { ?s ?p ?o } } ORDER BY ?o"""
+        self.assertEqual(len(self._query(query, reduced_buffer=6)), 6)
+
+    def testQueryTimeout(self):
+        query = """SELECT * WHERE { GRAPH ?g { ?s ?p ?o . ?s2 ?p2 ?o2 } }"""
+
+        self.assertEqual(len(self._query(query, query_timeout=60)), 900)
+        self.assertEqual(self._post(query, query_timeout=0).status_code, 503)
+
+        query = """SELECT * WHERE { GRAPH ?g { ?s <http://ex.org/p>* ?o } }"""
+        self.assertEqual(self._post(query, query_timeout=0).status_code, 503)
+
+    def testQueryResultLimit(self):
+        query = """SELECT * WHERE { GRAPH ?g { ?s ?p ?o } }"""
+
+        self.assertEqual(len(self._query(query, query_result_limit=30)), 30)
+        response = self._post(query, query_result_limit=29)
+        self.assertEqual(response.status_code, 503)
+        self.assertIn(b'29 results', response.data)
+
+    def testExplainAndProfile(self):
+        query = """SELECT ?s WHERE { GRAPH ?g { ?s ?p ?o OPTIONAL { ?o ?p2 ?x } } } LIMIT 3"""
+
+        with TemporaryRepositoryFactory().withGraph("http://example.org/", self.content) as repo:
+            args = quitApp.getDefaults()
+            args['targetdir'] = repo.workdir
+            app = create_app(args).test_client()
+
+            response = app.post('/sparql', data=dict(query=query, explain='true'))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['Content-Type'], 'text/plain')
+            lines = response.data.decode("utf-8").splitlines()
+            self.assertEqual(lines[0], 'SelectQuery ?s')
+            self.assertIn('        LeftJoin', lines)
+            self.assertNotIn('rows=', response.data.decode("utf-8"))
+
+            response = app.post('/sparql?profile', data=dict(query=query))
+            self.assertEqual(response.status_code, 200)
+            lines = response.data.decode("utf-8").splitlines()
+            self.assertTrue(lines[0].startswith('SelectQuery ?s  (calls=1, rows=3, '))
+            self.assertTrue(lines[-1].startswith('Total: '))
+            optional = [line for line in lines if line.startswith('          BGP { ?o ?p2 ?x }')]
+            self.assertEqual(len(optional), 1)
+            # the optional part is evaluated for each solution of the required part
+            calls = int(optional[0].split('calls=')[1].split(',')[0])
+            self.assertGreaterEqual(calls, 3)
+            self.assertIn('rows=0', optional[0])
+            self.assertIn('lookups={})'.format(calls), optional[0])
+
+
+class AppTestCase(unittest.TestCase):
+    """Base class of tests running a QuitStore app on a temporary repository."""
+
+    def _app(self, repo, **kwargs):
+        args = quitApp.getDefaults()
+        args['targetdir'] = repo.workdir
+        args.update(kwargs)
+        return create_app(args)
+
+    def _client(self, repo, **kwargs):
+        return self._app(repo, **kwargs).test_client()
+
+
+class BulkImportTests(AppTestCase):
+    """Test importing statements without SPARQL Update."""
+
+    content = """<http://ex.org/b> <http://ex.org/p> "2" .
+<http://ex.org/a> <http://ex.org/p> "1" ."""
+
+    def _file(self, repo, name):
+        return repo.revparse_single('HEAD').tree[name].data.decode('utf-8')
+
+    def testImportTriples(self):
+        with TemporaryRepositoryFactory().withGraph("http://example.org/", self.content) as repo:
+            app = self._client(repo)
+            data = b"""<http://ex.org/c> <http://ex.org/p> "3" .\r
+# a comment
+
+<http://ex.org/a> <http://ex.org/p> "1" .
+"""
+            response = app.post('/import/master?graph=http://example.org/&message=Import',
+                                data=data, content_type='application/n-triples')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, b'2 statements imported')
+            self.assertEqual(response.headers['X-CurrentCommit'], str(repo.head.target))
+            self.assertEqual(repo.revparse_single('HEAD').message.strip(), 'Import')
+            self.assertEqual(self._file(repo, 'graph.nt').splitlines(), [
+                '<http://ex.org/a> <http://ex.org/p> "1" .',
+                '<http://ex.org/b> <http://ex.org/p> "2" .',
+                '<http://ex.org/c> <http://ex.org/p> "3" .'])
+
+            query = 'SELECT * WHERE { GRAPH ?g { ?s ?p ?o } }'
+            response = app.post('/sparql', data=dict(query=query),
+                                headers=dict(accept="application/sparql-results+json"))
+            bindings = json.loads(response.data.decode("utf-8"))["results"]["bindings"]
+            self.assertEqual(len(bindings), 3)
+
+    def testImportQuads(self):
+        with TemporaryRepositoryFactory().withGraph("http://example.org/", self.content) as repo:
+            app = self._app(repo)
+            graph = self._file(repo, 'graph.nt')
+            data = "\n".join(
+                "<http://ex.org/s{}> <http://ex.org/p> \"{}\" <http://aksw.org/> .".format(i % 7, i)
+                for i in range(20)).encode('utf-8')
+
+            # a run size below the number of statements spills sorted runs to disk
+            oid, count = BulkImport(app.config['quit'], run_size=3).run(io.BytesIO(data), 'master')
+            self.assertEqual(count, 20)
+            spilled = self._file(repo, 'aksw.org.nt')
+            self.assertEqual(self._file(repo, 'aksw.org.nt.graph'), 'http://aksw.org/\n')
+
+            response = app.test_client().post(
+                '/import/master', data=data, content_type='application/n-quads')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self._file(repo, 'aksw.org.nt'), spilled)
+            lines = spilled.splitlines()
+            self.assertEqual(lines, sorted(set(lines)))
+            self.assertEqual(len(lines), 20)
+            self.assertEqual(self._file(repo, 'graph.nt'), graph)
+
+    def testImportErrors(self):
+        with TemporaryRepositoryFactory().withGraph("http://example.org/", self.content) as repo:
+            app = self._client(repo)
+            head = str(repo.head.target)
+
+            for url, data, status in [
+                    ('/import/master', b'<urn:a> <urn:b> <urn:c> .', 400),
+                    ('/import/master?graph=http://example.org/', b'<urn:a> <urn:b> .', 400),
+                    ('/import/master?graph=urn:x', b'<urn:a> <urn:b> <urn:c> .', 400),
+                    ('/import/unknown?graph=http://example.org/', b'<urn:a> <urn:b> <urn:c> .',
+                     404)]:
+                response = app.post(url, data=data, content_type='application/n-quads')
+                self.assertEqual(response.status_code, status)
+
+            response = app.post('/import/master', data=b'', content_type='text/turtle')
+            self.assertEqual(response.status_code, 415)
+            self.assertEqual(str(repo.head.target), head)
+
+    def testImportIntoRevisions(self):
+        with TemporaryRepositoryFactory().withGraph("http://example.org/", self.content) as repo:
+            app = self._client(repo)
+            head = str(repo.head.target)
+            data = b'<http://ex.org/c> <http://ex.org/p> "3" .'
+
+            # HEAD is resolved to the branch it points to
+            response = app.post('/import/HEAD?graph=http://example.org/', data=data,
+                                content_type='application/n-triples')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['X-CurrentCommit'], str(repo.head.target))
+            self.assertEqual(list(repo.branches.local), ['master'])
+
+            response = app.post('/import/{}?graph=http://example.org/'.format(head), data=data,
+                                content_type='application/n-triples')
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(list(repo.branches.local), ['master'])
+
+
+class StatementsTests(AppTestCase):
+    """Test changing statements with the statements endpoint."""
+
+    content = '<http://ex.org/a> <http://ex.org/p> "1" .\n<http://ex.org/b> <http://ex.org/p> "2" .'
+
+    def _file(self, repo, name):
+        content = repo.revparse_single('HEAD').tree[name].data.decode('utf-8')
+        return [line for line in content.splitlines() if line]
+
+    def testPostPutDelete(self):
+        with TemporaryRepositoryFactory().withGraph("http://example.org/", self.content) as repo:
+            app = self._client(repo)
+
+            data = b"""<http://ex.org/a> <http://ex.org/p> "1" <http://example.org/> .
+<http://ex.org/c> <http://ex.org/p> "3" <http://example.org/> .
+"""
+            response = app.post('/statements', data=data, content_type='application/n-quads')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self._file(repo, 'graph.nt'), [
+                '<http://ex.org/a> <http://ex.org/p> "1" .',
+                '<http://ex.org/b> <http://ex.org/p> "2" .',
+                '<http://ex.org/c> <http://ex.org/p> "3" .'])
+
+            # nothing changes, so nothing is committed
+            head = str(repo.head.target)
+            response = app.post('/statements', data=data, content_type='application/n-quads')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(str(repo.head.target), head)
+
+            response = app.get('/statements?subj=http://ex.org/c')
+            self.assertEqual(response.data.strip(),
+                             b'<http://ex.org/c> <http://ex.org/p> "3" <http://example.org/> .')
+
+            response = app.put('/statements?context=http://example.org/',
+                               data=b'<http://ex.org/d> <http://ex.org/p> "4" .\n',
+                               content_type='application/n-triples')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self._file(repo, 'graph.nt'),
+                             ['<http://ex.org/d> <http://ex.org/p> "4" .'])
+
+            response = app.delete('/statements?subj=http://ex.org/d')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self._file(repo, 'graph.nt'), [])
+
+            response = app.get('/statements')
+            self.assertEqual(response.data.strip(), b'')
+
+    def testPutMinimalDelta(self):
+        with TemporaryRepositoryFactory().withGraph("http://example.org/", self.content) as repo:
+            app = self._client(repo)
+            quit = app.application.config['quit']
+            deltas = []
+            commit = quit.commit
+
+            def record(graph, delta, *args, **kwargs):
+                deltas.extend(dict(entry['delta']) for entry in delta)
+                return commit(graph, delta, *args, **kwargs)
+            quit.commit = record
+
+            data = b"""<http://ex.org/b> <http://ex.org/p> "2" .
+<http://ex.org/c> <http://ex.org/p> "3" .
+"""
+            response = app.put('/statements?context=http://example.org/', data=data,
+                               content_type='application/n-triples')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('OperationTypes: "MODIFY"', repo.revparse_single('HEAD').message)
+            self.assertEqual(self._file(repo, 'graph.nt'), [
+                '<http://ex.org/b> <http://ex.org/p> "2" .',
+                '<http://ex.org/c> <http://ex.org/p> "3" .'])
+
+            # only the changed statements are in the delta of the commit
+            self.assertEqual(deltas, [{URIRef('http://example.org/'): [
+                ('removals', [(URIRef('http://ex.org/a'), URIRef('http://ex.org/p'),
+                               Literal('1'))]),
+                ('additions', [(URIRef('http://ex.org/c'), URIRef('http://ex.org/p'),
+                                Literal('3'))])]}])
+
+            # replacing a graph with its statements does not change anything
+            head = str(repo.head.target)
+            response = app.put('/statements?context=http://example.org/', data=data,
+                               content_type='application/n-triples')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(str(repo.head.target), head)
+
+            # statements of other graphs can not replace the graph of the context
+            quad = b'<http://ex.org/z> <http://ex.org/p> "9" <http://aksw.org/> .\n'
+            response = app.put('/statements?context=http://example.org/', data=quad,
+                               content_type='application/n-quads')
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(str(repo.head.target), head)
+            self.assertEqual(len(self._file(repo, 'graph.nt')), 2)
+
+    def testInvalidAndLargeUploads(self):
+        with TemporaryRepositoryFactory().withGraph("http://example.org/", self.content) as repo:
+            app = self._client(repo, upload_limit=150)
+            head = str(repo.head.target)
+
+            data = b"""<http://ex.org/c> <http://ex.org/p> "3" <http://example.org/> .
+<http://ex.org/d> <http://ex.org/p> .
+"""
+            response = app.post('/statements', data=data, content_type='application/n-quads')
+            self.assertEqual(response.status_code, 400)
+
+            data = b'<http://ex.org/c> <http://ex.org/p> "3" <http://example.org/> .\n' * 3
+            response = app.post('/statements', data=data, content_type='application/n-quads')
+            self.assertEqual(response.status_code, 413)
+
+            # a body without content length is only rejected while it is read
+            response = app.post('/statements', input_stream=io.BytesIO(data),
+                                content_type='application/n-quads')
+            self.assertEqual(response.status_code, 413)
+
+            # the limit applies to bulk imports as well
+            for kwargs in [dict(data=data), dict(input_stream=io.BytesIO(data))]:
+                response = app.post('/import/master', content_type='application/n-quads',
+                                    **kwargs)
+                self.assertEqual(response.status_code, 413)
+
+            self.assertEqual(str(repo.head.target), head)
+            graph = ConjunctiveGraph()
+            graph.parse(data=app.get('/statements').data, format='nquads')
+            self.assertEqual(len(graph), 2)
+
+
+class GraphStoreTests(AppTestCase):
+    """Test the graph store protocol endpoint."""
+
+    content = '<http://ex.org/b> <http://ex.org/p> "2" .\n<http://ex.org/a> <http://ex.org/p> "1" .'
+
+    def _tree(self, repo):
+        return repo.revparse_single('HEAD').tree
+
+    def testGetPutPostDelete(self):
+        with TemporaryRepositoryFactory().withGraph("http://example.org/", self.content) as repo:
+            app = self._client(repo)
+
+            response = app.get('/graph-store?graph=http://example.org/')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'application/n-triples')
+            self.assertEqual(response.data.decode('utf-8'), self.content)
+            self.assertEqual(app.get('/graph-store/master?graph=http://aksw.org/').status_code,
+                             404)
+
+            response = app.put('/graph-store/master?graph=http://example.org/',
+                               data=b'<http://ex.org/c> <http://ex.org/p> "3" .\n',
+                               content_type='application/n-triples')
+            self.assertEqual(response.status_code, 204)
+            self.assertEqual(response.headers['X-CurrentCommit'], str(repo.head.target))
+            self.assertEqual(self._tree(repo)['graph.nt'].data,
+                             b'<http://ex.org/c> <http://ex.org/p> "3" .\n')
+
+            # the same content again does not create a commit
+            head = str(repo.head.target)
+            response = app.put('/graph-store/master?graph=http://example.org/',
+                               data=b'<http://ex.org/c> <http://ex.org/p> "3" .\n',
+                               content_type='application/n-triples')
+            self.assertEqual(response.status_code, 204)
+            self.assertEqual(response.headers['X-CurrentCommit'], head)
+            self.assertEqual(str(repo.head.target), head)
+
+            response = app.post('/graph-store/master?graph=http://example.org/',
+                                data='<http://ex.org/a> <http://ex.org/p> "1" .',
+                                content_type='text/turtle')
+            self.assertEqual(response.status_code, 204)
+            self.assertEqual(self._tree(repo)['graph.nt'].data.splitlines(), [
+                b'<http://ex.org/a> <http://ex.org/p> "1" .',
+                b'<http://ex.org/c> <http://ex.org/p> "3" .'])
+
+            response = app.put('/graph-store/master?graph=http://aksw.org/',
+                               data=b'<http://ex.org/d> <http://ex.org/p> "4" .\n',
+                               content_type='application/n-triples')
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(self._tree(repo)['aksw.org.nt.graph'].data, b'http://aksw.org/\n')
+
+            query = 'SELECT ?g (COUNT(*) AS ?n) WHERE { GRAPH ?g { ?s ?p ?o } } GROUP BY ?g'
+            response = app.post('/sparql', data=dict(query=query),
+                                headers=dict(accept="application/sparql-results+json"))
+            bindings = json.loads(response.data.decode("utf-8"))["results"]["bindings"]
+            self.assertEqual(dict((b['g']['value'], b['n']['value']) for b in bindings),
+                             {'http://example.org/': '2', 'http://aksw.org/': '1'})
+
+            response = app.delete('/graph-store/master?graph=http://example.org/')
+            self.assertEqual(response.status_code, 204)
+            self.assertNotIn('graph.nt', self._tree(repo))
+            self.assertNotIn('graph.nt.graph', self._tree(repo))
+            self.assertEqual(app.get('/graph-store?graph=http://example.org/').status_code, 404)
+            self.assertEqual(app.delete('/graph-store?graph=http://example.org/').status_code,
+                             404)
+
+    def testErrors(self):
+        with TemporaryRepositoryFactory().withGraph("http://example.org/", self.content) as repo:
+            app = self._client(repo)
+            head = str(repo.head.target)
+
+            for data, content_type, status in [
+                    (b'<http://ex.org/a> <http://ex.org/p> .', 'application/n-triples', 400),
+                    (b'<urn:a> <urn:b> <urn:c> <http://aksw.org/> .', 'application/n-triples',
+                     400),
+                    (b'<urn:a> <urn:b> .', 'text/turtle', 400),
+                    (b'{}', 'application/json', 415)]:
+                response = app.put('/graph-store?graph=http://example.org/', data=data,
+                                   content_type=content_type)
+                self.assertEqual(response.status_code, status)
+
+            self.assertEqual(app.get('/graph-store').status_code, 400)
+            self.assertEqual(app.get('/graph-store?default').status_code, 400)
+            self.assertEqual(app.get('/graph-store/unknown?graph=http://example.org/').status_code,
+                             404)
+
+            app = self._client(repo, upload_limit=50)
+            data = b'<http://ex.org/c> <http://ex.org/p> "3" .\n' * 3
+            for content_type in ['application/n-triples', 'text/turtle']:
+                for kwargs in [dict(data=data), dict(input_stream=io.BytesIO(data))]:
+                    response = app.put('/graph-store?graph=http://example.org/',
+                                       content_type=content_type, **kwargs)
+                    self.assertEqual(response.status_code, 413)
+            self.assertEqual(str(repo.head.target), head)
+
+
+class BulkExportTests(unittest.TestCase):
+    """Test streaming the statements of a commit."""
+
+    def testExport(self):
+        graphs = {'http://example.org/': '<http://ex.org/a> <http://ex.org/p> "1" .\n'
+                                         '<http://ex.org/b> <http://ex.org/p> "2 ." .',
+                  'http://aksw.org/': '<http://ex.org/c> <http://ex.org/p> <http://ex.org/d> .'}
+        with TemporaryRepositoryFactory().withGraphs(graphs) as repo:
+            args = quitApp.getDefaults()
+            args['targetdir'] = repo.workdir
+            app = create_app(args).test_client()
+            head = str(repo.head.target)
+
+            response = app.get('/export/master')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'application/n-quads')
+            self.assertEqual(response.headers['X-CurrentCommit'], head)
+
+            expected = ConjunctiveGraph()
+            for iri, content in graphs.items():
+                expected.get_context(URIRef(iri)).parse(data=content, format='nt')
+            exported = ConjunctiveGraph()
+            exported.parse(data=response.data, format='nquads')
+            self.assertEqual(len(exported), 3)
+            for iri in graphs:
+                self.assertEqual(set(exported.get_context(URIRef(iri))),
+                                 set(expected.get_context(URIRef(iri))))
+
+            for response in [app.get('/export/{}?format=trig'.format(head)),
+                             app.get('/export', headers={'Accept': 'application/trig'})]:
+                self.assertEqual(response.mimetype, 'application/trig')
+                exported = ConjunctiveGraph()
+                exported.parse(data=response.data, format='trig')
+                self.assertEqual(len(exported), 3)
+                self.assertEqual(set(exported.get_context(URIRef('http://aksw.org/'))),
+                                 set(expected.get_context(URIRef('http://aksw.org/'))))
+
+            self.assertEqual(app.get('/export/master?format=turtle').status_code, 400)
+            self.assertEqual(app.get('/export/unknown').status_code, 404)
+
+    def testExportBlankNodes(self):
+        graphs = {'http://example.org/': '_:b0 <http://ex.org/p> "1" .\n'
+                                         '_:b0 <http://ex.org/q> _:b1 .\n'
+                                         '<http://ex.org/a> <http://ex.org/p> "_:b0" . # comment\n'
+                                         '<http://ex.org/a> <http://ex.org/p> broken',
+                  'http://aksw.org/': '_:b0 <http://ex.org/p> "2" .'}
+        with TemporaryRepositoryFactory().withGraphs(graphs) as repo:
+            args = quitApp.getDefaults()
+            args['targetdir'] = repo.workdir
+            app = create_app(args).test_client()
+
+            for format in ['nquads', 'trig']:
+                response = app.get('/export/master?format={}'.format(format))
+                exported = ConjunctiveGraph()
+                exported.parse(data=response.data, format=format)
+                self.assertEqual(len(exported), 4)
+
+                # the same label in two files denotes two nodes
+                example = exported.get_context(URIRef('http://example.org/'))
+                aksw = exported.get_context(URIRef('http://aksw.org/'))
+                [node] = set(example.subjects(URIRef('http://ex.org/q'), None))
+                self.assertEqual(example.value(node, URIRef('http://ex.org/p')), Literal('1'))
+                [other] = set(aksw.subjects())
+                self.assertNotEqual(node, other)
+                self.assertIn((URIRef('http://ex.org/a'), URIRef('http://ex.org/p'),
+                               Literal('_:b0')), example)
+
+        # files with the same content share their blob
+        graphs = {'http://example.org/': '_:b0 <http://ex.org/p> "1" .',
+                  'http://aksw.org/': '_:b0 <http://ex.org/p> "1" .'}
+        with TemporaryRepositoryFactory().withGraphs(graphs) as repo:
+            args = quitApp.getDefaults()
+            args['targetdir'] = repo.workdir
+            app = create_app(args).test_client()
+
+            for format in ['nquads', 'trig']:
+                response = app.get('/export/master?format={}'.format(format))
+                exported = ConjunctiveGraph()
+                exported.parse(data=response.data, format=format)
+                self.assertEqual(len(exported), 2)
+                self.assertEqual(len(set(exported.subjects())), 2)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -10,6 +10,7 @@ from pygit2 import init_repository, Repository, clone_repository
 from pygit2 import GIT_SORT_TOPOLOGICAL, GIT_SORT_REVERSE, Signature
 from tempfile import TemporaryDirectory, NamedTemporaryFile
 import subprocess
+import threading
 from helpers import createCommit, TemporaryRepository, TemporaryRepositoryFactory
 
 try:
@@ -748,6 +749,80 @@ class GitRepositoryTests(unittest.TestCase):
         """TODO"""
         pass
 
+    def testReferenceEvents(self):
+        """Test that listeners are notified about moved references."""
+        graphContent = """
+            <http://ex.org/x> <http://ex.org/y> <http://ex.org/z> ."""
+        with TemporaryRepositoryFactory().withGraph("http://example.org/", graphContent) as remote:
+            with TemporaryRepository(False) as local:
+                local.remotes.create("origin", remote.path)
+                quitRepo = quit.git.Repository(local.workdir)
+                current_head = remote.head.shorthand
+                remoteHead = remote.revparse_single('HEAD').hex
+
+                events = []
+
+                def listener(*event):
+                    events.append(event)
+                quitRepo.subscribe(listener)
+
+                quitRepo.pull("origin", current_head)
+                self.assertEqual(events, [
+                    ('refs/heads/' + current_head, None, remoteHead),
+                    ('refs/remotes/origin/' + current_head, None, remoteHead)])
+
+                del events[:]
+                index = quitRepo.index(remoteHead)
+                index.add('graph.nt', '<http://ex.org/a> <http://ex.org/b> <http://ex.org/c> .')
+                commit = index.commit("Update", "QuitStoreTest", "quit@quit.aksw.org",
+                                      ref='refs/heads/' + current_head)
+                quitRepo.branch(current_head, 'develop')
+                self.assertTrue(quitRepo.delete_branch('develop'))
+                self.assertFalse(quitRepo.delete_branch('develop'))
+                self.assertEqual(events, [
+                    ('refs/heads/' + current_head, remoteHead, str(commit)),
+                    ('refs/heads/develop', None, str(commit)),
+                    ('refs/heads/develop', str(commit), None)])
+
+                del events[:]
+                quitRepo.unsubscribe(listener)
+                quitRepo.branch(current_head, 'develop')
+                self.assertEqual(events, [])
+
+    def testReferenceEventsOfThreads(self):
+        """Test that a reference moved during an operation of another thread is reported once."""
+        graphContent = """
+            <http://ex.org/x> <http://ex.org/y> <http://ex.org/z> ."""
+        with TemporaryRepositoryFactory().withGraph("http://example.org/", graphContent) as repo:
+            quitRepo = quit.git.Repository(repo.workdir)
+            head = str(repo.head.target)
+
+            events = []
+
+            def listener(*event):
+                events.append(event)
+            quitRepo.subscribe(listener)
+
+            entered = threading.Event()
+            commits = []
+
+            def commit():
+                entered.wait()
+                index = quitRepo.index(head)
+                index.add('graph.nt', '<http://ex.org/a> <http://ex.org/b> <http://ex.org/c> .')
+                commits.append(index.commit("Update", "QuitStoreTest", "quit@quit.aksw.org",
+                                            ref='refs/heads/develop'))
+
+            thread = threading.Thread(target=commit)
+            thread.start()
+            with quitRepo.notifying():
+                entered.set()
+                # the commit of the other thread does not wait until this context is left
+                thread.join(5)
+                self.assertFalse(thread.is_alive())
+                self.assertEqual(events, [('refs/heads/develop', None, str(commits[0]))])
+            self.assertEqual(events, [('refs/heads/develop', None, str(commits[0]))])
+
     def testRepositoryIsEmpty(self):
         """Test that adding data causes a new commit."""
         self.addfile()
@@ -792,6 +867,174 @@ class GitRepositoryTests(unittest.TestCase):
         self.assertEqual(response, '256')
 
 
+class GitCommitGraphTests(unittest.TestCase):
+    """Test the commit graph index against the ancestry queries of libgit2."""
+
+    def createHistory(self, repo):
+        """Create the history r <- a1 <- a2 <- m, r <- b1 <- m, b1 <- c and a detached root x."""
+        author = Signature('QuitStoreTest', 'quit@quit.aksw.org')
+        tree = repo.TreeBuilder().write()
+
+        def commit(name, parents):
+            return repo.create_commit(None, author, author, name, tree, parents)
+
+        commits = {'r': commit('r', [])}
+        commits['a1'] = commit('a1', [commits['r']])
+        commits['a2'] = commit('a2', [commits['a1']])
+        commits['b1'] = commit('b1', [commits['r']])
+        commits['m'] = commit('m', [commits['a2'], commits['b1']])
+        commits['c'] = commit('c', [commits['b1']])
+        commits['x'] = commit('x', [])
+        return commits
+
+    def testAncestryQueries(self):
+        with TemporaryRepository() as repo:
+            commits = self.createHistory(repo)
+
+            for bitmaps in [True, False]:
+                graph = quit.git.CommitGraph(repo, bitmaps=bitmaps)
+
+                self.assertEqual(graph.generation(commits['m']), 4)
+                self.assertEqual(graph.generation(str(commits['c'])), 3)
+                self.assertEqual(graph.parents(commits['m']), [commits['a2'], commits['b1']])
+                self.assertIn(commits['r'], graph)
+                self.assertNotIn(commits['x'], graph)
+
+                for one in commits.values():
+                    for two in commits.values():
+                        self.assertEqual(
+                            graph.is_ancestor(one, two),
+                            one == two or repo.descendant_of(two, one))
+                        self.assertEqual(graph.merge_base(one, two), repo.merge_base(one, two))
+
+                self.assertEqual(len(graph), 7)
+                self.assertRaises(RevisionNotFound, graph.ensure, '0' * 40)
+
+    def testMergeBaseStopsAtCommonAncestor(self):
+        """Test that the ancestors below the merge base are not visited."""
+        with TemporaryRepository() as repo:
+            author = Signature('QuitStoreTest', 'quit@quit.aksw.org')
+            tree = repo.TreeBuilder().write()
+            commits = [repo.create_commit(None, author, author, 'c0', tree, [])]
+            for i in range(1, 100):
+                commits.append(repo.create_commit(None, author, author, 'c{}'.format(i), tree,
+                                                  [commits[-1]]))
+            branch = repo.create_commit(None, author, author, 'b', tree, [commits[-2]])
+
+            graph = quit.git.CommitGraph(repo)
+            graph.ensure(commits[-1])
+            graph.ensure(branch)
+            # the history below the merge base can not be walked anymore
+            for id in range(90):
+                graph._parents[id] = None
+            self.assertEqual(graph.merge_base(commits[-1], branch), commits[-2])
+            self.assertEqual(graph.merge_base(branch, commits[-2]), commits[-2])
+            self.assertEqual(graph.merge_base(commits[-1], commits[-1]), commits[-1])
+
+    def testRepositoryUpdatesGraphOnCommit(self):
+        with TemporaryRepositoryFactory().withEmptyGraph("http://example.org/") as repo:
+            quitRepo = quit.git.Repository(repo.workdir)
+            head = quitRepo.revision('HEAD').id
+
+            index = quitRepo.index(head)
+            index.add('graph.nt', '<http://ex.org/a> <http://ex.org/b> <http://ex.org/c> .\n')
+            oid = index.commit('commit', 'QuitStoreTest', 'quit@quit.aksw.org')
+
+            self.assertIn(oid, quitRepo.commit_graph)
+            self.assertTrue(quitRepo.is_ancestor(head, oid))
+            self.assertFalse(quitRepo.is_ancestor(oid, head))
+            self.assertEqual(quitRepo.merge_base(oid, head), pygit2.Oid(hex=head))
+            # ancestor bitmaps need memory quadratic in the number of commits
+            self.assertIsNone(quitRepo.commit_graph._bitmaps)
+
+
+class GitTreeListingTests(unittest.TestCase):
+    """Test the cached listing of the files of a tree."""
+
+    def testFiles(self):
+        with TemporaryRepository() as repo:
+            author = Signature('QuitStoreTest', 'quit@quit.aksw.org')
+            a = repo.create_blob(b'a')
+            b = repo.create_blob(b'b')
+
+            def tree(entries):
+                builder = repo.TreeBuilder()
+                for name, oid, filemode in entries:
+                    builder.insert(name, oid, filemode)
+                return builder.write()
+
+            sub = tree([('b.nt', b, pygit2.GIT_FILEMODE_BLOB)])
+            root = tree([('a.nt', a, pygit2.GIT_FILEMODE_BLOB),
+                         ('x', sub, pygit2.GIT_FILEMODE_TREE),
+                         ('y', sub, pygit2.GIT_FILEMODE_TREE)])
+            commit = repo.create_commit('HEAD', author, author, 'm', root, [])
+
+            quitRepo = quit.git.Repository(repo.workdir)
+            expected = [('a.nt', a, pygit2.GIT_FILEMODE_BLOB),
+                        ('x/b.nt', b, pygit2.GIT_FILEMODE_BLOB),
+                        ('y/b.nt', b, pygit2.GIT_FILEMODE_BLOB)]
+
+            self.assertEqual(sorted(quitRepo.revision(str(commit)).files()), expected)
+            self.assertEqual(quitRepo.files(repo[sub]), (('b.nt', b, pygit2.GIT_FILEMODE_BLOB),))
+            self.assertEqual(
+                sorted(quitRepo.files(repo[root])),
+                sorted((node.name, node.oid, pygit2.GIT_FILEMODE_BLOB) for node
+                       in quitRepo.revision(str(commit)).node().entries(recursive=True)
+                       if node.is_file))
+
+
+class GitPathIndexTests(unittest.TestCase):
+    """Test the per-path index of file versions."""
+
+    def testHistory(self):
+        with TemporaryRepository() as repo:
+            author = Signature('QuitStoreTest', 'quit@quit.aksw.org')
+            blobs = {content: repo.create_blob(content) for content in [b'1', b'2', b'3']}
+
+            def commit(files, parents):
+                builder = repo.TreeBuilder()
+                for name, content in files.items():
+                    builder.insert(name, blobs[content], pygit2.GIT_FILEMODE_BLOB)
+                return repo.create_commit(None, author, author, 'm', builder.write(), parents)
+
+            c1 = commit({'a.nt': b'1', 'b.nt': b'1'}, [])
+            c2 = commit({'a.nt': b'2', 'b.nt': b'1'}, [c1])
+            c3 = commit({'a.nt': b'2', 'b.nt': b'2'}, [c2])
+            c4 = commit({'a.nt': b'3'}, [c3])
+            c5 = commit({'a.nt': b'3', 'b.nt': b'3'}, [c4])
+
+            for interval in [1, 2, 64]:
+                index = quit.git.PathIndex(repo, interval=interval)
+
+                self.assertEqual(list(index.history(c4, 'a.nt')),
+                                 [(c2, blobs[b'2']), (c1, blobs[b'1'])])
+                self.assertIn(c1, index)
+                self.assertNotIn(c5, index)
+                self.assertEqual(index.previous(c3, 'a.nt'), (c1, blobs[b'1']))
+                self.assertEqual(index.previous(c3, 'b.nt'), (c1, blobs[b'1']))
+                self.assertIsNone(index.previous(c1, 'a.nt'))
+                self.assertIsNone(index.previous(c4, 'b.nt'))
+                # b.nt was removed in c4, so its history starts again in c5
+                self.assertIsNone(index.previous(c5, 'b.nt'))
+                self.assertEqual(list(index.versions(c5, 'b.nt')), [(c5, blobs[b'3'])])
+                # only the checkpoints keep all paths of a commit
+                self.assertEqual(len(index._checkpoints), (4 // interval) + 1)
+
+    def testNodeHistory(self):
+        with TemporaryRepositoryFactory().withEmptyGraph("http://example.org/") as repo:
+            quitRepo = quit.git.Repository(repo.workdir)
+            head = quitRepo.revision('HEAD').id
+            initial = quitRepo.revision(head).node('graph.nt').oid
+
+            index = quitRepo.index(head)
+            index.add('graph.nt', '<http://ex.org/a> <http://ex.org/b> <http://ex.org/c> .\n')
+            oid = index.commit('commit', 'QuitStoreTest', 'quit@quit.aksw.org')
+
+            history = list(quitRepo.revision(str(oid)).node('graph.nt').history())
+            self.assertEqual([node.oid for node in history], [initial])
+            self.assertEqual(history[0]._commit.hex, head)
+
+
 def main():
     unittest.main()
 
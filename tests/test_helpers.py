@@ -5,8 +5,14 @@ from context import quit
 from itertools import chain
 from quit.helpers import configure_query_dataset, configure_update_dataset
 from quit.helpers import parse_query_type, parse_update_type
+from quit.helpers import PreparedQueryCache, preparedQueries
+from quit.helpers import ntLines, applyChangeset
+from quit.cache import FileReference
+from quit.tools.update import _append
 from quit.exceptions import SparqlProtocolError, NonAbsoluteBaseError, UnSupportedQuery
-from rdflib import URIRef
+from rdflib import BNode, Literal, URIRef
+from rdflib.namespace import XSD
+from rdflib.plugins.serializers.nt import _nt_row
 from rdflib.plugins.sparql.parser import parseQuery, parseUpdate
 
 
@@ -468,6 +474,103 @@ class QueryRewritingTests(unittest.TestCase):
                           configure_update_dataset, parseUpdate(self.update_named), ['urn:default'], ['urn:named'])
 
 
+class PreparedQueryCacheTests(unittest.TestCase):
+    """Test the cache of prepared queries."""
+
+    def testCacheHit(self):
+        cache = PreparedQueryCache()
+        calls = []
+
+        def prepare():
+            calls.append(1)
+            return 'prepared'
+
+        self.assertEqual(cache.get('key', prepare), 'prepared')
+        self.assertEqual(cache.get('key', prepare), 'prepared')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.stats['hits'], 1)
+        self.assertEqual(cache.stats['misses'], 1)
+        self.assertEqual(cache.stats['size'], 1)
+
+    def testNoCacheOnError(self):
+        cache = PreparedQueryCache()
+
+        def prepare():
+            raise UnSupportedQuery()
+
+        self.assertRaises(UnSupportedQuery, cache.get, 'key', prepare)
+        self.assertEqual(cache.stats['size'], 0)
+
+    def testParseQueryTypeIsCached(self):
+        preparedQueries.clear()
+        select = "SELECT * WHERE { ?s ?p ?o }"
+
+        first = parse_query_type(select, 'http://example.org/')
+        second = parse_query_type(select, 'http://example.org/')
+        self.assertIs(first[1], second[1])
+
+        other = parse_query_type(select, 'http://example.org/', ['http://example.org/graph'])
+        self.assertIsNot(first[1], other[1])
+        self.assertEqual(len(other[1].algebra.datasetClause), 1)
+
+        update = "INSERT { ?s <urn:b> <urn:c> } WHERE { ?s <urn:b> <urn:a> }"
+        first = parse_update_type(update)
+        second = parse_update_type(update)
+        self.assertIs(first[1], second[1])
+
+        self.assertEqual(preparedQueries.stats['hits'], 2)
+        self.assertEqual(preparedQueries.stats['misses'], 3)
+
+        # updates with data payloads are not kept
+        for update in ["INSERT DATA { <urn:a> <urn:b> <urn:c> }",
+                       "DELETE DATA { <urn:a> <urn:b> <urn:c> }",
+                       "DELETE WHERE { ?s ?p ?o }; INSERT DATA { <urn:a> <urn:b> <urn:c> }"]:
+            first = parse_update_type(update)
+            second = parse_update_type(update)
+            self.assertIsNot(first[1], second[1])
+        self.assertEqual(preparedQueries.stats['size'], 3)
+
+
+class ChangesetTests(unittest.TestCase):
+    """Test applying the deltas of updates to graph files."""
+
+    a, b, p = URIRef('http://ex.org/a'), URIRef('http://ex.org/b'), URIRef('http://ex.org/p')
+
+    def testNtLines(self):
+        node = BNode()
+        triples = [(self.b, self.p, Literal('x "y"\nz', lang='en')),
+                   (self.a, self.p, Literal('1', datatype=XSD.integer)),
+                   (node, self.p, self.a),
+                   (self.a, self.p, node),
+                   (self.a, self.p, Literal('1', datatype=XSD.integer))]
+        self.assertEqual(ntLines(triples),
+                         sorted(set(_nt_row(triple).rstrip() for triple in triples)))
+        self.assertEqual(len(ntLines(triples)), 4)
+
+    def testApplyChangeset(self):
+        f = FileReference('graph.nt', '<http://ex.org/a> <http://ex.org/p> "1" .\n'
+                                      '<http://ex.org/b> <http://ex.org/p> "2" .')
+        changeset = [('removals', [(self.a, self.p, Literal('1')), (self.a, self.p, self.b)]),
+                     ('additions', [(self.b, self.p, Literal('3')),
+                                    (self.a, self.p, Literal('1'))]),
+                     ('removals', [(self.b, self.p, Literal('2'))])]
+        applyChangeset(f, changeset, URIRef('http://example.org/'))
+        self.assertEqual(f.content, '<http://ex.org/a> <http://ex.org/p> "1" .\n'
+                                    '<http://ex.org/b> <http://ex.org/p> "3" .\n')
+
+    def testUpdateDeltaBatches(self):
+        delta = {}
+        for i in range(3):
+            _append(delta, 'http://example.org/', 'removals', [(self.a, self.p, Literal(i))])
+        _append(delta, 'http://example.org/', 'additions', [(self.b, self.p, Literal(0))])
+        _append(delta, 'http://example.org/', 'removals', [])
+        _append(delta, 'http://example.org/', 'removals', [(self.b, self.p, Literal(1))])
+        self.assertEqual(delta, {URIRef('http://example.org/'): [
+            ('removals', [(self.a, self.p, Literal(i)) for i in range(3)]),
+            ('additions', [(self.b, self.p, Literal(0))]),
+            ('removals', [(self.b, self.p, Literal(1))])]})
+
+
 def main():
     unittest.main()
 
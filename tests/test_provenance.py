@@ -2,7 +2,10 @@
 
 import unittest
 from context import quit
-from quit.provenance import Blame
+from quit.provenance import Blame, BlameIndex, HistoryBlame, quad_key
+from quit.git import Repository as QuitRepository
+from helpers import TemporaryRepository, createCommit
+from rdflib import BNode, URIRef
 from os import path, environ
 from pygit2 import init_repository, Repository, clone_repository
 from pygit2 import GIT_SORT_TOPOLOGICAL, GIT_SORT_REVERSE, Signature
@@ -17,6 +20,133 @@ class BlameTests(unittest.TestCase):
         pass
 
 
+class BlameIndexTests(unittest.TestCase):
+    graph = URIRef('http://example.org/')
+
+    def triple(self, name):
+        return (
+            URIRef('http://ex.org/' + name), URIRef('http://ex.org/p'), URIRef('http://ex.org/o'))
+
+    def key(self, name):
+        return quad_key(*self.triple(name), self.graph)
+
+    def testLinearHistory(self):
+        index = BlameIndex()
+        index.add('a', [], {self.graph: [('additions', [self.triple('x'), self.triple('y')])]})
+        index.add('b', ['a'], {self.graph: [('additions', [self.triple('z')]),
+                                            ('removals', [self.triple('x')])]})
+        index.add('c', ['b'], {self.graph: [('additions', [self.triple('x')])]})
+
+        self.assertIn('b', index)
+        self.assertNotIn('d', index)
+        self.assertEqual(index.attribution('a'), {self.key('x'): 'a', self.key('y'): 'a'})
+        self.assertEqual(index.attribution('b'), {self.key('y'): 'a', self.key('z'): 'b'})
+        self.assertEqual(
+            index.attribution('c'), {self.key('x'): 'c', self.key('y'): 'a', self.key('z'): 'b'})
+        self.assertRaises(KeyError, index.attribution, 'd')
+
+    def testMergeKeepsAttribution(self):
+        index = BlameIndex(capacity=1)
+        index.add('a', [], {self.graph: [('additions', [self.triple('x')])]})
+        index.add('b', ['a'], {self.graph: [('additions', [self.triple('y')])]})
+        index.add('c', ['a'], {self.graph: [('additions', [self.triple('z')])]})
+        # the merge takes over z from c and introduces m itself
+        index.add('m', ['b', 'c'], {self.graph: [('additions', [self.triple('z'),
+                                                                self.triple('m')])]})
+
+        self.assertEqual(index.attribution('m'), {
+            self.key('x'): 'a', self.key('y'): 'b', self.key('z'): 'c', self.key('m'): 'm'})
+
+    def testNestedMerges(self):
+        index = BlameIndex(capacity=1)
+        index.add('a', [], {self.graph: [('additions', [self.triple('x')])]})
+        index.add('b', ['a'], {self.graph: [('additions', [self.triple('y')])]})
+        index.add('c', ['a'], {self.graph: [('additions', [self.triple('z')])]})
+        index.add('d', ['c'], {self.graph: [('removals', [self.triple('z')])]})
+        # e takes over y from b, the merge of e takes it over from e
+        index.add('e', ['d', 'b'], {self.graph: [('additions', [self.triple('y')])]})
+        index.add('f', ['a'], {self.graph: [('additions', [self.triple('w')])]})
+        # z was removed in the history of e, so it is taken over from c
+        index.add('m', ['f', 'e', 'c'], {self.graph: [('additions', [
+            self.triple('y'), self.triple('z'), self.triple('m')])]})
+
+        self.assertEqual(index.attribution('m'), {
+            self.key('x'): 'a', self.key('y'): 'b', self.key('z'): 'c', self.key('w'): 'f',
+            self.key('m'): 'm'})
+
+    def testManyMerges(self):
+        index = BlameIndex(capacity=1)
+        index.add('m0', [], {self.graph: [('additions', [self.triple('root')])]})
+        for i in range(1, 3000):
+            side = [('additions', [self.triple(str(i))])]
+            index.add('s{}'.format(i), ['m{}'.format(i - 1)], {self.graph: side})
+            index.add('m{}'.format(i), ['m{}'.format(i - 1), 's{}'.format(i)], {self.graph: side})
+
+        attribution = index.attribution('m2999')
+        self.assertEqual(len(attribution), 3000)
+        self.assertEqual(attribution[self.key('root')], 'm0')
+        self.assertEqual(attribution[self.key('1234')], 's1234')
+
+    def testBlankNodes(self):
+        index = BlameIndex()
+        s, p, o = BNode(), URIRef('http://ex.org/p'), URIRef('http://ex.org/o')
+        index.add('a', [], {self.graph: [('additions', [(s, p, o)])]})
+
+        self.assertEqual(index.attribution('a').get(quad_key(BNode(), p, o, self.graph)), 'a')
+
+
+class HistoryBlameTests(unittest.TestCase):
+
+    def commit(self, repo, lines):
+        with open(path.join(repo.workdir, 'graph.nt'), 'w') as graphFile:
+            graphFile.write('\n'.join(sorted(lines)) + '\n')
+        createCommit(repo)
+        return str(repo.head.target)
+
+    def testBlameReusesBlobs(self):
+        a = '<http://ex.org/a> <http://ex.org/p> "a" .'
+        b = '<http://ex.org/b> <http://ex.org/p> "b" .'
+        c = '<http://ex.org/c> <http://ex.org/p> "c" .'
+
+        with TemporaryRepository() as repo:
+            first = self.commit(repo, [a, b])
+            second = self.commit(repo, [a, c])
+            third = self.commit(repo, [a, b, c])
+
+            history = HistoryBlame(QuitRepository(repo.workdir))
+            self.assertEqual(history.blame(second, 'graph.nt'), {a: first, c: second})
+            self.assertEqual(history._blobs.size, 2)
+
+            # only the blob of the third commit has to be computed
+            self.assertEqual(history.blame(third, 'graph.nt'), {a: first, b: third, c: second})
+            self.assertEqual(history._blobs.size, 3)
+
+            self.assertEqual(history.blame(first, 'graph.nt'), {a: first, b: first})
+            self.assertEqual(history.blame(first, 'missing.nt'), {})
+
+    def testBlameFollowsHistoryOfPath(self):
+        a = '<http://ex.org/a> <http://ex.org/p> "a" .'
+        b = '<http://ex.org/b> <http://ex.org/p> "b" .'
+
+        with TemporaryRepository() as repo:
+            first = self.commit(repo, [a, b])
+            second = self.commit(repo, [a])
+            # the blob of the first commit again, b is introduced by the revert
+            third = self.commit(repo, [a, b])
+            # the same blob at another path is introduced by the commit that creates the file
+            with open(path.join(repo.workdir, 'other.nt'), 'w') as graphFile:
+                graphFile.write('\n'.join([a, b]) + '\n')
+            createCommit(repo)
+            fourth = str(repo.head.target)
+
+            history = HistoryBlame(QuitRepository(repo.workdir))
+            self.assertEqual(history.blame(first, 'graph.nt'), {a: first, b: first})
+            self.assertEqual(history.blame(second, 'graph.nt'), {a: first})
+            self.assertEqual(history.blame(third, 'graph.nt'), {a: first, b: third})
+            self.assertEqual(history.blame(fourth, 'graph.nt'), {a: first, b: third})
+            self.assertEqual(history.blame(fourth, 'other.nt'), {a: fourth, b: fourth})
+
+
 def main():
     unittest.main()
 